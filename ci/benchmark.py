@@ -0,0 +1,402 @@
+# Time the neopo install path against the local fixture server (fixtures.py)
+# Reports time, throughput and peak memory for each scenario, and fails if a
+# scenario got slower than a saved baseline. Then compares NEOPO_SEGMENTS values
+# on an archive above SEGMENT_THRESHOLD over a slow link, and the extraction
+# backend with and without pigz/zstd against tarfile.extractall. Example:
+#   python ci/benchmark.py --bandwidth 50 --latency 0.02 --json results.json
+#   python ci/benchmark.py --baseline results.json --tolerance 0.5
+import argparse
+import builtins
+import contextlib
+import gzip
+import io
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import tracemalloc
+
+# Run from a checkout without installing neopo
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fixtures import FIRMWARE, UNLISTED, FixtureServer
+
+parser = argparse.ArgumentParser(description="Benchmark the neopo install path")
+parser.add_argument("--size", type=float, default=24, help="archive size in MiB")
+parser.add_argument("--bandwidth", type=float, default=0, help="MiB/s per connection")
+parser.add_argument("--latency", type=float, default=0, help="seconds per response")
+parser.add_argument(
+    "--failure-rate", type=float, default=0, help="chance of dropping a download"
+)
+parser.add_argument("--segments", type=int, default=4, help="NEOPO_SEGMENTS to test")
+parser.add_argument(
+    "--sweep", default="1,2,4,8", help="NEOPO_SEGMENTS values to compare (or '')"
+)
+parser.add_argument(
+    "--sweep-latency",
+    type=float,
+    default=0.05,
+    help="seconds per response while comparing NEOPO_SEGMENTS",
+)
+parser.add_argument(
+    "--sweep-bandwidth",
+    type=float,
+    default=10,
+    help="MiB/s per connection while comparing NEOPO_SEGMENTS",
+)
+parser.add_argument("--json", help="write the results to a file")
+parser.add_argument("--baseline", help="compare with results written by --json")
+parser.add_argument(
+    "--tolerance", type=float, default=0.5, help="allowed slowdown (0.5 is 50%%)"
+)
+parser.add_argument("--verbose", action="store_true", help="show neopo output")
+args = parser.parse_args()
+
+# neopo reads its configuration when imported, so set it up first
+workspace = tempfile.TemporaryDirectory(prefix="neopo-benchmark-")
+os.environ["NEOPO_PATH"] = os.path.join(workspace.name, "neopo")
+os.environ["NEOPO_STORE"] = os.path.join(workspace.name, "store")
+os.environ["NEOPO_RETRIES"] = "20"
+os.environ.pop("NEOPO_MIRROR", None)
+
+import neopo.download
+import neopo.extract
+import neopo.project
+import neopo.store
+import neopo.toolchain
+import neopo.utility
+import neopo.verify
+import neopo.workbench
+
+server = FixtureServer(
+    size=int(args.size * 1024 * 1024),
+    bandwidth=int(args.bandwidth * 1024 * 1024),
+    latency=args.latency,
+    failure_rate=args.failure_rate,
+    verbose=args.verbose,
+).start()
+
+# Point every upstream service at the fixture server
+neopo.workbench.MARKETPLACE_QUERY = server.base_url + "/extensionquery"
+neopo.workbench.PARTICLE_MANIFEST = server.base_url + "/particle-cli.json"
+neopo.workbench.ARM_GCC_ARM = {}
+neopo.utility.s3_bucket = server.base_url + "/s3/"
+neopo.toolchain.DEVICE_OS_BINARIES = server.base_url + "/device-os/v%s.tar.gz"
+
+# Project with a library that depends on another library
+project = os.path.join(workspace.name, "project")
+os.makedirs(os.path.join(project, "lib"))
+with open(os.path.join(project, "project.properties"), "w") as file:
+    file.write("name=project\ndependencies.FixtureLib=1.0.0\n")
+
+versions = list(FIRMWARE)
+MIB = 1024 * 1024
+
+
+def download_unlisted():
+    # Unlisted releases have no sha256 to check, accept the prompt
+    answer = builtins.input
+    builtins.input = lambda prompt="": "y"
+    try:
+        neopo.toolchain.download_unlisted(UNLISTED)
+    finally:
+        builtins.input = answer
+
+
+def download_segmented():
+    neopo.download.NEOPO_SEGMENTS = args.segments
+    try:
+        neopo.toolchain.download_firmware(versions[1])
+    finally:
+        neopo.download.NEOPO_SEGMENTS = 1
+
+
+# Scenarios run in order, each building on the state left by the previous ones
+scenarios = [
+    ("install", lambda: neopo.workbench.install_or_update(True, False, False)),
+    (
+        "update (unchanged)",
+        lambda: neopo.workbench.install_or_update(False, False, False),
+    ),
+    ("download_firmware", lambda: neopo.toolchain.download_firmware(versions[2])),
+    ("download_firmware (segmented)", download_segmented),
+    ("download_unlisted", download_unlisted),
+    (
+        "download_firmware (argon only)",
+        lambda: neopo.toolchain.download_firmware(versions[3], ["argon"]),
+    ),
+    (
+        "add boron (from store)",
+        lambda: neopo.toolchain.add_firmware_platforms(versions[3], ["boron"]),
+    ),
+    ("check_libraries", lambda: neopo.project.check_libraries(project, True)),
+    (
+        "install -f (from store)",
+        lambda: neopo.workbench.install_or_update(True, True, False),
+    ),
+    ("verify", lambda: neopo.verify.verify_deps(False)),
+    ("verify --deep", lambda: neopo.verify.verify_deps(True)),
+]
+
+
+# Archive for the NEOPO_SEGMENTS sweep, large enough to be downloaded in segments
+sweep_dep = None
+if args.sweep:
+    sweep_size = max(int(args.size * MIB), 4 * neopo.download.SEGMENT_THRESHOLD)
+    sweep_dep = server.fixtures.dependency("sweep", "1.0.0", sweep_size)
+    sweep_archive = server.fixtures.path("toolchains/sweep-1.0.0.tar.gz")
+    assert os.path.getsize(sweep_archive) > neopo.download.SEGMENT_THRESHOLD
+
+
+# Download and extract the sweep archive with a number of segments, as an install
+# would, starting from an empty artifact store every time
+def download_sweep(segments):
+    neopo.store.remove_artifact(sweep_dep["sha256"])
+    neopo.download.NEOPO_SEGMENTS = segments
+    target = os.path.join(workspace.name, "sweep")
+    try:
+        staging, _ = neopo.download.stream_to_staging(
+            sweep_dep["url"], target, sweep_dep
+        )
+        neopo.download.discard_staging(staging)
+    finally:
+        neopo.download.NEOPO_SEGMENTS = 1
+
+
+# deviceOS archive for the extraction comparison, also compressed with zstd if
+# it is installed
+extract_gzip = server.fixtures.path("toolchains/deviceOS-%s.tar.gz" % versions[0])
+extract_zstd = None
+if shutil.which("zstd"):
+    extract_zstd = os.path.join(workspace.name, "deviceOS.tar.zst")
+    with open(extract_gzip, "rb") as file:
+        subprocess.run(
+            ["zstd", "-q", "-f", "-o", extract_zstd],
+            input=gzip.decompress(file.read()),
+            check=True,
+        )
+
+
+# Extract an archive the way neopo did before neopo.extract
+def extract_tarfile(archive, target):
+    with open(archive, "rb") as file:
+        with tarfile.open(
+            fileobj=file, mode="r|gz", bufsize=neopo.extract.CHUNK_SIZE
+        ) as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(target, filter="tar")
+            else:
+                tar.extractall(target)
+
+
+# Extract an archive with neopo.extract, decompressing it with command (a list of
+# arguments) or in-process if it is None, whatever the number of cores
+def extract_parallel(archive, target, command):
+    find_decompressor = neopo.extract.find_decompressor
+    neopo.extract.find_decompressor = lambda magic: command
+    try:
+        with open(archive, "rb") as file:
+            neopo.extract.extract_archive(file, target)
+    finally:
+        neopo.extract.find_decompressor = find_decompressor
+
+
+# Installed command for a kind of archive, fastest first
+def decompressor(magic):
+    for command in neopo.extract.DECOMPRESSORS[magic]:
+        if shutil.which(command[0]):
+            return command
+    return None
+
+
+# Ways to extract: [(name, function(target))], the first one is the baseline
+gzip_command = decompressor(neopo.extract.GZIP_MAGIC)
+extractions = [
+    ("tarfile.extractall", lambda target: extract_tarfile(extract_gzip, target)),
+    (
+        "neopo.extract, zlib",
+        lambda target: extract_parallel(extract_gzip, target, None),
+    ),
+]
+if gzip_command:
+    extractions.append(
+        (
+            "neopo.extract, %s" % gzip_command[0],
+            lambda target: extract_parallel(extract_gzip, target, gzip_command),
+        )
+    )
+if extract_zstd:
+    extractions.append(
+        (
+            "neopo.extract, zstd",
+            lambda target: extract_parallel(
+                extract_zstd, target, decompressor(neopo.extract.ZSTD_MAGIC)
+            ),
+        )
+    )
+
+
+def run(name, scenario):
+    output = io.StringIO()
+    start_stats = dict(server.stats)
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        if args.verbose:
+            scenario()
+        else:
+            with contextlib.redirect_stdout(output):
+                scenario()
+    except BaseException:
+        print(output.getvalue())
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    transferred = server.stats["bytes"] - start_stats["bytes"]
+    return {
+        "name": name,
+        "seconds": elapsed,
+        "bytes": transferred,
+        "throughput": transferred / elapsed if elapsed else 0,
+        "requests": server.stats["requests"] - start_stats["requests"],
+        "failures": server.stats["failures"] - start_stats["failures"],
+        "peak_memory": peak,
+    }
+
+
+results = []
+try:
+    print(
+        "%-32s %8s %10s %10s %8s %8s %10s"
+        % ("scenario", "seconds", "MiB", "MiB/s", "requests", "dropped", "peak MiB")
+    )
+    for name, scenario in scenarios:
+        result = run(name, scenario)
+        results.append(result)
+        print(
+            "%-32s %8.2f %10.1f %10.1f %8d %8d %10.1f"
+            % (
+                name,
+                result["seconds"],
+                result["bytes"] / MIB,
+                result["throughput"] / MIB,
+                result["requests"],
+                result["failures"],
+                result["peak_memory"] / MIB,
+            )
+        )
+
+    # Compare numbers of segments on one archive over a slow link, without dropped
+    # connections so the timings are comparable
+    if sweep_dep:
+        print()
+        print(
+            "NEOPO_SEGMENTS sweep: %.1f MiB archive, %.2fs latency, %s per connection"
+            % (
+                os.path.getsize(sweep_archive) / MIB,
+                args.sweep_latency,
+                (
+                    "%.1f MiB/s" % args.sweep_bandwidth
+                    if args.sweep_bandwidth
+                    else "unlimited"
+                ),
+            )
+        )
+        print("%-32s %8s %10s %8s" % ("scenario", "seconds", "MiB/s", "speedup"))
+        link = server.latency, server.bandwidth, server.failure_rate
+        server.latency = args.sweep_latency
+        server.bandwidth = int(args.sweep_bandwidth * MIB)
+        server.failure_rate = 0
+        try:
+            single = None
+            for segments in [int(value) for value in args.sweep.split(",")]:
+                name = "download (%d segments)" % segments
+                result = run(name, lambda segments=segments: download_sweep(segments))
+                single = single or (segments == 1 and result["seconds"])
+                result["speedup"] = single / result["seconds"] if single else None
+                results.append(result)
+                print(
+                    "%-32s %8.2f %10.1f %8s"
+                    % (
+                        name,
+                        result["seconds"],
+                        result["throughput"] / MIB,
+                        "%.2fx" % result["speedup"] if single else "-",
+                    )
+                )
+        finally:
+            server.latency, server.bandwidth, server.failure_rate = link
+
+    # Compare the extraction backends on the same archive, already on disk
+    print()
+    print(
+        "Extraction: %.1f MiB archive, %d core(s), %d writer thread(s)"
+        % (
+            os.path.getsize(extract_gzip) / MIB,
+            os.cpu_count() or 1,
+            neopo.extract.EXTRACT_WORKERS,
+        )
+    )
+    print("%-32s %8s %10s %8s" % ("scenario", "seconds", "MiB/s", "speedup"))
+    baseline_seconds = None
+    for backend, extraction in extractions:
+        name = "extract (%s)" % backend
+        target = os.path.join(workspace.name, "extract")
+        result = run(
+            name, lambda extraction=extraction, target=target: extraction(target)
+        )
+        shutil.rmtree(target)
+        result["throughput"] = os.path.getsize(extract_gzip) / result["seconds"]
+        baseline_seconds = baseline_seconds or result["seconds"]
+        result["speedup"] = baseline_seconds / result["seconds"]
+        results.append(result)
+        print(
+            "%-32s %8.2f %10.1f %7.2fx"
+            % (
+                name,
+                result["seconds"],
+                result["throughput"] / MIB,
+                result["speedup"],
+            )
+        )
+finally:
+    server.stop()
+    workspace.cleanup()
+
+# ru_maxrss is in KiB on Linux and bytes on macOS
+max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+max_rss = max_rss / (MIB if sys.platform == "darwin" else 1024)
+print("Peak resident memory: %.1f MiB" % max_rss)
+
+if args.json:
+    with open(args.json, "w") as file:
+        json.dump({"results": results, "max_rss_mib": max_rss}, file, indent=4)
+
+# Fail on scenarios that got slower than the baseline allows
+if args.baseline:
+    with open(args.baseline) as file:
+        baseline = {result["name"]: result for result in json.load(file)["results"]}
+    regressions = []
+    for result in results:
+        previous = baseline.get(result["name"])
+        if not previous:
+            continue
+        # Ignore noise on scenarios that only take a moment
+        allowed = previous["seconds"] * (1 + args.tolerance) + 0.25
+        if result["seconds"] > allowed:
+            regressions.append(
+                "%s: %.2fs, baseline %.2fs"
+                % (result["name"], result["seconds"], previous["seconds"])
+            )
+    if regressions:
+        print("Slower than the baseline:")
+        print(*regressions, sep="\n")
+        sys.exit(1)
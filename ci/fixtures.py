@@ -0,0 +1,473 @@
+# Local stand-in for the Marketplace, binaries.particle.io, GitHub releases and
+# the S3 library bucket, serving synthetic content with configurable bandwidth,
+# latency and dropped connections. Run it directly or use it from benchmark.py:
+#   python ci/fixtures.py --port 8080 --bandwidth 20 --latency 0.05 --failure-rate 0.1
+import argparse
+import gzip
+import hashlib
+import http.server
+import io
+import json
+import os
+import random
+import re
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.parse
+import zipfile
+
+# Paths of the Workbench files inside the VSIX
+VSIX_MANIFEST = "extension/node_modules/@particle/toolchain-manager/manifest.json"
+VSIX_LAUNCH = "extension/src/cli/vscode/launch.json"
+VSIX_SETTINGS = "extension/src/cli/vscode/settings.json"
+
+# Listed deviceOS releases and the toolchains they use
+FIRMWARE = {
+    "3.0.0": {
+        "gcc-arm": "10.2.1",
+        "buildtools": "1.1.1",
+        "buildscripts": "1.10.0",
+        "openocd": "0.11.0",
+    },
+    "2.5.0": {
+        "gcc-arm": "10.2.1",
+        "buildtools": "1.1.1",
+        "buildscripts": "1.10.0",
+        "openocd": "0.11.0",
+    },
+    "2.0.0": {
+        "gcc-arm": "9.2.1",
+        "buildtools": "1.1.1",
+        "buildscripts": "1.9.2",
+        "openocd": "0.11.0",
+    },
+    "1.5.0": {
+        "gcc-arm": "9.2.1",
+        "buildtools": "1.1.1",
+        "buildscripts": "1.9.2",
+        "openocd": "0.11.0",
+    },
+}
+
+# Directories the files of deviceOS releases are spread over, like a real release
+# with shared sources and per-platform sources and build outputs
+DEVICE_OS_DIRECTORIES = [
+    "wiring/src",
+    "hal/src/nRF52840",
+    "hal/src/argon",
+    "hal/src/boron",
+    "modules/argon",
+    "modules/boron",
+    "build/target/user/platform-12-m",
+    "build/target/user/platform-13-m",
+]
+
+# Release that is only available from the device-os download mirror
+UNLISTED = "1.9.9"
+
+# Libraries in the S3 bucket: name -> (version, dependencies)
+LIBRARIES = {
+    "FixtureLib": ("1.0.0", {"FixtureDep": "0.1.0"}),
+    "FixtureDep": ("0.1.0", {}),
+}
+
+CATALOG_KEYS = {
+    "gcc-arm": "compilers",
+    "buildtools": "tools",
+    "buildscripts": "scripts",
+    "openocd": "debuggers",
+}
+SYSTEMS = ["linux", "darwin", "windows"]
+ARCHITECTURES = ["x64", "arm", "arm64"]
+CHUNK_SIZE = 16 * 1024
+
+
+# Write a gzipped tarball of files with partly compressible contents
+def write_tarball(path, size, files=None, seed=0, directories=("src",)):
+    generator = random.Random(seed)
+    files = dict(files or {})
+    count = max(1, min(256, size // (64 * 1024)))
+    for index in range(count):
+        # Half random bytes, half repeated text, roughly like object files and sources
+        length = size // count
+        noise = generator.getrandbits(length * 4).to_bytes(length // 2, "little")
+        name = "%s/file%03d.bin" % (directories[index % len(directories)], index)
+        files[name] = noise + b"neopo fixture " * (length // 28)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tarfile.open(path, "w:gz", compresslevel=1) as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mode = 0o755 if name.startswith("bin/") else 0o644
+            tar.addfile(info, io.BytesIO(content))
+    return sha256_file(path)
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Synthetic upstream content, written to a directory and described by URLs under
+# base_url
+class Fixtures:
+    def __init__(self, root, base_url, size):
+        self.root = root
+        self.base_url = base_url
+        self.size = size
+        self.vsix_version = "1.0.0"
+        self.build()
+
+    def url(self, path):
+        return "%s/%s" % (self.base_url, path)
+
+    def path(self, path):
+        return os.path.join(self.root, path)
+
+    def dependency(self, name, version, size, files=None):
+        relative = "toolchains/%s-%s.tar.gz" % (name, version)
+        seed = int(hashlib.sha256(relative.encode()).hexdigest()[:8], 16)
+        directories = DEVICE_OS_DIRECTORIES if name == "deviceOS" else ("src",)
+        sha256 = write_tarball(self.path(relative), size, files, seed, directories)
+        return {
+            "name": name,
+            "version": version,
+            "url": self.url(relative),
+            "sha256": sha256,
+        }
+
+    def build(self):
+        manifest = {
+            "firmware": [],
+            "platforms": [{"id": 12, "name": "argon"}, {"id": 13, "name": "boron"}],
+        }
+        manifest["toolchains"] = []
+        toolchains = {}
+        for version, deps in FIRMWARE.items():
+            manifest["firmware"].append(self.dependency("deviceOS", version, self.size))
+            manifest["toolchains"].append(
+                dict(
+                    {
+                        key: "%s@%s" % (name, deps[name])
+                        for name, key in CATALOG_KEYS.items()
+                    },
+                    firmware="deviceOS@%s" % version,
+                    platforms=[12, 13],
+                )
+            )
+            for name, dep_version in deps.items():
+                toolchains.setdefault((name, dep_version), None)
+
+        # Toolchains are smaller than deviceOS, except for the compiler
+        for name, version in toolchains:
+            size = self.size if name == "gcc-arm" else self.size // 4
+            toolchains[(name, version)] = self.dependency(name, version, size)
+        for name, key in CATALOG_KEYS.items():
+            entries = sorted(
+                [dep for dep in toolchains.values() if dep["name"] == name],
+                key=lambda dep: [int(part) for part in dep["version"].split(".")],
+                reverse=True,
+            )
+            manifest[key] = {
+                system: {arch: entries for arch in ARCHITECTURES} for system in SYSTEMS
+            }
+
+        with zipfile.ZipFile(
+            self.path("extension.vsix"), "w", zipfile.ZIP_DEFLATED
+        ) as vsix:
+            vsix.writestr(VSIX_MANIFEST, json.dumps(manifest, indent=4))
+            vsix.writestr(VSIX_LAUNCH, "{}")
+            vsix.writestr(VSIX_SETTINGS, "{}")
+            # Padding like the rest of a real extension, which is never downloaded
+            vsix.writestr("extension/dist/extension.js", os.urandom(4 * 1024 * 1024))
+
+        # particle-cli binary and its manifest
+        with gzip.open(self.path("particle.gz"), "wb") as file:
+            file.write(b"#!/bin/sh\necho 'particle fixture 1.0.0'\n")
+        build = {
+            "url": self.url("particle.gz"),
+            "sha256": sha256_file(self.path("particle.gz")),
+        }
+        cli = {
+            "builds": {
+                system: {arch: build for arch in ARCHITECTURES} for system in SYSTEMS
+            }
+        }
+        with open(self.path("particle-cli.json"), "w") as file:
+            json.dump(cli, file)
+
+        # Unlisted release with its own toolchain manifest
+        deps = FIRMWARE["3.0.0"]
+        workbench = {
+            "toolchains": [
+                dict(
+                    {
+                        key: "%s@%s" % (name, deps[name])
+                        for name, key in CATALOG_KEYS.items()
+                    },
+                    firmware="deviceOS@%s" % UNLISTED,
+                    platforms=[12],
+                )
+            ],
+            "platforms": manifest["platforms"],
+        }
+        write_tarball(
+            self.path("device-os/v%s.tar.gz" % UNLISTED),
+            self.size,
+            {".workbench/manifest.json": json.dumps(workbench).encode()},
+        )
+
+        # Libraries in the layout of the S3 bucket
+        for name, (version, dependencies) in LIBRARIES.items():
+            properties = "name=%s\nversion=%s\n" % (name, version)
+            properties += "".join(
+                "dependencies.%s=%s\n" % item for item in dependencies.items()
+            )
+            write_tarball(
+                self.path("s3/libraries/%s/%s-%s.tar.gz" % (name, name, version)),
+                64 * 1024,
+                {"library.properties": properties.encode()},
+            )
+
+    # Response of the Marketplace extension query
+    def extension_query(self):
+        files = [
+            {
+                "assetType": "Microsoft.VisualStudio.Services.VSIXPackage",
+                "source": self.url("extension.vsix"),
+            }
+        ]
+        version = {"version": self.vsix_version, "files": files}
+        return {"results": [{"extensions": [{"versions": [version]}]}]}
+
+    # S3 ListBucketResult for a prefix
+    def s3_listing(self, prefix):
+        keys = []
+        for directory, _, files in os.walk(self.path("s3")):
+            for file in files:
+                key = os.path.relpath(os.path.join(directory, file), self.path("s3"))
+                if key.startswith(prefix):
+                    keys.append(key)
+        contents = "".join(
+            "<Contents><Key>%s</Key></Contents>" % key for key in sorted(keys)
+        )
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            "<ListBucketResult>%s</ListBucketResult>" % contents
+        )
+
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        if self.server.verbose:
+            super().log_message(*args)
+
+    # Remember every response, so tests can check what reached upstream
+    def log_request(self, code="-", size="-"):
+        with self.server.lock:
+            self.server.log.append((self.path, int(code)))
+        super().log_request(code, size)
+
+    def do_POST(self):
+        self.delay()
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.endswith("/extensionquery"):
+            self.send_bytes(
+                json.dumps(self.server.fixtures.extension_query()).encode(),
+                "application/json",
+            )
+        else:
+            self.send_error(404)
+
+    def do_GET(self):
+        self.delay()
+        parts = urllib.parse.urlsplit(self.path)
+        if parts.path == "/s3/":
+            prefix = urllib.parse.parse_qs(parts.query).get("prefix", [""])[0]
+            self.send_bytes(
+                self.server.fixtures.s3_listing(prefix).encode(), "application/xml"
+            )
+            return
+        path = os.path.normpath(self.server.fixtures.path(parts.path.lstrip("/")))
+        if not path.startswith(self.server.fixtures.root) or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        self.send_file(path)
+
+    # Every request is counted and answered after the configured latency
+    def delay(self):
+        self.server.count("requests", 1)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def send_bytes(self, content, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.write(content)
+
+    def send_file(self, path):
+        size = os.path.getsize(path)
+        etag = (
+            '"%s"'
+            % hashlib.sha256(
+                ("%s:%d" % (path, os.path.getmtime(path))).encode()
+            ).hexdigest()
+        )
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        start, end, status = 0, size - 1, 200
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match and self.headers.get("If-Range") in (None, etag):
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            status = 206
+
+        # Drop some archive downloads partway through
+        drop_at = None
+        if path.endswith(".tar.gz") and self.server.failure(end - start + 1):
+            drop_at = self.server.random(start, end)
+
+        self.send_response(status)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        if status == 206:
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+        self.end_headers()
+
+        with open(path, "rb") as file:
+            file.seek(start)
+            position = start
+            while position <= end:
+                chunk = file.read(min(CHUNK_SIZE, end - position + 1))
+                if drop_at is not None and position + len(chunk) > drop_at:
+                    self.write(chunk[: drop_at - position])
+                    self.server.count("failures", 1)
+                    self.close_connection = True
+                    return
+                self.write(chunk)
+                position += len(chunk)
+
+    # Write to the client at no more than the configured bandwidth
+    def write(self, content):
+        try:
+            self.wfile.write(content)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+            return
+        self.server.count("bytes", len(content))
+        if self.server.bandwidth:
+            time.sleep(len(content) / self.server.bandwidth)
+
+
+# Threaded fixture server, bandwidth in bytes/s per connection (0 is unlimited)
+class FixtureServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        port=0,
+        size=16 * 1024 * 1024,
+        bandwidth=0,
+        latency=0,
+        failure_rate=0,
+        seed=0,
+        verbose=False,
+    ):
+        super().__init__(("127.0.0.1", port), FixtureHandler)
+        self.base_url = "http://127.0.0.1:%d" % self.server_address[1]
+        self.directory = tempfile.TemporaryDirectory(prefix="neopo-fixtures-")
+        self.fixtures = Fixtures(self.directory.name, self.base_url, size)
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.verbose = verbose
+        self.generator = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"bytes": 0, "requests": 0, "failures": 0}
+        self.log = []
+
+    def count(self, key, value):
+        with self.lock:
+            self.stats[key] += value
+
+    # Decide whether to drop a response, only for responses worth resuming
+    def failure(self, length):
+        with self.lock:
+            return length > CHUNK_SIZE and self.generator.random() < self.failure_rate
+
+    def random(self, start, end):
+        with self.lock:
+            return self.generator.randint(start + 1, end)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.directory.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve synthetic neopo upstream content"
+    )
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--size", type=float, default=16, help="deviceOS archive size in MiB"
+    )
+    parser.add_argument(
+        "--bandwidth", type=float, default=0, help="MiB/s per connection"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0, help="seconds before each response"
+    )
+    parser.add_argument(
+        "--failure-rate",
+        type=float,
+        default=0,
+        help="chance of dropping an archive download",
+    )
+    args = parser.parse_args()
+
+    server = FixtureServer(
+        args.port,
+        int(args.size * 1024 * 1024),
+        int(args.bandwidth * 1024 * 1024),
+        args.latency,
+        args.failure_rate,
+        verbose=True,
+    )
+    print("Serving fixtures on %s" % server.base_url)
+    print("  Marketplace query: %s/extensionquery" % server.base_url)
+    print("  particle-cli manifest: %s/particle-cli.json" % server.base_url)
+    print("  S3 bucket: %s/s3/" % server.base_url)
+    print("  Unlisted deviceOS: %s/device-os/v%%s.tar.gz" % server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.directory.cleanup()
+
+
+if __name__ == "__main__":
+    main()
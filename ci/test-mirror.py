@@ -0,0 +1,214 @@
+# Run neopo serve and clients using it on the same host, with the local fixture
+# server (fixtures.py) standing in for every upstream service:
+#   python ci/test-mirror.py
+# The mirror and each client run in their own process with their own NEOPO_PATH,
+# started again by this script as:
+#   python ci/test-mirror.py serve <fixtures> <port>
+#   python ci/test-mirror.py client <fixtures> [neopo arguments...]
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+# Run from a checkout without installing neopo
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fixtures import FIRMWARE, FixtureServer
+
+# Seconds the mirror may take to install its catalog and start listening
+STARTUP_TIMEOUT = 120
+
+
+# Point every upstream service neopo uses at the fixture server
+def use_fixtures(base_url):
+    import neopo.toolchain
+    import neopo.utility
+    import neopo.workbench
+
+    neopo.workbench.MARKETPLACE_QUERY = base_url + "/extensionquery"
+    neopo.workbench.PARTICLE_MANIFEST = base_url + "/particle-cli.json"
+    neopo.workbench.ARM_GCC_ARM = {}
+    neopo.utility.s3_bucket = base_url + "/s3/"
+    neopo.toolchain.DEVICE_OS_BINARIES = base_url + "/device-os/v%s.tar.gz"
+
+
+# Install the catalog of the fixtures, then serve it
+def serve(base_url, port):
+    use_fixtures(base_url)
+    import neopo.mirror
+    import neopo.workbench
+
+    neopo.workbench.install_or_update(True, False, True)
+    neopo.mirror.serve_command(["neopo", "serve", port, "127.0.0.1"])
+
+
+# Run a neopo command, reaching upstream only through NEOPO_MIRROR
+def client(base_url, args):
+    use_fixtures(base_url)
+    import neopo.command
+
+    neopo.command.main(["neopo"] + args)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def request(url, headers=None):
+    try:
+        with urllib.request.urlopen(
+            urllib.request.Request(url, headers=headers or {})
+        ) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as error:
+        return error.code, error.headers, b""
+
+
+# Path of a URL on the mirror
+def mirrored(url):
+    return "%s/http/%s" % (mirror, url[len("http://") :])
+
+
+# Paths of the archives the fixture server sent since the log had start entries
+def archives_sent(start):
+    return [
+        path
+        for path, code in fixtures.log[start:]
+        if path.endswith(".tar.gz") and code in (200, 206)
+    ]
+
+
+# Paths of the archives the mirror sent since its log had start bytes
+def archives_mirrored(log, start):
+    with open(log, "r") as file:
+        file.seek(start)
+        requests = re.findall(r'"GET (\S+) HTTP/[\d.]+" (\d+)', file.read())
+    return [
+        path
+        for path, code in requests
+        if path.endswith(".tar.gz") and code in ("200", "206")
+    ]
+
+
+def wait_for_mirror(server):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise AssertionError("The mirror exited with %d" % server.returncode)
+        try:
+            urllib.request.urlopen(mirror + "/catalog/manifest.json").close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise AssertionError("The mirror did not start in %d seconds" % STARTUP_TIMEOUT)
+
+
+# Run a client with its own NEOPO_PATH and artifact store
+def run_client(path, *args):
+    env = dict(
+        os.environ,
+        NEOPO_PATH=path,
+        NEOPO_STORE=path + "-store",
+        NEOPO_MIRROR=mirror,
+        PYTHONPATH=ROOT,
+    )
+    env.pop("NEOPO_LOCAL", None)
+    command = [sys.executable, __file__, "client", fixtures.base_url, *args]
+    subprocess.run(command, env=env, check=True)
+
+
+def test_mirror(workspace):
+    env = dict(
+        os.environ,
+        NEOPO_PATH=os.path.join(workspace, "mirror"),
+        NEOPO_STORE=os.path.join(workspace, "store"),
+        PYTHONPATH=ROOT,
+    )
+    env.pop("NEOPO_LOCAL", None)
+    env.pop("NEOPO_MIRROR", None)
+    command = [sys.executable, __file__, "serve", fixtures.base_url, str(port)]
+    # The mirror logs every request it answers to stderr
+    log = os.path.join(workspace, "mirror.log")
+    with open(log, "w") as stderr:
+        server = subprocess.Popen(command, env=env, stderr=stderr)
+    try:
+        wait_for_mirror(server)
+
+        # A client installs neopo with deviceOS and its toolchains through the mirror
+        start = len(fixtures.log)
+        first = os.path.join(workspace, "first")
+        run_client(first, "install")
+        run_client(first, "versions")
+        run_client(first, "particle", "--version")
+        sent = archives_sent(start)
+        assert sent, "The install did not reach upstream through the mirror"
+        assert len(sent) == len(set(sent)), "Archives fetched twice: %s" % sent
+        print("ok   install through the mirror (%d archives)" % len(sent))
+
+        # Another client gets the same archives from the store of the mirror
+        start, mirror_start = len(fixtures.log), os.path.getsize(log)
+        run_client(os.path.join(workspace, "second"), "install")
+        assert not archives_sent(start), "Fetched again: %s" % archives_sent(start)
+        served = set(archives_mirrored(log, mirror_start))
+        upstream = {mirrored(fixtures.base_url + path)[len(mirror) :] for path in sent}
+        assert served == upstream, "Not from the mirror: %s" % served
+        print("ok   second install served from the store")
+
+        # An archive the client already has is not sent again
+        deviceOS = fixtures.fixtures.url(
+            "toolchains/deviceOS-%s.tar.gz" % list(FIRMWARE)[0]
+        )
+        status, headers, _ = request(mirrored(deviceOS))
+        assert status == 200, status
+        status, _, _ = request(mirrored(deviceOS), {"If-None-Match": headers["ETag"]})
+        assert status == 304, status
+
+        # Nor is an unchanged catalog
+        status, headers, _ = request(mirror + "/catalog/manifest.json")
+        status, _, _ = request(
+            mirror + "/catalog/manifest.json", {"If-None-Match": headers["ETag"]}
+        )
+        assert status == 304, status
+
+        # Resources that can change upstream are revalidated with a conditional
+        # request, and an unchanged one is not downloaded again
+        manifest = mirrored(fixtures.base_url + "/particle-cli.json")
+        status, headers, content = request(manifest)
+        assert status == 200 and json.loads(content)["builds"], status
+        start = len(fixtures.log)
+        status, _, _ = request(manifest, {"If-None-Match": headers["ETag"]})
+        assert status == 304, status
+        upstream = fixtures.log[start:]
+        assert upstream == [("/particle-cli.json", 304)], upstream
+        print("ok   conditional requests answered with 304")
+
+        # A second run only revalidates the catalog
+        run_client(first, "update", "-s")
+        print("ok   update through the mirror")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if len(sys.argv) > 1 and sys.argv[1] == "serve":
+    serve(sys.argv[2], sys.argv[3])
+elif len(sys.argv) > 1 and sys.argv[1] == "client":
+    client(sys.argv[2], sys.argv[3:])
+else:
+    port = free_port()
+    mirror = "http://127.0.0.1:%d" % port
+    fixtures = FixtureServer(size=1024 * 1024).start()
+    try:
+        with tempfile.TemporaryDirectory(prefix="neopo-mirror-") as workspace:
+            test_mirror(workspace)
+    finally:
+        fixtures.stop()
@@ -0,0 +1,292 @@
+# Check that interrupted downloads resume correctly, against a local server that
+# drops, stalls and corrupts responses:
+#   python ci/test-resume.py
+import hashlib
+import http.server
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+
+# Run from a checkout without installing neopo
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# neopo reads its configuration when imported, so set it up first
+workspace = tempfile.TemporaryDirectory(prefix="neopo-resume-")
+os.environ["NEOPO_PATH"] = os.path.join(workspace.name, "neopo")
+os.environ["NEOPO_STORE"] = os.path.join(workspace.name, "store")
+os.environ["NEOPO_RETRIES"] = "3"
+os.environ.pop("NEOPO_MIRROR", None)
+
+import neopo.download
+from neopo.common import DOWNLOAD_DIR, DependencyError
+from neopo.download import JOURNAL_INTERVAL, fetch_artifact
+from neopo.store import find_artifact, remove_artifact
+
+# Archive served by the test server, large enough to be journaled partway
+CONTENT = os.urandom(3 * JOURNAL_INTERVAL // 2)
+SHA256 = hashlib.sha256(CONTENT).hexdigest()
+ETAG = '"%s"' % SHA256[:16]
+
+
+class ResumeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    # Clients hang up on purpose when they reject a download
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionResetError:
+            pass
+
+    def do_GET(self):
+        server = self.server
+        server.ranges.append(self.headers.get("Range"))
+        start, status = 0, 200
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match and server.honor_ranges:
+            start, status = int(match.group(1)), 206
+
+        content = CONTENT[start:]
+        if status == 206 and server.corrupt_resume:
+            content = bytes(byte ^ 0xFF for byte in content[:16]) + content[16:]
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", ETAG)
+        if status == 206:
+            self.send_header(
+                "Content-Range",
+                "bytes %d-%d/%d" % (start, len(CONTENT) - 1, len(CONTENT)),
+            )
+        self.end_headers()
+
+        # Drop or stall the response at an offset of the archive
+        drop = server.drops.pop(0) if server.drops else None
+        end = len(CONTENT) if drop is None else max(drop, start)
+        try:
+            self.wfile.write(content[: end - start])
+            self.wfile.flush()
+            server.sent += end - start
+            if drop is not None and server.stall:
+                server.released.wait()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        if drop is not None:
+            self.close_connection = True
+
+
+class ResumeServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), ResumeHandler)
+        self.url = "http://127.0.0.1:%d/archive.tar.gz" % self.server_address[1]
+        self.released = threading.Event()
+        self.reset()
+
+    # Behave normally again, forgetting the requests seen so far
+    def reset(self, drops=(), honor_ranges=True, stall=False, corrupt_resume=False):
+        self.released.clear()
+        self.drops = list(drops)
+        self.honor_ranges = honor_ranges
+        self.stall = stall
+        self.corrupt_resume = corrupt_resume
+        self.ranges = []
+        self.sent = 0
+
+
+def dependency(case):
+    # Each case downloads its own URL, so it gets its own .part file
+    url = "%s?case=%s" % (server.url, case)
+    return {"name": "fixture", "version": case, "url": url, "sha256": SHA256}
+
+
+def part_files():
+    if not os.path.isdir(DOWNLOAD_DIR):
+        return []
+    return sorted(name for name in os.listdir(DOWNLOAD_DIR) if ".part" in name)
+
+
+def journal(dep):
+    key = hashlib.sha256(dep["url"].encode("utf-8")).hexdigest()[:32]
+    with open(os.path.join(DOWNLOAD_DIR, key + ".json"), "r") as file:
+        return json.load(file)
+
+
+# Download with no retries, so a dropped connection interrupts the download
+def interrupted_fetch(dep):
+    neopo.download.NEOPO_RETRIES = 0
+    try:
+        fetch_artifact(dep)
+        raise AssertionError("Download was not interrupted")
+    except urllib.error.URLError:
+        pass
+    finally:
+        neopo.download.NEOPO_RETRIES = 3
+
+
+def check_stored():
+    artifact = find_artifact(SHA256)
+    assert artifact, "Archive was not stored"
+    with open(artifact, "rb") as file:
+        assert hashlib.sha256(file.read()).hexdigest() == SHA256
+    assert not part_files(), "Left behind %s" % part_files()
+    remove_artifact(SHA256)
+
+
+# A dropped connection is resumed with a Range request for the rest
+def test_range_resume():
+    drop = len(CONTENT) // 3
+    server.reset(drops=[drop])
+    fetch_artifact(dependency("range"))
+    assert server.ranges == [None, "bytes=%d-" % drop], server.ranges
+    assert server.sent == len(CONTENT), "Downloaded %d bytes" % server.sent
+    check_stored()
+
+
+# A server that ignores Range and answers 200 gets the whole archive again
+def test_full_download_fallback():
+    dep = dependency("fallback")
+    drop = len(CONTENT) // 2
+    server.reset(drops=[drop])
+    interrupted_fetch(dep)
+    assert journal(dep)["bytes"] == drop
+
+    server.reset(honor_ranges=False)
+    fetch_artifact(dep)
+    assert server.ranges == ["bytes=%d-" % drop], server.ranges
+    assert server.sent == len(CONTENT)
+    check_stored()
+
+
+# Start another neopo process downloading dep, which stalls once it journaled
+# part of the download
+def stalled_process(dep):
+    server.reset(drops=[len(CONTENT) - 1024], stall=True)
+    code = "import json, sys; from neopo.download import fetch_artifact; "
+    code += "fetch_artifact(json.loads(sys.argv[1]))"
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    child = subprocess.Popen([sys.executable, "-c", code, json.dumps(dep)], env=env)
+    for _ in range(200):
+        try:
+            if journal(dep)["bytes"]:
+                return child
+        except (OSError, ValueError, KeyError):
+            pass
+        time.sleep(0.05)
+    child.kill()
+    child.wait()
+    raise AssertionError("The download was never journaled")
+
+
+def stop_process(child):
+    child.kill()
+    child.wait()
+    server.released.set()
+
+
+# A neopo process killed mid-download leaves its .part file and journal behind,
+# and the next process replays them and only downloads the rest
+def test_restart_replay():
+    dep = dependency("restart")
+    stop_process(stalled_process(dep))
+    journaled = journal(dep)["bytes"]
+    assert journaled == JOURNAL_INTERVAL, journaled
+
+    server.reset()
+    fetch_artifact(dep)
+    assert server.ranges == ["bytes=%d-" % journaled], server.ranges
+    assert server.sent == len(CONTENT) - journaled
+    check_stored()
+
+
+# A process downloading the URL another process is downloading uses a .part file
+# of its own, and deletes it when done
+def test_concurrent_processes():
+    dep = dependency("concurrent")
+    child = stalled_process(dep)
+    try:
+        journaled = journal(dep)["bytes"]
+        parts = part_files()
+        server.reset()
+        fetch_artifact(dep)
+        assert server.ranges == [None], server.ranges
+        assert journal(dep)["bytes"] == journaled
+        assert part_files() == parts, part_files()
+    finally:
+        stop_process(child)
+    remove_artifact(SHA256)
+
+    # The .part file of the other process was left alone
+    server.reset()
+    fetch_artifact(dep)
+    assert server.ranges == ["bytes=%d-" % journaled], server.ranges
+    check_stored()
+
+
+# A resume that does not hash to the expected sha256 is rejected: either the
+# .part file was damaged on disk, or the server sent different bytes
+def test_corrupt_resume():
+    dep = dependency("corrupt-part")
+    server.reset(drops=[len(CONTENT) // 2])
+    interrupted_fetch(dep)
+    part = os.path.join(DOWNLOAD_DIR, part_files()[0])
+    with open(part, "r+b") as file:
+        file.seek(1000)
+        byte = file.read(1)
+        file.seek(1000)
+        file.write(bytes([byte[0] ^ 0xFF]))
+    server.reset()
+    try:
+        fetch_artifact(dep)
+        raise AssertionError("Damaged .part file was accepted")
+    except DependencyError as error:
+        assert "corrupt" in str(error), error
+    assert not find_artifact(SHA256)
+    assert not part_files(), "Damaged .part file was kept"
+
+    dep = dependency("corrupt-network")
+    server.reset(drops=[len(CONTENT) // 2], corrupt_resume=True)
+    try:
+        fetch_artifact(dep)
+        raise AssertionError("Corrupt resume was accepted")
+    except DependencyError as error:
+        assert "SHA256 mismatch" in str(error), error
+    assert not find_artifact(SHA256), "Corrupt archive was stored"
+    assert not part_files()
+
+    # Nothing of the corrupt downloads is reused
+    server.reset()
+    fetch_artifact(dep)
+    assert server.ranges == [None]
+    check_stored()
+
+
+server = ResumeServer()
+threading.Thread(target=server.serve_forever, daemon=True).start()
+tests = [
+    test_range_resume,
+    test_full_download_fallback,
+    test_restart_replay,
+    test_concurrent_processes,
+    test_corrupt_resume,
+]
+try:
+    for test in tests:
+        test()
+        print("ok   %s" % test.__name__)
+finally:
+    server.released.set()
+    server.shutdown()
+    server.server_close()
+    workspace.cleanup()
@@ -0,0 +1,176 @@
+# Check neopo workspace on stub projects, without a toolchain:
+#   python ci/test-workspace.py
+# Builds are run by the make on PATH, which must be GNU make 4 for the jobserver
+import io
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+
+# Run from a checkout without installing neopo
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# neopo reads its configuration when imported, so set it up first
+workspace = tempfile.TemporaryDirectory(prefix="neopo-workspace-")
+os.environ["NEOPO_PATH"] = os.path.join(workspace.name, "neopo")
+
+import neopo.workspace
+from neopo.common import ProjectError
+from neopo.daemon import ThreadOutput
+from neopo.workspace import (
+    Jobserver,
+    PrefixedOutput,
+    build_workspace,
+    find_projects,
+    run_make,
+)
+
+# Jobs of the stub projects, and how many of them the workspace may run at once
+JOBS_PER_PROJECT = 4
+BUDGET = 3
+
+# Recipe that records how many jobs of the workspace are running with it
+RECIPE = """
+\ttouch %(running)s/$@-$(NAME)
+\tls %(running)s | wc -l >> %(counts)s
+\tsleep 0.3
+\trm %(running)s/$@-$(NAME)
+"""
+
+
+# Write a stub project, with a Makefile of jobs that only sleep
+def stub_project(path):
+    os.makedirs(path)
+    with open(os.path.join(path, "project.properties"), "w") as file:
+        file.write("name=%s\n" % os.path.basename(path))
+    targets = ["job%d" % job for job in range(JOBS_PER_PROJECT)]
+    paths = {
+        "running": os.path.join(workspace.name, "running"),
+        "counts": os.path.join(workspace.name, "counts"),
+    }
+    with open(os.path.join(path, "Makefile"), "w") as file:
+        file.write("all: %s\n" % " ".join(targets))
+        for target in targets:
+            file.write("%s:%s" % (target, RECIPE % paths))
+
+
+# Projects are found below the root, but not inside other projects or hidden
+# directories
+def test_discovery():
+    root = os.path.join(workspace.name, "root")
+    for name in ["app", "group/sensor", "group/gateway"]:
+        stub_project(os.path.join(root, name))
+    stub_project(os.path.join(root, "app", "lib", "vendored"))
+    stub_project(os.path.join(root, ".cache", "copy"))
+    projects = [os.path.relpath(path, root) for path in find_projects(root)]
+    expected = [
+        "app",
+        os.path.join("group", "gateway"),
+        os.path.join("group", "sensor"),
+    ]
+    assert projects == expected, projects
+
+
+# Output is written in whole lines, each prefixed with its project, however the
+# writes of several projects interleave
+def test_prefixed_output():
+    stream = io.StringIO()
+    lock = threading.Lock()
+    first = PrefixedOutput("first", stream, lock)
+    second = PrefixedOutput("second", stream, lock)
+    first.write("compil")
+    second.write("link")
+    first.write("ing main.cpp\nwarn")
+    second.write("ing firmware.elf\n")
+    first.write("ing: unused")
+    first.close()
+    second.close()
+    lines = stream.getvalue().splitlines()
+    assert lines == [
+        "[first] compiling main.cpp",
+        "[second] linking firmware.elf",
+        "[first] warning: unused",
+    ], lines
+
+
+# The makes of every project together run no more jobs than the jobserver has
+# tokens, and every token is returned
+def test_shared_budget():
+    version = subprocess.run(["make", "--version"], capture_output=True, text=True)
+    match = re.match(r"GNU Make (\d+)", version.stdout)
+    if not match or int(match.group(1)) < 4:
+        print("skip test_shared_budget: needs GNU make 4")
+        return
+    os.makedirs(os.path.join(workspace.name, "running"))
+    root = os.path.join(workspace.name, "root")
+    projects = find_projects(root)
+
+    jobserver = Jobserver(BUDGET)
+    environ = dict(os.environ, MAKEFLAGS=jobserver.makeflags())
+    stream = io.StringIO()
+    lock = threading.Lock()
+    stopped = threading.Event()
+    statuses = []
+
+    def build(project):
+        process = ["make", "-C", project, "NAME=%s" % os.path.basename(project)]
+        output = PrefixedOutput(os.path.basename(project), stream, lock)
+        statuses.append(run_make(process, environ, output, jobserver, stopped))
+
+    threads = [threading.Thread(target=build, args=(path,)) for path in projects]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert statuses == [0] * len(projects), stream.getvalue()
+    with open(os.path.join(workspace.name, "counts")) as file:
+        counts = [int(line) for line in file]
+    assert len(counts) == JOBS_PER_PROJECT * len(projects), counts
+    assert max(counts) <= BUDGET, counts
+    assert max(counts) > 1, "The builds did not run in parallel"
+    os.set_blocking(jobserver.fds[0], False)
+    tokens = os.read(jobserver.fds[0], BUDGET + 1)
+    assert len(tokens) == BUDGET, tokens
+    jobserver.close()
+
+
+# A ^C while the projects are still being resolved reports the projects that
+# were not built instead of ending in a traceback
+def test_interrupted_resolution():
+    root = os.path.join(workspace.name, "root")
+    projects = find_projects(root)
+    names = {project: os.path.relpath(project, root) for project in projects}
+
+    def resolve_project(project_path, toolchains):
+        if project_path == projects[0]:
+            raise ProjectError("Firmware related error!")
+        raise KeyboardInterrupt
+
+    stdout = io.StringIO()
+    resolve, saved = neopo.workspace.resolve_project, sys.stdout
+    neopo.workspace.resolve_project = resolve_project
+    sys.stdout = ThreadOutput(stdout)
+    try:
+        results = build_workspace(projects, names, "all", stdout, threading.Lock())
+    finally:
+        neopo.workspace.resolve_project, sys.stdout = resolve, saved
+    assert results == {projects[0]: ("failed", 0)}, results
+    assert "Stopping the builds of the workspace..." in stdout.getvalue()
+
+
+tests = [
+    test_discovery,
+    test_prefixed_output,
+    test_shared_budget,
+    test_interrupted_resolution,
+]
+try:
+    for test in tests:
+        test()
+        print("ok   %s" % test.__name__)
+finally:
+    workspace.cleanup()
@@ -14,14 +14,19 @@ from .common import (
     projectFiles,
     running_on_windows,
 )
+from .compilercache import use_compiler_cache
+from .daemonclient import daemon_build
+from .jobs import make_jobs, outer_jobserver, parallel_make
+from .lockfile import LOCKED_DEPS, has_lockfile, load_lockfile
 from .manifest import get_manifest_value, load_manifest
-from .project import check_libraries, get_flags, get_settings
+from .project import check_libraries, get_flags, get_settings, lock_project
 from .toolchain import (
     check_firmware_version,
     get_compiler,
     get_firmware_path,
     platform_convert,
 )
+from .usage import record_usage
 from .utility import write_executable
 
 
@@ -34,6 +39,13 @@ def export_build_process(project_path, process, environment, target):
     tools = environment["PATH"].split(os.pathsep)[:-3:-1]
     path_line = 'PATH="$PATH:%s"\n' % os.pathsep.join(tools)
 
+    # Keep the jobs of the build, letting the environment of the script override them
+    # (a jobserver of the make neopo ran under is gone when the script runs)
+    jobs = '-j"${NEOPO_MAKE_JOBS:-%d}"' % make_jobs(environment)
+    process = [jobs if arg.startswith("-j") else arg for arg in process]
+    if jobs not in process:
+        process.insert(3, jobs)
+
     # Format make line better
     temp = [" ".join(process[:3])]
     temp.extend(process[3:])
@@ -85,6 +97,7 @@ def build_bootloader(platform, firmware_version, verbosity=1):
     add_to_path(
         temp_env, os.path.join(PARTICLE_DEPS, "gcc-arm", compiler_version, "bin")
     )
+    record_usage({"buildtools": tools_version, "gcc-arm": compiler_version})
 
     device_os_path = os.path.join(PARTICLE_DEPS, "deviceOS", firmware_version)
     bootloader = os.path.join(device_os_path, "bootloader")
@@ -102,7 +115,7 @@ def build_bootloader(platform, firmware_version, verbosity=1):
             stdout=subprocess.PIPE if verbosity == -1 else None,
             stderr=subprocess.PIPE if verbosity == -1 else None,
         )
-    except subprocess.CalledProcessError as error:
+    except subprocess.CalledProcessError:
         pass
     finally:
         os.chdir(OLDPWD)
@@ -124,10 +137,23 @@ def build_bootloader(platform, firmware_version, verbosity=1):
         raise ProcessError("%s was not built!" % target)
 
 
-# Use the Makefile to build the specified target
-def build_project(project_path, command, help_only, verbosity, export=False):
-    compiler_version, script_version, tools_version, firmware_version = load_manifest()
-    temp_env = min_particle_env()
+# Resolve the make process for a target of the Workbench Makefile
+# lock is a resolution to trust instead of the project's lockfile, and environ the
+# environment to build in (that of this process by default)
+# Returns (process, environment, resolution of the project)
+def build_process(project_path, command, help_only, verbosity, lock=None, environ=None):
+    # A project with an up to date lockfile skips resolving its toolchain and libraries
+    if not lock and not help_only:
+        lock = load_lockfile(project_path)
+    if lock:
+        compiler_version, script_version, tools_version, firmware_version = (
+            lock["toolchain"][name] for name in LOCKED_DEPS
+        )
+    else:
+        compiler_version, script_version, tools_version, firmware_version = (
+            load_manifest()
+        )
+    temp_env = min_particle_env(environ)
     add_build_tools(temp_env, tools_version)
 
     # Windows compatibility modifications
@@ -149,8 +175,14 @@ def build_project(project_path, command, help_only, verbosity, export=False):
     if verbosity == 0:
         process[process.index("-f")] = "-sf"
 
+    # Build in parallel, or with the jobs an outer make gives
+    parallel_make(process, temp_env)
+
     if help_only:
         process.append("help")
+    elif lock:
+        device_platform = lock["platform"]
+        extra_compiler_flags = lock["EXTRA_CFLAGS"]
     else:
         try:
             device_platform, firmware_version = get_settings(project_path)
@@ -161,6 +193,9 @@ def build_project(project_path, command, help_only, verbosity, export=False):
 
             if not check_libraries(project_path, False):
                 print("To install libraries run: $ neopo libs [project]")
+            elif has_lockfile(project_path):
+                # Pin the new resolution so the next build takes the fast path
+                lock_project(project_path)
 
         except (FileNotFoundError, KeyError) as error:
             if os.path.isfile(os.path.join(project_path, projectFiles["properties"])):
@@ -171,21 +206,45 @@ def build_project(project_path, command, help_only, verbosity, export=False):
                 raise UserError(
                     "%s is not a Particle project!" % project_path
                 ) from error
+        extra_compiler_flags = get_flags(project_path)
 
-        # Add compiler to path
-        add_to_path(
-            temp_env, os.path.join(PARTICLE_DEPS, "gcc-arm", compiler_version, "bin")
+    if not help_only:
+        # Add compiler to path, behind the compiler cache if it is enabled
+        compiler_path = os.path.join(PARTICLE_DEPS, "gcc-arm", compiler_version, "bin")
+        add_to_path(temp_env, compiler_path)
+        use_compiler_cache(
+            temp_env, compiler_version, compiler_path, extra_compiler_flags
         )
 
         # Set additional variables for make
         device_os_path = get_firmware_path(firmware_version)
-        extra_compiler_flags = get_flags(project_path)
         process.append("APPDIR=%s" % project_path)
         process.append("DEVICE_OS_PATH=%s" % device_os_path)
         process.append("PLATFORM=%s" % device_platform)
         process.append("EXTRA_CFLAGS=%s" % extra_compiler_flags)
         process.append(command)
 
+        resolution = {
+            "platform": device_platform,
+            "toolchain": {
+                "gcc-arm": compiler_version,
+                "buildscripts": script_version,
+                "buildtools": tools_version,
+                "deviceOS": firmware_version,
+            },
+            "EXTRA_CFLAGS": extra_compiler_flags,
+        }
+        # Remember the toolchain of this build for neopo gc, in a single write
+        record_usage(resolution["toolchain"])
+    else:
+        resolution = None
+    return process, temp_env, resolution
+
+
+# Use the Makefile to build the specified target
+def build_project(project_path, command, help_only, verbosity, export=False):
+    process, temp_env, _ = build_process(project_path, command, help_only, verbosity)
+
     # Export the build process to a shell script
     if export and not help_only:
         export_build_process(project_path, process, temp_env, command)
@@ -200,6 +259,7 @@ def build_project(project_path, command, help_only, verbosity, export=False):
             check=True,
             stdout=subprocess.PIPE if verbosity == -1 else None,
             stderr=subprocess.PIPE if verbosity == -1 else None,
+            pass_fds=outer_jobserver(temp_env) or (),
         )
     except subprocess.CalledProcessError as error:
         raise ProcessError("\n*** %s FAILED ***\n" % command.upper()) from error
@@ -233,6 +293,9 @@ def build_command(command, index, args, export=False):
         raise UserError("Invalid verbosity!") from error
 
     # Build the given project with a command and verbosity
+    # A running neopo daemon builds it, unless it is exported
+    if not export and daemon_build(project, command, verbosity):
+        return
     build_project(project, command, False, verbosity, export)
 
 
@@ -0,0 +1,317 @@
+import concurrent.futures
+import io
+import json
+import os
+import pathlib
+import platform
+import shutil
+import tarfile
+import tempfile
+import urllib.error
+
+# Local imports
+from .common import (
+    CACHE_DIR,
+    DOWNLOAD_DIR,
+    NEOPO_DEPS,
+    NEOPO_JOBS,
+    STORE_LIMIT,
+    DependencyError,
+    UserError,
+    jsonFiles,
+    particle_cli,
+    vscodeFiles,
+)
+from .download import CHUNK_SIZE, HashingReader, fetch_artifact
+from .manifest import create_manifest, get_cached_json
+from .store import find_artifact, format_size, store_artifact
+from .toolchain import (
+    download_firmware,
+    get_dep_data,
+    get_firmware_data,
+    get_firmware_deps,
+)
+from .utility import handle_missing_file, write_executable, write_file
+from .workbench import (
+    CATALOG_KEYS,
+    install_selected_deps,
+    select_deps,
+    write_json_caches,
+)
+
+# Version of the bundle layout
+BUNDLE_FORMAT = 1
+
+# Catalogs that list toolchains per system
+TOOLCHAIN_KEYS = ["compilers", "tools", "scripts", "debuggers"]
+
+
+# Find every dependency needed to install neopo and the given deviceOS versions
+def bundle_deps(data, versions):
+    deps = select_deps(data)
+    for version in versions:
+        firmware = get_firmware_data(version)
+        if not firmware:
+            raise UserError("Invalid deviceOS version %s!" % version)
+        deps.append(firmware)
+        for dep, dep_version in get_firmware_deps(version).items():
+            deps.append(get_dep_data(dep, dep_version))
+
+    # Several versions usually share toolchains
+    unique = {}
+    for dep in deps:
+        unique.setdefault((dep["name"], dep["version"]), dep)
+    return list(unique.values())
+
+
+# Reduce the JSON caches to the entries of the bundled dependencies
+def slice_catalog(data, deps):
+    bundled = {(dep["name"], dep["version"]) for dep in deps}
+    firmware = [
+        "deviceOS@%s" % version for name, version in bundled if name == "deviceOS"
+    ]
+    system = platform.system().lower()
+
+    catalog = {
+        "platforms": data["platforms"],
+        "firmware": [
+            entry
+            for entry in data["firmware"]
+            if ("deviceOS", entry["version"]) in bundled
+        ],
+        "toolchains": [
+            entry for entry in data["toolchains"] if entry["firmware"] in firmware
+        ],
+    }
+    for key in TOOLCHAIN_KEYS:
+        section = data[key][system]["x64"]
+        catalog[key] = {
+            system: {
+                "x64": [
+                    entry
+                    for entry in section
+                    if (entry["name"], entry["version"]) in bundled
+                ]
+            }
+        }
+    return catalog
+
+
+# Add an in-memory file to a tar archive
+def add_bytes(tar, name, content, mode=0o644):
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    info.mode = mode
+    tar.addfile(info, io.BytesIO(content))
+
+
+# Write a bundle with the catalog, toolchain archives, particle binary, and
+# vscode templates needed to install neopo and versions without a network
+def export_bundle(path, versions):
+    data = {key: get_cached_json(key) for key in CATALOG_KEYS}
+    if None in data.values():
+        raise DependencyError("The JSON caches are corrupt! Please run `neopo update`.")
+    for file in [particle_cli, vscodeFiles["launch"], vscodeFiles["settings"]]:
+        if not os.path.isfile(file):
+            handle_missing_file(file)
+
+    deps = bundle_deps(data, versions)
+
+    # Download any archives that are not already in the store
+    print("Collecting %d dependency archives..." % len(deps))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=NEOPO_JOBS) as executor:
+        jobs = {dep["sha256"]: executor.submit(fetch_artifact, dep) for dep in deps}
+        try:
+            artifacts = {sha256: job.result() for sha256, job in jobs.items()}
+        except urllib.error.URLError as error:
+            raise DependencyError("Failed to download dependency archives!") from error
+
+    info = {
+        "format": BUNDLE_FORMAT,
+        "system": platform.system().lower(),
+        "machine": platform.machine(),
+        "versions": versions,
+        "deps": deps,
+        "size": sum(os.path.getsize(artifact) for artifact in artifacts.values()),
+    }
+
+    # Write to a temporary file so an interrupted export leaves no partial bundle
+    temp = path + ".tmp"
+    try:
+        with tarfile.open(temp, "w") as tar:
+            add_bytes(tar, "bundle.json", json.dumps(info, indent=4).encode("utf-8"))
+            for key, content in slice_catalog(data, deps).items():
+                add_bytes(
+                    tar, "catalog/%s.json" % key, json.dumps(content).encode("utf-8")
+                )
+            tar.add(particle_cli, arcname=os.path.basename(particle_cli))
+            tar.add(vscodeFiles["launch"], arcname="vscode/launch.json")
+            tar.add(vscodeFiles["settings"], arcname="vscode/settings.json")
+            for sha256, artifact in artifacts.items():
+                tar.add(artifact, arcname="archives/%s.tar.gz" % sha256)
+        os.replace(temp, path)
+    except BaseException:
+        if os.path.isfile(temp):
+            os.remove(temp)
+        raise
+
+    print("Exported %s (%s)." % (path, format_size(os.path.getsize(path))))
+
+
+# Refuse bundles that were made for another platform
+def check_bundle(info):
+    if info.get("format") != BUNDLE_FORMAT:
+        raise DependencyError("Unsupported bundle format!")
+    system, machine = platform.system().lower(), platform.machine()
+    if (info["system"], info["machine"]) != (system, machine):
+        raise DependencyError(
+            "This bundle is for %s/%s, not %s/%s!"
+            % (info["system"], info["machine"], system, machine)
+        )
+
+    # Archives are staged in the store, which must not evict them before they are installed
+    if info["size"] > STORE_LIMIT:
+        raise DependencyError(
+            "The bundle needs %s in the store! Please raise NEOPO_STORE_SIZE."
+            % format_size(info["size"])
+        )
+
+
+# Identity of an entry of a catalog, which a merged catalog lists only once
+def entry_key(key, entry):
+    if key == "firmware":
+        return entry["version"]
+    if key == "platforms":
+        return entry["id"]
+    if key == "toolchains":
+        return entry["firmware"]
+    return (entry["name"], entry["version"])
+
+
+# Append the imported entries of a catalog that are not already in entries
+def merge_entries(key, entries, imported):
+    known = {entry_key(key, entry) for entry in entries}
+    return entries + [entry for entry in imported if entry_key(key, entry) not in known]
+
+
+# Add the catalog of a bundle to the JSON caches of this host, if it has any
+# The bundle only has the entries of its dependencies, which must not replace the
+# rest of the catalog
+def merge_catalog(catalog):
+    merged = {}
+    for key in CATALOG_KEYS:
+        existing = get_cached_json(key) if os.path.isfile(jsonFiles[key]) else None
+        if existing is None:
+            merged[key] = catalog[key]
+        elif key in TOOLCHAIN_KEYS:
+            for system, sections in catalog[key].items():
+                for arch, entries in sections.items():
+                    section = existing.setdefault(system, {}).setdefault(arch, [])
+                    section[:] = merge_entries(key, section, entries)
+            merged[key] = existing
+        else:
+            merged[key] = merge_entries(key, existing, catalog[key])
+    return merged
+
+
+# Copy an archive out of the bundle into the artifact store, verifying its sha256
+def import_artifact(source, sha256, dep):
+    pathlib.Path(DOWNLOAD_DIR).mkdir(parents=True, exist_ok=True)
+    handle, temp = tempfile.mkstemp(dir=DOWNLOAD_DIR, suffix=".bundle")
+    try:
+        reader = HashingReader(source)
+        with os.fdopen(handle, "wb") as file:
+            shutil.copyfileobj(reader, file, CHUNK_SIZE)
+        if reader.hexdigest() != sha256:
+            raise DependencyError("Archive %s in bundle is corrupt!" % sha256)
+        store_artifact(temp, sha256, dep)
+    finally:
+        if os.path.isfile(temp):
+            os.remove(temp)
+
+
+# Install neopo and the deviceOS versions of a bundle without using the network
+# The bundle is read in one pass, with archives going through the artifact store
+def import_bundle(path):
+    try:
+        tar = tarfile.open(path, "r|")
+    except (OSError, tarfile.TarError) as error:
+        raise UserError("Could not open bundle %s!" % path) from error
+
+    info = None
+    catalog = {}
+    files = {}
+    try:
+        with tar:
+            for member in tar:
+                if member.name == "bundle.json":
+                    info = json.load(tar.extractfile(member))
+                    check_bundle(info)
+                    deps = {dep["sha256"]: dep for dep in info["deps"]}
+                    continue
+                if info is None:
+                    raise DependencyError("Invalid bundle %s!" % path)
+                if not member.isfile():
+                    continue
+
+                directory, name = os.path.split(member.name)
+                if directory == "archives":
+                    sha256 = name.split(".")[0]
+                    if sha256 in deps and not find_artifact(sha256):
+                        print(
+                            "Importing %s@%s..."
+                            % (deps[sha256]["name"], deps[sha256]["version"])
+                        )
+                        import_artifact(tar.extractfile(member), sha256, deps[sha256])
+                elif directory == "catalog":
+                    key = name[: -len(".json")]
+                    if key in CATALOG_KEYS:
+                        catalog[key] = json.load(tar.extractfile(member))
+                elif member.name in ("vscode/launch.json", "vscode/settings.json"):
+                    files[vscodeFiles[name[: -len(".json")]]] = tar.extractfile(
+                        member
+                    ).read()
+                elif member.name == os.path.basename(particle_cli):
+                    files[particle_cli] = tar.extractfile(member).read()
+    except (OSError, ValueError, tarfile.TarError) as error:
+        # A truncated or damaged bundle fails partway through
+        raise UserError("Could not read bundle %s!" % path) from error
+
+    if info is None or len(catalog) != len(CATALOG_KEYS):
+        raise DependencyError("Invalid bundle %s!" % path)
+
+    # Put the catalog, particle binary, and templates where install_or_update would
+    pathlib.Path(CACHE_DIR).mkdir(parents=True, exist_ok=True)
+    pathlib.Path(vscodeFiles["dir"]).mkdir(parents=True, exist_ok=True)
+    pathlib.Path(NEOPO_DEPS).mkdir(parents=True, exist_ok=True)
+    for file, content in files.items():
+        if file == particle_cli:
+            write_executable(content, file)
+        else:
+            write_file(content, file, "wb")
+    write_json_caches(merge_catalog(catalog), CATALOG_KEYS)
+    create_manifest()
+
+    # Every archive is now in the store, so the usual install path stays offline
+    # (the bundle's own catalog selects the dependencies it has archives for)
+    print("Installing neopo from bundle...")
+    install_selected_deps(select_deps(catalog), True, False, False)
+    for version in info["versions"]:
+        download_firmware(version)
+    print("Imported %s." % path)
+
+
+# Wrapper for [bundle]
+def bundle_command(args):
+    try:
+        action, path = args[2], args[3]
+    except IndexError as error:
+        raise UserError(
+            "Usage:\n\t$ neopo bundle export <file> [versions...]\n\t$ neopo bundle import <file>"
+        ) from error
+    if action == "export":
+        export_bundle(path, args[4:])
+    elif action == "import":
+        import_bundle(path)
+    else:
+        raise UserError("Invalid command! Commands are: export, import")
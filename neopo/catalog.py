@@ -0,0 +1,199 @@
+import json
+import marshal
+import os
+import platform
+import sys
+import threading
+
+# Local imports
+from .common import CACHE_DIR, jsonFiles
+
+# Catalogs of toolchain dependencies, by the name of the dependencies they list
+DEP_CATALOGS = {
+    "gcc-arm": "compilers",
+    "buildtools": "tools",
+    "buildscripts": "scripts",
+    "openocd": "debuggers",
+}
+
+# Precompiled catalog written by neopo update, read instead of the JSON caches
+CATALOG_SNAPSHOT = os.path.join(CACHE_DIR, "catalog.marshal")
+
+# Bump when the layout of the precompiled catalog changes
+SNAPSHOT_FORMAT = 1
+
+# JSON caches that are kept whole in the precompiled catalog (the others are
+# only looked up through their indexes)
+SNAPSHOT_DATA = ["firmware", "platforms"]
+
+
+# Index a list of catalog entries by one of their fields
+def index_by(field):
+    return lambda data: {entry[field]: entry for entry in data}
+
+
+# Index a toolchain dependency catalog by (version, system), first entry first
+def index_deps(data):
+    deps = {}
+    for system, architectures in data.items():
+        for entry in architectures.get("x64", []):
+            deps.setdefault((entry["version"], system), entry)
+    return deps
+
+
+# Indexes of the catalog: {name: (JSON cache indexed, function building the index)}
+INDEXES = {
+    "platform:id": ("platforms", index_by("id")),
+    "platform:name": ("platforms", index_by("name")),
+    "firmware": ("firmware", index_by("version")),
+    "toolchain": ("toolchains", index_by("firmware")),
+}
+INDEXES.update({"dep:%s" % key: (key, index_deps) for key in DEP_CATALOGS.values()})
+
+
+# Modification time and size of every JSON cache the catalog is built from
+def source_stamps():
+    keys = sorted(set(key for key, _ in INDEXES.values()))
+    stamps = {}
+    for key in keys:
+        stat = os.stat(jsonFiles[key])
+        stamps[key] = (stat.st_mtime_ns, stat.st_size)
+    return stamps
+
+
+# Header identifying what a precompiled catalog was built from
+def snapshot_header():
+    return {
+        "format": SNAPSHOT_FORMAT,
+        "python": tuple(sys.version_info[:2]),
+        "system": platform.system().lower(),
+        "sources": source_stamps(),
+    }
+
+
+# Write the precompiled catalog from the data just written to the JSON caches
+def save_snapshot(data):
+    system = platform.system().lower()
+    indexes = {}
+    for name, (key, build) in INDEXES.items():
+        index = build(data[key])
+        if build is index_deps:
+            # Dependencies for other operating systems are never looked up
+            index = {item: entry for item, entry in index.items() if item[1] == system}
+        indexes[name] = index
+
+    temp = "%s.%d.tmp" % (CATALOG_SNAPSHOT, os.getpid())
+    try:
+        with open(temp, "wb") as file:
+            marshal.dump(snapshot_header(), file)
+            marshal.dump({key: data[key] for key in SNAPSHOT_DATA}, file)
+            marshal.dump(indexes, file)
+        os.replace(temp, CATALOG_SNAPSHOT)
+    except OSError:
+        # The JSON caches are enough, only slower to load
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+# Read the precompiled catalog: (data, indexes)
+# Returns None if there is none or the JSON caches changed since it was written
+def load_snapshot():
+    try:
+        with open(CATALOG_SNAPSHOT, "rb") as file:
+            if marshal.load(file) != snapshot_header():
+                return None
+            return marshal.load(file), marshal.load(file)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+# The dependency catalog in the JSON caches, loaded once per process
+# Each cache is parsed the first time it is needed and indexed for lookups,
+# unless the precompiled catalog written by neopo update is up to date
+# Entries are shared, so lookups that return dependencies return copies
+class Catalog:
+    def __init__(self):
+        self.data = {}
+        self.indexes = {}
+        self.restored = False
+        self.stamps = None
+        self.lock = threading.Lock()
+
+    # Start from the precompiled catalog, once (called with the lock held)
+    def restore(self):
+        if self.restored:
+            return
+        self.restored = True
+        snapshot = load_snapshot()
+        if snapshot:
+            data, indexes = snapshot
+            self.data.update(data)
+            self.indexes.update(indexes)
+
+    # Parsed contents of a JSON cache
+    def load(self, key):
+        with self.lock:
+            self.restore()
+            if key not in self.data:
+                with open(jsonFiles[key], "r") as file:
+                    self.data[key] = json.load(file)
+            return self.data[key]
+
+    # An index of the catalog (see INDEXES), built once
+    def index(self, name):
+        with self.lock:
+            self.restore()
+            if name in self.indexes:
+                return self.indexes[name]
+        key, build = INDEXES[name]
+        data = self.load(key)
+        with self.lock:
+            if name not in self.indexes:
+                self.indexes[name] = build(data)
+            return self.indexes[name]
+
+    # Forget caches that were rewritten (all of them by default)
+    def invalidate(self, keys=None):
+        with self.lock:
+            for key in list(self.data) if keys is None else keys:
+                self.data.pop(key, None)
+            self.indexes.clear()
+            self.restored = False
+
+    # Forget everything if the JSON caches changed since the last check
+    # For processes that outlive a neopo update, like neopo daemon
+    def refresh(self):
+        try:
+            stamps = source_stamps()
+        except OSError:
+            stamps = None
+        with self.lock:
+            changed = stamps != self.stamps
+            self.stamps = stamps
+        if changed:
+            self.invalidate()
+
+    # Platform whose key ("id" or "name") has a value, or None
+    def platform(self, key, value):
+        return self.index("platform:%s" % key).get(value)
+
+    # Listed deviceOS releases, latest first
+    def firmware_releases(self):
+        return self.load("firmware")
+
+    # Listed deviceOS release with a version, or None
+    def firmware(self, version):
+        entry = self.index("firmware").get(version)
+        return dict(entry) if entry else None
+
+    # Toolchain (compiler, tools, scripts, debugger, platforms) of a listed release
+    def toolchain(self, version):
+        return self.index("toolchain").get("deviceOS@%s" % version)
+
+    # Dependency with a name and version for an operating system, or None
+    def dep(self, name, version, system):
+        entry = self.index("dep:%s" % DEP_CATALOGS[name]).get((version, system))
+        return dict(entry) if entry else None
+
+
+catalog = Catalog()
@@ -0,0 +1,313 @@
+# Compiler wrapper that caches the objects arm-none-eabi-gcc compiles
+# neopo puts shims in front of the compiler that run this file as a script:
+#   python3 -S ccwrapper.py <compiler> [arguments...]
+# so it only uses the standard library and imports nothing from neopo
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Change to invalidate every cached object
+CACHE_VERSION = "1"
+
+# Sources the cache handles (others are compiled without it)
+SOURCE_EXTENSIONS = [".c", ".cc", ".cp", ".cpp", ".cxx", ".c++", ".C", ".S", ".sx"]
+
+# Options whose value is the next argument
+VALUE_OPTIONS = [
+    "-o",
+    "-MF",
+    "-MT",
+    "-MQ",
+    "-I",
+    "-D",
+    "-U",
+    "-x",
+    "-include",
+    "-imacros",
+    "-isystem",
+    "-iquote",
+    "-idirafter",
+    "-iprefix",
+    "-iwithprefix",
+    "-isysroot",
+    "-Xassembler",
+    "-Xpreprocessor",
+    "-aux-info",
+]
+
+# Options whose value names an output, which must not be part of the key
+OUTPUT_OPTIONS = ["-o", "-MF", "-MT", "-MQ"]
+
+# Options that make a compilation impossible to cache
+UNCACHEABLE_OPTIONS = ["-E", "-M", "-MM", "-", "--coverage", "-fprofile-arcs"]
+
+# Statistics of a cache, and their initial values
+STATS = {"hits": 0, "misses": 0, "uncacheable": 0, "size": 0, "files": 0}
+
+# Fraction of the limit a full cache is cleaned down to
+CLEANUP_RATIO = 0.8
+
+
+# Parse the arguments of a compilation that can be cached
+# Returns (source, object, arguments that preprocess it into a temp file) or None
+def parse_arguments(args, temp):
+    if "-c" not in args:
+        return None
+    sources = []
+    output = None
+    dep_file = dep_target = depends = False
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        if arg in UNCACHEABLE_OPTIONS or arg.startswith(("@", "-save-temps", "-Wp,")):
+            return None
+        if arg in VALUE_OPTIONS:
+            if index + 1 == len(args):
+                return None
+            if arg == "-o":
+                output = args[index + 1]
+            dep_file = dep_file or arg == "-MF"
+            dep_target = dep_target or arg in ["-MT", "-MQ"]
+            index += 2
+            continue
+        if arg.startswith("-o"):
+            output = arg[2:]
+        elif arg in ["-MD", "-MMD"]:
+            depends = True
+        elif not arg.startswith("-"):
+            if os.path.splitext(arg)[1] in SOURCE_EXTENSIONS:
+                sources.append(arg)
+            else:
+                return None
+        index += 1
+    if len(sources) != 1:
+        return None
+    source = sources[0]
+    if not output:
+        output = os.path.splitext(os.path.basename(source))[0] + ".o"
+
+    # Preprocessing writes the dependency file a compilation would
+    preprocess = []
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        if arg == "-c":
+            preprocess.append("-E")
+        elif arg == "-o":
+            index += 1
+        elif not arg.startswith("-o"):
+            preprocess.append(arg)
+        index += 1
+    preprocess.extend(["-o", temp])
+    if depends and not dep_file:
+        preprocess.extend(["-MF", os.path.splitext(output)[0] + ".d"])
+    if depends and not dep_target:
+        preprocess.extend(["-MT", output])
+    return source, output, preprocess
+
+
+# Arguments without the names of outputs
+def key_arguments(args):
+    key = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in OUTPUT_OPTIONS:
+            skip = True
+        elif not arg.startswith("-o"):
+            key.append(arg)
+    return key
+
+
+# Key of a compilation: the compiler, its arguments, the working directory (which
+# ends up in debug information), EXTRA_CFLAGS of the project and the preprocessed
+# source
+def cache_key(compiler, args, preprocessed):
+    stat = os.stat(compiler)
+    digest = hashlib.sha256()
+    header = [
+        CACHE_VERSION,
+        os.path.realpath(compiler),
+        stat.st_size,
+        stat.st_mtime_ns,
+        os.getcwd(),
+        os.environ.get("NEOPO_CCACHE_EXTRA", ""),
+        key_arguments(args),
+    ]
+    digest.update(json.dumps(header).encode())
+    with open(preprocessed, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Copy a file to another path in one step
+def copy_file(source, target):
+    directory = os.path.dirname(target) or os.curdir
+    with open(source, "rb") as reader:
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as writer:
+            for chunk in iter(lambda: reader.read(1 << 20), b""):
+                writer.write(chunk)
+    os.replace(writer.name, target)
+
+
+# Lock on the statistics of a cache
+class StatsLock:
+    def __init__(self, cache_dir):
+        self.path = os.path.join(cache_dir, "stats.lock")
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "a")
+        if fcntl:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        self.file.close()
+
+
+# Load the statistics of a cache
+def load_stats(cache_dir):
+    stats = dict(STATS)
+    try:
+        with open(os.path.join(cache_dir, "stats.json"), "r") as file:
+            stats.update(json.load(file))
+    except (OSError, ValueError):
+        pass
+    return stats
+
+
+def save_stats(cache_dir, stats):
+    path = os.path.join(cache_dir, "stats.json")
+    with open(path + ".tmp", "w") as file:
+        json.dump(stats, file, indent=4)
+    os.replace(path + ".tmp", path)
+
+
+# Objects in a cache: [(last used, path, size)]
+def cached_files(cache_dir):
+    files = []
+    objects = os.path.join(cache_dir, "objects")
+    for directory, _, names in os.walk(objects):
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, path, stat.st_size))
+    return files
+
+
+# Remove the least recently used objects until the cache fits in limit bytes
+def cleanup(cache_dir, limit, stats):
+    kept = []
+    files = sorted(cached_files(cache_dir))
+    size = sum(file[2] for file in files)
+    for _, path, file_size in files:
+        if size > limit:
+            try:
+                os.remove(path)
+                size -= file_size
+                continue
+            except OSError:
+                pass
+        kept.append(path)
+    stats["size"] = size
+    stats["files"] = len([path for path in kept if path.endswith(".o")])
+
+
+# Count a compilation in the statistics, cleaning up a cache that got too big
+def count(cache_dir, limit, result, stored=0, files=0):
+    try:
+        with StatsLock(cache_dir):
+            stats = load_stats(cache_dir)
+            stats[result] += 1
+            stats["size"] += stored
+            stats["files"] += files
+            if stats["size"] > limit:
+                cleanup(cache_dir, limit * CLEANUP_RATIO, stats)
+            save_stats(cache_dir, stats)
+    except OSError:
+        pass
+
+
+# Run the compiler, with its errors and warnings captured
+def compile_object(compiler, args):
+    process = subprocess.run([compiler] + args, stderr=subprocess.PIPE)
+    return process.returncode, process.stderr
+
+
+# Compile with the cache, returning the exit status of the compiler
+def main(argv):
+    compiler, args = argv[1], argv[2:]
+    cache_dir = os.environ.get("NEOPO_CCACHE_DIR")
+    if not cache_dir:
+        return subprocess.run([compiler] + args).returncode
+    limit = int(os.environ["NEOPO_CCACHE_SIZE"]) * 1024 * 1024
+
+    os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+    handle, temp = tempfile.mkstemp(suffix=".i", dir=cache_dir)
+    os.close(handle)
+    try:
+        parsed = parse_arguments(args, temp)
+        if parsed:
+            source, output, preprocess = parsed
+            # Warnings of the preprocessor are printed again when compiling
+            status = subprocess.run(
+                [compiler] + preprocess, stderr=subprocess.DEVNULL
+            ).returncode
+            if status:
+                parsed = None
+        if not parsed:
+            count(cache_dir, limit, "uncacheable")
+            return subprocess.run([compiler] + args).returncode
+        key = cache_key(compiler, args, temp)
+    finally:
+        os.remove(temp)
+
+    cached = os.path.join(cache_dir, "objects", key[:2], key)
+    try:
+        copy_file(cached + ".o", output)
+        with open(cached + ".stderr", "rb") as file:
+            sys.stderr.buffer.write(file.read())
+        # Cleaning up removes the objects used least recently first
+        os.utime(cached + ".o")
+        os.utime(cached + ".stderr")
+        count(cache_dir, limit, "hits")
+        return 0
+    except OSError:
+        pass
+
+    status, errors = compile_object(compiler, args)
+    sys.stderr.buffer.write(errors)
+    if status:
+        count(cache_dir, limit, "misses")
+        return status
+    try:
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(cached), delete=False
+        ) as file:
+            file.write(errors)
+        os.replace(file.name, cached + ".stderr")
+        copy_file(output, cached + ".o")
+        stored = os.path.getsize(cached + ".o") + len(errors)
+        count(cache_dir, limit, "misses", stored, 1)
+    except OSError:
+        count(cache_dir, limit, "misses")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
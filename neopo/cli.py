@@ -26,6 +26,7 @@ from .command import (
     upgrade_command,
     versions_command,
 )
+from .common import check_environment
 
 
 # Main API for using neopo as a module
@@ -38,6 +39,7 @@ def main(args=None):
     try:
         # Add dummy first argument
         args = ["", *args]
+        check_environment()
         commands[args[1]](args)
     except IndexError:
         print("Expected a command!")
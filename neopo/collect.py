@@ -0,0 +1,174 @@
+import json
+import os
+import shutil
+import time
+
+# Local imports
+from .common import DependencyError, UserError, jsonFiles, projectFiles
+from .dedupe import load_index, save_index
+from .lock import dependency_lock, file_lock
+from .manifest import read_manifest
+from .store import format_size
+from .toolchain import get_firmware_deps
+from .usage import forget_usage, load_usage
+from .verify import installed_deps
+from .workbench import INSTALL_RECEIPT
+
+# Directories that never contain projects
+SKIPPED_DIRS = ["node_modules", "target", "lib"]
+
+
+# Find the deviceOS versions of the projects under some directories
+def project_versions(roots):
+    versions = {}
+    for root in roots:
+        for directory, dirs, _ in os.walk(root):
+            dirs[:] = [
+                name
+                for name in dirs
+                if not name.startswith(".") and name not in SKIPPED_DIRS
+            ]
+            settings = os.path.join(directory, projectFiles["settings"])
+            try:
+                with open(settings, "r") as file:
+                    version = json.load(file)["particle.firmwareVersion"]
+            except (OSError, KeyError, TypeError, json.decoder.JSONDecodeError):
+                continue
+            versions.setdefault(version, []).append(directory)
+    return versions
+
+
+# Dependencies ("name@version") that must be kept: the default toolchain in the
+# manifest and the toolchains of the deviceOS versions used by projects
+def referenced_deps(versions):
+    referenced = set()
+    try:
+        manifest = read_manifest() or {}
+    except FileNotFoundError:
+        manifest = {}
+    referenced.update("%s@%s" % item for item in manifest.items())
+    for version in versions:
+        referenced.add("deviceOS@%s" % version)
+        try:
+            deps = get_firmware_deps(version)
+        except (DependencyError, FileNotFoundError, KeyError, TypeError):
+            continue
+        referenced.update("%s@%s" % item for item in deps.items())
+    return referenced
+
+
+# Disk space used by a tree, hard-linked files counting a share per link
+def tree_size(path):
+    size = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.lstat(os.path.join(directory, name))
+            except OSError:
+                continue
+            blocks = getattr(stat, "st_blocks", None)
+            used = blocks * 512 if blocks is not None else stat.st_size
+            size += used // max(1, stat.st_nlink)
+    return size
+
+
+# When a dependency was last used: by a build, or else when it was installed
+def last_used(key, path, usage):
+    if key in usage:
+        return usage[key]
+    try:
+        with open(os.path.join(path, INSTALL_RECEIPT), "r") as file:
+            return json.load(file)["installed"] / 1000
+    except (OSError, KeyError, TypeError, json.decoder.JSONDecodeError):
+        return os.path.getmtime(path)
+
+
+# Delete an installed dependency, renaming it aside first so it is never half installed
+def remove_dep(name, version, path):
+    with dependency_lock(name, version):
+        if not os.path.isdir(path):
+            return
+        trash = os.path.join(
+            os.path.dirname(path), ".%s-%d.removed" % (version, os.getpid())
+        )
+        os.rename(path, trash)
+        shutil.rmtree(trash)
+
+
+# Remove least recently used dependencies that no project references until the
+# installed toolchains fit in target bytes, returning the space reclaimed
+def collect_garbage(target, roots, dry_run=False):
+    versions = project_versions(roots)
+    referenced = referenced_deps(versions)
+    print(
+        "Found %d projects using %d deviceOS versions."
+        % (sum(len(paths) for paths in versions.values()), len(versions))
+    )
+
+    usage = load_usage()
+    deps = []
+    total = 0
+    for name, version, path in installed_deps():
+        key = "%s@%s" % (name, version)
+        size = tree_size(path)
+        total += size
+        if key not in referenced:
+            deps.append((last_used(key, path, usage), key, name, version, path, size))
+    deps.sort()
+
+    reclaimed = 0
+    collected = []
+    for used, key, name, version, path, size in deps:
+        if total - reclaimed <= target:
+            break
+        day = time.strftime("%Y-%m-%d", time.localtime(used))
+        if dry_run:
+            print("Would remove %s (last used %s, %s)" % (key, day, format_size(size)))
+        else:
+            print("Removing %s (last used %s, %s)..." % (key, day, format_size(size)))
+            remove_dep(name, version, path)
+        collected.append(key)
+        reclaimed += size
+
+    if collected and not dry_run:
+        forget_usage(collected)
+        # Let neopo dedupe scan these versions again if they are reinstalled
+        with file_lock(jsonFiles["dedupe"]):
+            index = load_index()
+            trees = [os.path.join(*key.split("@", 1)) for key in collected]
+            index["trees"] = [tree for tree in index["trees"] if tree not in trees]
+            save_index(index)
+
+    print(
+        "%s %d dependencies, %s %s. Toolchains %s %s."
+        % (
+            "Would remove" if dry_run else "Removed",
+            len(collected),
+            "would reclaim" if dry_run else "reclaimed",
+            format_size(reclaimed),
+            "would use" if dry_run else "now use",
+            format_size(total - reclaimed),
+        )
+    )
+    return reclaimed
+
+
+# Wrapper for [gc]
+def gc_command(args):
+    options = args[2:]
+    dry_run = "--dry-run" in options
+    remove_all = "--all" in options
+    options = [option for option in options if option not in ("--dry-run", "--all")]
+    target = None
+    if options and options[0].isdigit():
+        target = int(options.pop(0)) * 1024 * 1024
+    if (options and options[0].startswith("-")) or (remove_all and target is not None):
+        raise UserError(
+            "Invalid option! Use: neopo gc [--dry-run] <size|--all> [roots...]"
+        )
+
+    # Without a size nothing is removed, only what --all would remove is listed
+    implied = target is None and not remove_all
+    collect_garbage(target or 0, options or [os.curdir], dry_run or implied)
+    if implied:
+        print("To remove them use: $ neopo gc <size|--all> [roots...]")
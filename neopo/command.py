@@ -11,19 +11,26 @@ from .build import (
     flash_command,
     run_command,
 )
+from .bundle import bundle_command
+from .collect import gc_command
 from .common import (
     NEOPO_DEPS,
     ProcessError,
     UserError,
+    check_environment,
     particle_cli,
     running_on_windows,
 )
+from .compilercache import compiler_cache_command
 from .completion import (
     find_valid_projects,
     get_makefile_targets,
     platforms_command,
     versions_compressed,
 )
+from .daemon import daemon_command
+from .dedupe import dedupe_command
+from .mirror import serve_command
 from .particle import particle_command, particle_env
 from .project import (
     configure_command,
@@ -40,6 +47,7 @@ from .serial import (
     serial_open,
     serial_reset,
 )
+from .store import cache_command
 from .toolchain import (
     download_unlisted_command,
     get_command,
@@ -49,8 +57,10 @@ from .toolchain import (
 from .utility import handle_missing_file, print_help, unexpected_error
 
 # Local imports
+from .verify import verify_command
 from .version import NEOPO_VERSION
 from .workbench import install_or_update, workbench_install
+from .workspace import workspace_command
 
 
 # Print all commands (for completion)
@@ -319,6 +329,14 @@ commands = {
     "update": update_command,
     "get": get_command,
     "remove": remove_command,
+    "cache": cache_command,
+    "ccache": compiler_cache_command,
+    "bundle": bundle_command,
+    "dedupe": dedupe_command,
+    "verify": verify_command,
+    "gc": gc_command,
+    "serve": serve_command,
+    "daemon": daemon_command,
     "list-versions": versions_compressed,
     "platforms": platforms_command,
     "projects": find_valid_projects,
@@ -337,6 +355,7 @@ commands = {
     "print": script_print,
     "settings": settings_command,
     "libs": libraries_command,
+    "workspace": workspace_command,
     "setup": setup_command,
     "setup-workbench": workbench_install,
 }
@@ -348,6 +367,7 @@ def main(args=sys.argv):
         print_help(None)
     elif args[1] in commands:
         try:
+            check_environment()
             commands[args[1]](args)
         except FileNotFoundError as error:
             handle_missing_file(error.filename)
@@ -8,8 +8,46 @@ running_on_windows = platform.system() == "Windows"
 # Home directory of user running neopo
 HOME_DIR = os.path.expanduser("~") if running_on_windows else os.environ["HOME"]
 
-# Enable parallel downloads with opt-in variable
-NEOPO_PARALLEL = "NEOPO_PARALLEL" in os.environ
+# Settings in the environment that are not valid numbers
+# They are reported by check_environment rather than when neopo is imported
+invalid_settings = []
+
+
+# Read a number of at least minimum from the environment, or use default
+def env_number(name, default, minimum=0, convert=int):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        number = convert(value)
+        if number >= minimum:
+            return number
+    except ValueError:
+        pass
+    invalid_settings.append("%s must be a number of at least %s!" % (name, minimum))
+    return default
+
+
+# Refuse to run with invalid numbers in the environment
+def check_environment():
+    if invalid_settings:
+        raise UserError("\n".join(invalid_settings))
+
+
+# Number of dependencies installed concurrently. Example:
+# NEOPO_JOBS=1 neopo install
+NEOPO_JOBS = env_number("NEOPO_JOBS", 4, 1)
+
+# Free disk space in MiB that must remain before another install is started
+NEOPO_MIN_FREE = env_number("NEOPO_MIN_FREE", 512) * 1024 * 1024
+
+# Number of times an interrupted download is resumed before giving up. Example:
+# NEOPO_RETRIES=10 neopo install
+NEOPO_RETRIES = env_number("NEOPO_RETRIES", 3)
+
+# Timeout in seconds for network connections. Example:
+# NEOPO_TIMEOUT=120 neopo install
+NEOPO_TIMEOUT = env_number("NEOPO_TIMEOUT", 30, 1, float)
 
 # Specify custom path. Example:
 # NEOPO_PATH=$PWD/temp neopo particle
@@ -37,13 +75,69 @@ else:
     NEOPO_DEPS = os.path.join(HOME_DIR, ".neopo")
     CACHE_DIR = os.path.join(NEOPO_DEPS, "cache")
 
+# Split large downloads into this many concurrently fetched byte ranges. Example:
+# NEOPO_SEGMENTS=8 neopo get 4.0.0
+NEOPO_SEGMENTS = env_number("NEOPO_SEGMENTS", 1, 1)
+
+# Partial downloads and their resume journals
+DOWNLOAD_DIR = os.path.join(CACHE_DIR, "downloads")
+
+# Lock files that let several neopo processes share one installation
+LOCK_DIR = os.path.join(CACHE_DIR, "locks")
+
+# Content-addressed store of dependency archives, shared by every neopo root
+# Point NEOPO_STORE at a shared mount to share it between machines. Example:
+# NEOPO_STORE=/mnt/shared/neopo-store neopo install
+STORE_DIR = os.environ.get(
+    "NEOPO_STORE", os.path.join(HOME_DIR, ".cache", "neopo", "store")
+)
+
+# Size limit of the artifact store in MiB. Example:
+# NEOPO_STORE_SIZE=2048 neopo get 4.0.0
+STORE_LIMIT = env_number("NEOPO_STORE_SIZE", 8192) * 1024 * 1024
+
+# Cache of objects compiled by builds with NEOPO_CCACHE set, shared by every project
+# Point NEOPO_CCACHE_DIR at a persistent directory on CI machines. Example:
+# NEOPO_CCACHE=1 NEOPO_CCACHE_DIR=/ci/cache/neopo neopo build
+COMPILER_CACHE_DIR = os.environ.get(
+    "NEOPO_CCACHE_DIR", os.path.join(HOME_DIR, ".cache", "neopo", "compiler")
+)
+
+# Size limit of the compiler cache in MiB. Example:
+# NEOPO_CCACHE=1 NEOPO_CCACHE_SIZE=1024 neopo build
+COMPILER_CACHE_SIZE = env_number("NEOPO_CCACHE_SIZE", 4096)
+
+# Download the catalog and dependencies through a neopo mirror (see neopo serve). Example:
+# NEOPO_MIRROR=http://buildserver:8088 neopo install
+NEOPO_MIRROR = os.environ.get("NEOPO_MIRROR", "").rstrip("/")
+
+# Downloads cached by neopo serve that are not dependency archives
+MIRROR_DIR = os.path.join(CACHE_DIR, "mirror")
+
+# Size limit of the downloads cached by neopo serve in MiB. Example:
+# NEOPO_MIRROR_SIZE=1024 neopo serve
+MIRROR_LIMIT = env_number("NEOPO_MIRROR_SIZE", 2048) * 1024 * 1024
+
+# Unix socket of neopo daemon, which builds run through while it is running
+DAEMON_SOCKET = os.path.join(CACHE_DIR, "daemon.sock")
+
+# OPT-IN to deduplicate files across installed toolchains after each install. Example:
+# NEOPO_DEDUPE=1 neopo get 4.0.0
+NEOPO_DEDUPE = "NEOPO_DEDUPE" in os.environ
+
+# Platforms that deviceOS releases are installed for, or "all". Example:
+# NEOPO_PLATFORMS=argon,boron neopo get 4.0.0
+NEOPO_PLATFORMS = [
+    name for name in os.environ.get("NEOPO_PLATFORMS", "").split(",") if name
+]
+
 # DEBUG
 # print(BASE_DIR, PARTICLE_DEPS, NEOPO_DEPS, CACHE_DIR, sep="\n")
 
 
-# Create a copy of the env with XDG_DATA_HOME set if necessary
-def min_particle_env():
-    temp_env = os.environ.copy()
+# Create a copy of the env (or of another environment) with XDG_DATA_HOME set if necessary
+def min_particle_env(environ=None):
+    temp_env = dict(os.environ if environ is None else environ)
     if NEOPO_LOCAL or NEOPO_PATH:
         temp_env["XDG_DATA_HOME"] = BASE_DIR
     return temp_env
@@ -98,6 +192,9 @@ jsonFiles = {
     "scripts": os.path.join(CACHE_DIR, "scripts.json"),
     "debuggers": os.path.join(CACHE_DIR, "debuggers.json"),
     "manifest": os.path.join(CACHE_DIR, "manifest.json"),
+    "upstream": os.path.join(CACHE_DIR, "upstream.json"),
+    "dedupe": os.path.join(CACHE_DIR, "dedupe.json"),
+    "usage": os.path.join(CACHE_DIR, "usage.json"),
 }
 
 # Workbench template files
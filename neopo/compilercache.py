@@ -0,0 +1,99 @@
+import os
+import shlex
+import shutil
+import sys
+
+# Local imports
+from .ccwrapper import load_stats
+from .common import (
+    COMPILER_CACHE_DIR,
+    COMPILER_CACHE_SIZE,
+    UserError,
+    running_on_windows,
+)
+from .store import format_size
+from .utility import write_executable
+
+# Compilers of gcc-arm that builds run through the compiler cache
+CACHED_COMPILERS = ["arm-none-eabi-gcc", "arm-none-eabi-g++", "arm-none-eabi-c++"]
+
+# Wrapper run by the shims in place of a compiler
+WRAPPER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ccwrapper.py")
+
+
+# Shim that runs a compiler through the compiler cache
+def compiler_shim(compiler):
+    command = [sys.executable, "-S", WRAPPER, compiler]
+    return '#!/bin/sh\nexec %s "$@"\n' % " ".join(shlex.quote(arg) for arg in command)
+
+
+# Write the shims of a gcc-arm version, unless they are already up to date
+# Returns the directory of the shims
+def write_compiler_shims(bin_path, compiler_version):
+    shims = os.path.join(COMPILER_CACHE_DIR, "shims", compiler_version)
+    os.makedirs(shims, exist_ok=True)
+    for name in CACHED_COMPILERS:
+        path = os.path.join(shims, name)
+        content = compiler_shim(os.path.join(bin_path, name))
+        try:
+            with open(path, "r") as file:
+                if file.read() == content:
+                    continue
+        except OSError:
+            pass
+        # Builds running in parallel may write the same shim
+        temp = "%s.%d.tmp" % (path, os.getpid())
+        write_executable(content.encode("utf-8"), temp)
+        os.replace(temp, path)
+    return shims
+
+
+# Put the compiler cache in front of the compiler of a build, if the environment of
+# the build sets NEOPO_CCACHE. Example:
+# NEOPO_CCACHE=1 neopo build
+# Objects are cached by the preprocessed source, the arguments and version of the
+# compiler, and the EXTRA_CFLAGS of the project
+def use_compiler_cache(environment, compiler_version, bin_path, flags):
+    if not environment.get("NEOPO_CCACHE") or running_on_windows:
+        return
+    shims = write_compiler_shims(bin_path, compiler_version)
+    environment["PATH"] = shims + os.pathsep + environment["PATH"]
+    environment["NEOPO_CCACHE_DIR"] = COMPILER_CACHE_DIR
+    environment["NEOPO_CCACHE_SIZE"] = str(COMPILER_CACHE_SIZE)
+    environment["NEOPO_CCACHE_EXTRA"] = flags
+
+
+# Print the statistics of the compiler cache
+def compiler_cache_stats():
+    stats = load_stats(COMPILER_CACHE_DIR)
+    cacheable = stats["hits"] + stats["misses"]
+    rate = 100 * stats["hits"] / cacheable if cacheable else 0
+    print("Compiler cache: %s" % COMPILER_CACHE_DIR)
+    print("  Hits:        %d (%.1f%%)" % (stats["hits"], rate))
+    print("  Misses:      %d" % stats["misses"])
+    print("  Uncacheable: %d" % stats["uncacheable"])
+    print("  Objects:     %d" % stats["files"])
+    print(
+        "  Size:        %s of %s"
+        % (
+            format_size(stats["size"]),
+            format_size(COMPILER_CACHE_SIZE * 1024 * 1024),
+        )
+    )
+
+
+# Wrapper for [ccache]
+def compiler_cache_command(args):
+    action = args[2] if len(args) >= 3 else "stats"
+    if action == "stats":
+        compiler_cache_stats()
+    elif action == "clear":
+        for name in ["objects", "stats.json"]:
+            path = os.path.join(COMPILER_CACHE_DIR, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.isfile(path):
+                os.remove(path)
+        print("Cleared the compiler cache.")
+    else:
+        raise UserError("Invalid command! Commands are: stats, clear")
@@ -1,15 +1,15 @@
-import json
 import os
 
 # Local imports
-from .common import PARTICLE_DEPS, jsonFiles, projectFiles
+from .catalog import catalog
+from .common import PARTICLE_DEPS, projectFiles
+from .manifest import read_manifest
 
 
 # Print available versions compressed (for completion)
 def versions_compressed(args):
     total_versions = set()
-    with open(jsonFiles["firmware"], "r") as firmware_file:
-        total_versions.update([entry["version"] for entry in json.load(firmware_file)])
+    total_versions.update([entry["version"] for entry in catalog.firmware_releases()])
     device_os_path = os.path.join(PARTICLE_DEPS, "deviceOS")
     if os.path.isdir(device_os_path):
         _, installed_versions, _ = next(os.walk(device_os_path))
@@ -19,8 +19,7 @@ def versions_compressed(args):
 
 # Print available platforms (for completion)
 def platforms_command(args):
-    with open(jsonFiles["platforms"], "r") as platform_file:
-        print(*[entry["name"] for entry in json.load(platform_file)])
+    print(*[entry["name"] for entry in catalog.load("platforms")])
 
 
 # Find all valid projects in PWD (for completion)
@@ -37,20 +36,19 @@ def find_valid_projects(args):
 
 # Find all makefile targets (for completion)
 def get_makefile_targets(args):
-    with open(jsonFiles["manifest"], "r") as manifest:
-        with open(
-            os.path.join(
-                PARTICLE_DEPS,
-                "buildscripts",
-                json.load(manifest)["buildscripts"],
-                "Makefile",
-            )
-        ) as makefile:
-            sep = ".PHONY: "
-            print(
-                *[
-                    line.partition(sep)[2].strip("\n")
-                    for line in makefile.readlines()
-                    if line.startswith(sep)
-                ]
-            )
+    with open(
+        os.path.join(
+            PARTICLE_DEPS,
+            "buildscripts",
+            read_manifest()["buildscripts"],
+            "Makefile",
+        )
+    ) as makefile:
+        sep = ".PHONY: "
+        print(
+            *[
+                line.partition(sep)[2].strip("\n")
+                for line in makefile.readlines()
+                if line.startswith(sep)
+            ]
+        )
@@ -0,0 +1,259 @@
+import json
+import os
+import pathlib
+import select
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import traceback
+
+# Local imports
+from .build import build_process
+from .catalog import catalog
+from .common import (
+    CACHE_DIR,
+    DAEMON_SOCKET,
+    NEOPO_JOBS,
+    PARTICLE_DEPS,
+    ProcessError,
+    ProjectError,
+    UserError,
+)
+from .daemonclient import DAEMON_PROTOCOL, daemon_running, receive_message
+from .jobs import JOBSERVER_FDS
+from .lockfile import load_lockfile
+from .manifest import get_manifest_value
+from .project import check_libraries, get_flags, get_settings
+from .toolchain import check_deps_installed
+from .workbench import INSTALL_RECEIPT
+
+
+# Standard output of the daemon: each request thread writes to its client
+class ThreadOutput:
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def stream(self):
+        return getattr(self.local, "stream", None) or self.default
+
+    def write(self, text):
+        return self.stream().write(text)
+
+    def flush(self):
+        self.stream().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream(), name)
+
+
+# Modification time of the install receipt of a deviceOS release, or None
+def firmware_receipt(version):
+    try:
+        receipt = os.path.join(PARTICLE_DEPS, "deviceOS", version, INSTALL_RECEIPT)
+        return os.stat(receipt).st_mtime_ns
+    except OSError:
+        return None
+
+
+# Wait for a build, stopping it if the client goes away (^C)
+# Returns the exit status, or None if the build was stopped
+def wait_for_build(process, conn):
+    while process.poll() is None:
+        readable, _, _ = select.select([conn], [], [], 0.25)
+        if readable and not conn.recv(1):
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait()
+            return None
+    return process.returncode
+
+
+class DaemonHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        reply = self.server.serve(self.request)
+        try:
+            self.request.sendall((json.dumps(reply) + "\n").encode())
+        except OSError:
+            pass
+
+
+# Server running builds for neopo clients, keeping what builds resolve in memory:
+# the catalog, the manifest and the toolchains validated for each
+# (platform, deviceOS) pair, which are only checked again when they change
+class BuildDaemon(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, jobs):
+        super().__init__(path, DaemonHandler)
+        self.jobs = threading.BoundedSemaphore(jobs)
+        self.validated = {}
+        self.validated_lock = threading.Lock()
+
+    # Resolve a project without validating its toolchain again, or return None
+    # to let build_process resolve (and report problems with) it
+    def resolve(self, project_path):
+        lock = load_lockfile(project_path)
+        if lock:
+            return lock
+        try:
+            platform, version = get_settings(project_path)
+        except (OSError, KeyError, TypeError, ProjectError):
+            return None
+
+        with self.validated_lock:
+            compiler, receipt = self.validated.get((platform, version), (None, None))
+        # A reinstalled release may lack the files of the platform
+        if not compiler or receipt != firmware_receipt(version):
+            return None
+        toolchain = {
+            "gcc-arm": compiler,
+            "buildscripts": get_manifest_value("buildscripts"),
+            "buildtools": get_manifest_value("buildtools"),
+            "deviceOS": version,
+        }
+        # Toolchains removed since (neopo gc, neopo remove) are validated again
+        if check_deps_installed(toolchain):
+            return None
+
+        if not check_libraries(project_path, False):
+            print("To install libraries run: $ neopo libs [project]")
+        return {
+            "platform": platform,
+            "toolchain": toolchain,
+            "EXTRA_CFLAGS": get_flags(project_path),
+        }
+
+    # Remember the toolchain of a (platform, deviceOS) pair that a build validated
+    def remember(self, resolution):
+        toolchain = resolution["toolchain"]
+        key = (resolution["platform"], toolchain["deviceOS"])
+        receipt = firmware_receipt(toolchain["deviceOS"])
+        with self.validated_lock:
+            self.validated[key] = (toolchain["gcc-arm"], receipt)
+
+    # Run a build request with the output of the client
+    def build(self, conn, request, stdout, stderr):
+        project_path, command = request["project"], request["command"]
+        verbosity = request["verbosity"]
+
+        # The descriptors of a jobserver pipe are the client's, not this process's
+        environ = request["environ"]
+        if "MAKEFLAGS" in environ:
+            environ["MAKEFLAGS"] = JOBSERVER_FDS.sub("", environ["MAKEFLAGS"]).strip()
+
+        catalog.refresh()
+        process, environment, resolution = build_process(
+            project_path,
+            command,
+            False,
+            verbosity,
+            self.resolve(project_path),
+            environ,
+        )
+        self.remember(resolution)
+        sys.stdout.flush()
+
+        quiet = verbosity == -1
+        make = subprocess.Popen(
+            process,
+            env=environment,
+            cwd=request["cwd"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL if quiet else stdout,
+            stderr=subprocess.DEVNULL if quiet else stderr,
+            start_new_session=True,
+        )
+        status = wait_for_build(make, conn)
+        if status:
+            raise ProcessError("\n*** %s FAILED ***\n" % command.upper())
+        return {}
+
+    # Serve one client: read its request and run it, returning the reply
+    def serve(self, conn):
+        fds = []
+        try:
+            data, fds, _, _ = socket.recv_fds(conn, 1 << 16, 2)
+            request = receive_message(conn, data)
+        except (OSError, ValueError):
+            for fd in fds:
+                os.close(fd)
+            return {"error": "Invalid request!", "kind": "UserError"}
+
+        output = None
+        try:
+            if request.get("protocol") != DAEMON_PROTOCOL or len(fds) != 2:
+                return {"protocol": DAEMON_PROTOCOL}
+            output = os.fdopen(fds[0], "w", closefd=False)
+            sys.stdout.local.stream = output
+            with self.jobs:
+                self.log("%s %s" % (request["command"], request["project"]))
+                return self.build(conn, request, *fds)
+        except FileNotFoundError as error:
+            return {"missing": error.filename}
+        except SystemExit as error:
+            return {"exit": error.code}
+        except RuntimeError as error:
+            return {"error": str(error), "kind": type(error).__name__}
+        except Exception as error:
+            traceback.print_exc(file=sys.stdout.default)
+            return {"error": "neopo daemon failed: %s" % error, "kind": "ProcessError"}
+        finally:
+            sys.stdout.local.stream = None
+            if output:
+                try:
+                    output.flush()
+                except OSError:
+                    pass
+            for fd in fds:
+                os.close(fd)
+
+    def log(self, message):
+        print(message, file=sys.stdout.default, flush=True)
+
+
+# Wrapper for [daemon]
+def daemon_command(args):
+    if not hasattr(socket, "AF_UNIX") or not hasattr(socket, "send_fds"):
+        raise UserError("neopo daemon requires Unix domain sockets!")
+    try:
+        jobs = int(args[2]) if len(args) >= 3 else NEOPO_JOBS
+    except ValueError as error:
+        raise UserError("The number of jobs must be a number!") from error
+    if jobs < 1:
+        raise UserError("The number of jobs must be at least 1!")
+
+    if daemon_running():
+        raise UserError("neopo daemon is already running!")
+    # A daemon that did not exit cleanly leaves its socket behind
+    try:
+        os.remove(DAEMON_SOCKET)
+    except FileNotFoundError:
+        pass
+    pathlib.Path(CACHE_DIR).mkdir(parents=True, exist_ok=True)
+
+    # Only this user may connect: builds run with this user's permissions
+    umask = os.umask(0o077)
+    try:
+        server = BuildDaemon(DAEMON_SOCKET, jobs)
+    except OSError as error:
+        raise UserError(
+            "Could not listen on %s: %s" % (DAEMON_SOCKET, error)
+        ) from error
+    finally:
+        os.umask(umask)
+
+    stdout = sys.stdout
+    sys.stdout = ThreadOutput(stdout)
+    print("neopo daemon running up to %d builds at a time." % jobs)
+    print("Builds of this neopo installation now run through it.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(DAEMON_SOCKET)
+        sys.stdout = stdout
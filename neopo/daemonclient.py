@@ -0,0 +1,103 @@
+import json
+import os
+import socket
+import sys
+
+# Local imports
+from .common import (
+    DAEMON_SOCKET,
+    DependencyError,
+    ProcessError,
+    ProjectError,
+    UserError,
+)
+from .jobs import outer_jobserver
+from .utility import handle_missing_file
+
+# Bump when requests or replies change, so a daemon running another version of
+# neopo is never sent builds it would run differently
+DAEMON_PROTOCOL = 1
+
+# Errors a daemon reports by name, raised again by the client
+DAEMON_ERRORS = {
+    error.__name__: error
+    for error in [DependencyError, ProcessError, ProjectError, UserError]
+}
+
+
+# Connect to neopo daemon, or return None if it is not running
+def connect_daemon():
+    if not hasattr(socket, "AF_UNIX") or not hasattr(socket, "send_fds"):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(DAEMON_SOCKET)
+    except OSError:
+        conn.close()
+        return None
+    return conn
+
+
+# Check whether neopo daemon is running
+def daemon_running():
+    conn = connect_daemon()
+    if conn:
+        conn.close()
+    return conn is not None
+
+
+# Read one newline-terminated JSON message from a connection
+def receive_message(conn, data=b""):
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(1 << 16)
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return json.loads(data)
+
+
+# Run a Makefile target of a project in neopo daemon, with this process's
+# environment and working directory. The daemon writes straight to this
+# process's stdout and stderr, and stops the build if this process is interrupted
+# Returns False if no daemon (of this version of neopo) is running
+def daemon_build(project_path, command, verbosity):
+    # A jobserver pipe of an outer make can only be passed on by this process
+    if outer_jobserver(os.environ):
+        return False
+    conn = connect_daemon()
+    if not conn:
+        return False
+
+    with conn:
+        request = {
+            "protocol": DAEMON_PROTOCOL,
+            "project": project_path,
+            "command": command,
+            "verbosity": verbosity,
+            "cwd": os.getcwd(),
+            "environ": dict(os.environ),
+        }
+        data = (json.dumps(request) + "\n").encode()
+        try:
+            fds = [sys.stdout.fileno(), sys.stderr.fileno()]
+        except (OSError, ValueError):
+            # Output captured in memory (neopo used as a module) stays in process
+            return False
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            sent = socket.send_fds(conn, [data], fds)
+            conn.sendall(data[sent:])
+            reply = receive_message(conn)
+        except (OSError, ValueError) as error:
+            raise ProcessError("Lost the connection to neopo daemon!") from error
+
+    if reply.get("protocol", DAEMON_PROTOCOL) != DAEMON_PROTOCOL:
+        return False
+    if "missing" in reply:
+        handle_missing_file(reply["missing"])
+    if "exit" in reply:
+        sys.exit(reply["exit"])
+    if "error" in reply:
+        raise DAEMON_ERRORS.get(reply.get("kind"), ProcessError)(reply["error"])
+    return True
@@ -0,0 +1,146 @@
+import json
+import os
+import stat
+
+# Local imports
+from .common import PARTICLE_DEPS, UserError, jsonFiles
+from .lock import file_lock
+from .store import format_size, hash_file
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl that clones a file's extents (copy-on-write reflink) on Linux
+FICLONE = 0x40049409
+
+# Files smaller than this are not worth an index entry
+MIN_SIZE = 1024
+
+
+# Load the index of file hashes and already deduplicated trees
+def load_index():
+    try:
+        with open(jsonFiles["dedupe"], "r") as file:
+            index = json.load(file)
+            if "files" in index and "trees" in index:
+                return index
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        pass
+    return {"files": {}, "trees": []}
+
+
+def save_index(index):
+    with open(jsonFiles["dedupe"], "w") as file:
+        json.dump(index, file)
+
+
+# Replace target with a reflink of source, or a hard link if that is unsupported
+def link_duplicate(source, target, target_stat):
+    temp = target + ".neopo-dedupe"
+    try:
+        if not fcntl:
+            raise OSError("reflinks are not supported")
+        with open(source, "rb") as src, open(temp, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        os.chmod(temp, stat.S_IMODE(target_stat.st_mode))
+    except OSError:
+        if os.path.exists(temp):
+            os.remove(temp)
+        # A hard link shares its permissions, so they have to agree
+        if os.stat(source).st_mode != target_stat.st_mode:
+            return False
+        try:
+            os.link(source, temp)
+        except OSError:
+            return False
+    os.replace(temp, target)
+    return True
+
+
+# Deduplicate the files of one tree against every file in the index
+def dedupe_tree(tree, index):
+    saved = 0
+    for root, _, files in os.walk(tree):
+        for name in files:
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, PARTICLE_DEPS)
+            file_stat = os.lstat(path)
+            if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_size < MIN_SIZE:
+                continue
+
+            sha256 = hash_file(path)
+            entry = index["files"].get(sha256)
+            index["files"][sha256] = [relative, file_stat.st_mtime]
+            if not entry or entry[0] == relative:
+                continue
+
+            # Skip index entries whose file was removed or modified since
+            source = os.path.join(PARTICLE_DEPS, entry[0])
+            try:
+                source_stat = os.stat(source)
+            except FileNotFoundError:
+                continue
+            if (
+                source_stat.st_mtime != entry[1]
+                or source_stat.st_size != file_stat.st_size
+            ):
+                continue
+            if (source_stat.st_dev, source_stat.st_ino) == (
+                file_stat.st_dev,
+                file_stat.st_ino,
+            ):
+                index["files"][sha256] = entry
+                continue
+
+            if link_duplicate(source, path, file_stat):
+                index["files"][sha256] = entry
+                saved += file_stat.st_size
+
+    relative = os.path.relpath(tree, PARTICLE_DEPS)
+    if relative not in index["trees"]:
+        index["trees"].append(relative)
+    return saved
+
+
+# Deduplicate a newly installed dependency (install-time hook)
+def dedupe_dependency(name, version):
+    tree = os.path.join(PARTICLE_DEPS, name, version)
+    if not os.path.isdir(tree):
+        return 0
+    with file_lock(jsonFiles["dedupe"]):
+        index = load_index()
+        saved = dedupe_tree(tree, index)
+        save_index(index)
+    return saved
+
+
+# Deduplicate every installed dependency, skipping trees already processed
+def dedupe_all(full=False):
+    with file_lock(jsonFiles["dedupe"]):
+        index = {"files": {}, "trees": []} if full else load_index()
+        saved = 0
+        if os.path.isdir(PARTICLE_DEPS):
+            for dep in sorted(os.listdir(PARTICLE_DEPS)):
+                dep_path = os.path.join(PARTICLE_DEPS, dep)
+                if not os.path.isdir(dep_path):
+                    continue
+                for version in sorted(os.listdir(dep_path)):
+                    tree = os.path.join(dep_path, version)
+                    relative = os.path.relpath(tree, PARTICLE_DEPS)
+                    if not os.path.isdir(tree) or relative in index["trees"]:
+                        continue
+                    print("Deduplicating %s@%s..." % (dep, version))
+                    saved += dedupe_tree(tree, index)
+        save_index(index)
+    return saved
+
+
+# Wrapper for [dedupe]
+def dedupe_command(args):
+    full = len(args) >= 3 and args[2] == "--full"
+    if len(args) >= 3 and not full:
+        raise UserError("Invalid option! Use: neopo dedupe [--full]")
+    saved = dedupe_all(full)
+    print("Deduplicated toolchains, reclaimed %s." % format_size(saved))
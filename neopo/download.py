@@ -0,0 +1,523 @@
+import concurrent.futures
+import hashlib
+import http.client
+import json
+import os
+import pathlib
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.error
+
+# Local imports
+from .common import DOWNLOAD_DIR, NEOPO_RETRIES, NEOPO_SEGMENTS, DependencyError
+from .extract import extract_archive
+from .fileindex import FILE_INDEX, load_file_index, update_file_index
+from .lock import file_lock
+from .session import TRANSIENT_ERRORS, mirror_url, urlopen
+from .store import find_artifact, hash_file, remove_artifact, store_artifact
+
+# Size of the chunks read from the network and fed to tarfile
+CHUNK_SIZE = 64 * 1024
+
+# How often (in bytes) the resume journal of a download is saved
+JOURNAL_INTERVAL = 4 * 1024 * 1024
+
+# Errors that mean the connection dropped and the download can be resumed
+# Requests retry these themselves, and fail at once on permanent errors
+NETWORK_ERRORS = TRANSIENT_ERRORS
+
+# Archives smaller than this are never split into segments
+SEGMENT_THRESHOLD = 8 * 1024 * 1024
+
+# Serializes the progress lines of downloads and installs running at once
+progress_lock = threading.Lock()
+
+
+# Print a line of progress whole, even while other threads print theirs
+def print_progress(message):
+    with progress_lock:
+        print(message, flush=True)
+
+
+# File-like wrapper that hashes everything read through it
+class HashingReader:
+    def __init__(self, stream):
+        self.stream = stream
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.hash.update(chunk)
+        self.size += len(chunk)
+        return chunk
+
+    # Consume the rest of the stream (tar padding) so the hash covers all of it
+    def drain(self):
+        while self.read(CHUNK_SIZE):
+            pass
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+# Extract a tar stream, refusing members that escape the destination
+# If select is given, only the members whose names it accepts are extracted
+# If index is True, the extracted files are added to the file index of path
+def extract_stream(stream, path, select=None, index=False):
+    files = extract_archive(stream, path, select)
+    if index:
+        update_file_index(path, files)
+
+
+# Create an empty staging directory next to the final location of path
+def make_staging(path):
+    parent = os.path.dirname(os.path.abspath(path))
+    pathlib.Path(parent).mkdir(parents=True, exist_ok=True)
+    prefix = ".%s-" % os.path.basename(path)
+    staging = tempfile.mkdtemp(prefix=prefix, suffix=".staging", dir=parent)
+    # mkdtemp is private to the user, match a normally created directory
+    os.chmod(staging, 0o755)
+    return staging
+
+
+# Delete a staging directory that will not be committed
+def discard_staging(staging):
+    shutil.rmtree(staging, ignore_errors=True)
+    # Remove the parent too if it was only created for the staging directory
+    try:
+        os.rmdir(os.path.dirname(staging))
+    except OSError:
+        pass
+
+
+# Move a staging directory into place, replacing any previous contents
+# The previous contents are renamed aside first so path is never half deleted
+def commit_staging(staging, path):
+    previous = None
+    if os.path.isdir(path):
+        previous = staging + ".old"
+        os.rename(path, previous)
+    os.rename(staging, path)
+    if previous:
+        shutil.rmtree(previous)
+
+
+# Move the files of a staging directory into an existing installation at path,
+# adding them to its file index and leaving the files already there in place
+def merge_staging(staging, path):
+    files = load_file_index(staging) or {}
+    if os.path.isfile(os.path.join(staging, FILE_INDEX)):
+        os.remove(os.path.join(staging, FILE_INDEX))
+    for root, directories, names in os.walk(staging):
+        target = os.path.join(path, os.path.relpath(root, staging))
+        os.makedirs(target, exist_ok=True)
+        # Symlinks to directories are moved like files
+        links = [
+            name for name in directories if os.path.islink(os.path.join(root, name))
+        ]
+        for name in names + links:
+            os.replace(os.path.join(root, name), os.path.join(target, name))
+    discard_staging(staging)
+    update_file_index(path, files)
+
+
+# A .part file in DOWNLOAD_DIR and the journal describing how much of it is valid
+# The .part file of a URL is claimed with a lock for as long as it is downloaded
+class PartialDownload:
+    def __init__(self, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]
+        lock = file_lock(key + ".part")
+        self.lock = lock if lock.try_acquire() else None
+        # Another thread or process downloading the same URL gets its own .part
+        # file, which is not kept for resuming
+        if not self.lock:
+            key = "%s-%d-%d" % (key, os.getpid(), threading.get_ident())
+        self.key = key
+        self.released = False
+        self.url = url
+        self.part = os.path.join(DOWNLOAD_DIR, key + ".part")
+        self.journal = os.path.join(DOWNLOAD_DIR, key + ".json")
+        self.etag = None
+        self.done = 0
+        self.sha256 = None
+        self.load()
+
+    # Load a previous journal, ignoring it if it does not match the .part file
+    def load(self):
+        try:
+            with open(self.journal, "r") as file:
+                data = json.load(file)
+            if data["url"] != self.url or os.path.getsize(self.part) < data["bytes"]:
+                return
+        except (FileNotFoundError, KeyError, json.decoder.JSONDecodeError):
+            return
+        self.etag, self.done, self.sha256 = data["etag"], data["bytes"], data["sha256"]
+
+    # Record that the first done bytes of the .part file hash to sha256
+    def save(self, etag, done, sha256):
+        self.etag, self.done, self.sha256 = etag, done, sha256
+        data = {"url": self.url, "etag": etag, "bytes": done, "sha256": sha256}
+        with open(self.journal, "w") as file:
+            json.dump(data, file, indent=4)
+
+    # Let other downloads of the same URL use this .part file again, or delete the
+    # .part file of a download that could not claim it
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        if self.lock:
+            self.lock.release()
+        else:
+            self.remove()
+
+    # Delete the .part file and its journal
+    def remove(self):
+        for path in (self.part, self.journal):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+# File-like download that tees the network stream into a .part file
+# An interrupted download is resumed with an HTTP Range request, replaying
+# the bytes already on disk first so the reader sees the whole archive
+class ResumableReader(HashingReader):
+    def __init__(self, url):
+        pathlib.Path(DOWNLOAD_DIR).mkdir(parents=True, exist_ok=True)
+        super().__init__(None)
+        self.url = url
+        self.partial = PartialDownload(url)
+        self.file = self.stream = None
+        self.interrupted = False
+        self.replay = None
+        self.written = 0
+        self.journaled = 0
+
+        try:
+            self.open()
+        except BaseException:
+            self.close()
+            raise
+
+    # Ask for the remainder, falling back to a full download if the server
+    # does not honor ranges or the resource changed since the .part file
+    def open(self):
+        resume = self.partial.done
+        try:
+            self.stream = self.request(resume, self.partial.etag)
+        except urllib.error.HTTPError:
+            if not resume:
+                raise
+            # Range not satisfiable, most likely a stale .part file
+            self.partial.remove()
+            resume = 0
+            self.stream = self.request()
+        if resume and self.stream.status != 206:
+            resume = 0
+        self.etag = self.stream.headers.get("ETag")
+
+        self.file = open(self.partial.part, "r+b" if resume else "wb")
+        self.file.truncate(resume)
+        self.file.seek(resume)
+        self.written = self.journaled = resume
+        if resume:
+            print_progress("Resuming download at %d bytes..." % resume)
+            self.replay = open(self.partial.part, "rb")
+
+    # Open the URL starting at offset
+    def request(self, offset=0, etag=None):
+        headers = {}
+        if offset:
+            headers["Range"] = "bytes=%d-" % offset
+            if etag:
+                headers["If-Range"] = etag
+        return urlopen(self.url, headers=headers)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = CHUNK_SIZE
+        chunk = self.read_replay(size) if self.replay else b""
+        if not chunk:
+            chunk = self.read_network(size)
+        self.hash.update(chunk)
+        self.size += len(chunk)
+        if self.written - self.journaled >= JOURNAL_INTERVAL:
+            self.suspend()
+        return chunk
+
+    # Read bytes already downloaded by a previous attempt
+    def read_replay(self, size):
+        chunk = self.replay.read(min(size, self.partial.done - self.size))
+        if chunk:
+            return chunk
+        self.replay.close()
+        self.replay = None
+        if self.hash.hexdigest() != self.partial.sha256:
+            raise DependencyError("Partial download of %s is corrupt!" % self.url)
+        return b""
+
+    # Read from the network, resuming with a Range request if the connection drops
+    def read_network(self, size):
+        attempt = 0
+        while True:
+            try:
+                chunk = self.stream.read(size)
+                # A dropped connection reads as EOF before Content-Length is met
+                if not chunk and self.stream.length:
+                    raise http.client.IncompleteRead(b"", self.stream.length)
+                break
+            except NETWORK_ERRORS as error:
+                attempt += 1
+                if attempt > NEOPO_RETRIES:
+                    self.interrupted = True
+                    raise urllib.error.URLError(error) from error
+                print_progress(
+                    "Connection lost, resuming at %d bytes..." % self.written
+                )
+                self.stream.close()
+                time.sleep(attempt)
+                try:
+                    self.stream = self.request(self.written, self.etag)
+                except BaseException:
+                    # The bytes on disk can still be resumed by a later attempt
+                    self.interrupted = True
+                    raise
+                if self.stream.status != 206:
+                    self.interrupted = True
+                    raise urllib.error.URLError(
+                        "Server does not support resuming!"
+                    ) from error
+
+        self.file.write(chunk)
+        self.written += len(chunk)
+        return chunk
+
+    # Flush the .part file and journal how much of it is valid
+    def suspend(self):
+        self.file.flush()
+        self.partial.save(self.etag, self.written, self.hash.hexdigest())
+        self.journaled = self.written
+
+    def close_files(self):
+        for file in (self.replay, self.file, self.stream):
+            if file:
+                file.close()
+
+    def close(self):
+        self.close_files()
+        self.partial.release()
+
+    # Keep the .part file if the download was interrupted, otherwise delete it
+    # A complete download matching the expected sha256 is moved into the store
+    def finish(self, dep=None):
+        # Only journal once every byte on disk has also been hashed
+        if self.interrupted and self.size == self.written:
+            self.suspend()
+        self.close_files()
+        # Keep the .part file claimed until it has been moved or deleted
+        try:
+            if self.interrupted:
+                return
+            if dep and self.size == self.written and self.hexdigest() == dep["sha256"]:
+                store_artifact(self.partial.part, dep["sha256"], dep)
+            self.partial.remove()
+        finally:
+            self.partial.release()
+
+
+# Find the size of a resource if the server supports range requests
+def probe_ranges(url):
+    with urlopen(url, headers={"Range": "bytes=0-0"}) as response:
+        if response.status != 206:
+            return None
+        response.read()
+        # Content-Range: bytes 0-0/<size>
+        try:
+            return int(response.headers.get("Content-Range", "").rsplit("/", 1)[1])
+        except (IndexError, ValueError):
+            return None
+
+
+# Fetch bytes start to end (inclusive) of url into the same offset of path
+def fetch_segment(url, path, start, end):
+    offset = start
+    attempt = 0
+    with open(path, "r+b") as file:
+        file.seek(offset)
+        while offset <= end:
+            headers = {"Range": "bytes=%d-%d" % (offset, end)}
+            try:
+                with urlopen(url, headers=headers) as response:
+                    if response.status != 206:
+                        raise DependencyError("Server ignored range request!")
+                    for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                        file.write(chunk)
+                        offset += len(chunk)
+            except NETWORK_ERRORS as error:
+                attempt += 1
+                if attempt > NEOPO_RETRIES:
+                    raise urllib.error.URLError(error) from error
+                time.sleep(attempt)
+                file.seek(offset)
+                continue
+            # A dropped connection can look like a short but complete response
+            if offset <= end:
+                attempt += 1
+                if attempt > NEOPO_RETRIES:
+                    raise urllib.error.URLError(
+                        "Segment %d-%d incomplete!" % (start, end)
+                    )
+
+
+# Download size bytes of url into a preallocated file using several connections
+def download_segmented(url, path, size, segments):
+    with open(path, "wb") as file:
+        file.truncate(size)
+    step = -(-size // segments)
+    bounds = [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+        jobs = [executor.submit(fetch_segment, url, path, *bound) for bound in bounds]
+        for job in jobs:
+            job.result()
+
+
+# Download a large archive in NEOPO_SEGMENTS byte ranges, verify it, then extract it
+# Returns None if the server does not support ranges or the archive is small
+def segmented_to_staging(url, path, dep, select=None):
+    size = probe_ranges(url)
+    if not size or size < SEGMENT_THRESHOLD:
+        return None
+
+    pathlib.Path(DOWNLOAD_DIR).mkdir(parents=True, exist_ok=True)
+    handle, archive = tempfile.mkstemp(dir=DOWNLOAD_DIR, suffix=".segments")
+    os.close(handle)
+    try:
+        download_segmented(url, archive, size, NEOPO_SEGMENTS)
+
+        # Check the sha256 from the catalog before extracting anything
+        content_sha256 = hash_file(archive)
+        if content_sha256 != dep["sha256"]:
+            raise DependencyError(
+                "SHA256 mismatch for %s@%s!" % (dep["name"], dep["version"])
+            )
+        staging = make_staging(path)
+        try:
+            with open(archive, "rb") as file:
+                extract_stream(file, staging, select, True)
+        except BaseException:
+            discard_staging(staging)
+            raise
+        store_artifact(archive, content_sha256, dep)
+        return staging, content_sha256
+    finally:
+        if os.path.isfile(archive):
+            os.remove(archive)
+
+
+# Extract an archive from the artifact store into a staging directory
+# Returns None if the stored archive is corrupt so it can be downloaded again
+# Errors writing the staging directory are raised, the archive is not to blame
+def extract_artifact(artifact, path, sha256, select=None):
+    # Another process may have evicted the archive since it was found
+    try:
+        file = open(artifact, "rb")
+    except FileNotFoundError:
+        return None
+    with file:
+        staging = make_staging(path)
+        reader = HashingReader(file)
+        try:
+            extract_stream(reader, staging, select, True)
+            reader.drain()
+            corrupt = reader.hexdigest() != sha256
+        except (tarfile.TarError, EOFError):
+            corrupt = True
+        except BaseException:
+            discard_staging(staging)
+            raise
+    if not corrupt:
+        return staging
+    discard_staging(staging)
+    remove_artifact(sha256)
+    return None
+
+
+# Download a tarball and extract it into a staging directory in one pass
+# The download goes through NEOPO_MIRROR if one is configured
+# Returns the staging directory and the sha256 of the downloaded archive
+# If dep is given its archive is taken from, or added to, the artifact store
+# and the file index of the extracted files is written to the staging directory
+# If select is given, only the members whose names it accepts are extracted
+def stream_to_staging(url, path, dep=None, select=None):
+    url = mirror_url(url)
+    artifact = find_artifact(dep["sha256"]) if dep else None
+    if artifact:
+        staging = extract_artifact(artifact, path, dep["sha256"], select)
+        if staging:
+            return staging, dep["sha256"]
+
+    # Opt-in: fetch large archives over several connections
+    # Only archives with a known sha256 (not unlisted releases) can be verified
+    if NEOPO_SEGMENTS > 1 and dep and dep["sha256"] != "SKIP":
+        result = segmented_to_staging(url, path, dep, select)
+        if result:
+            return result
+
+    staging = make_staging(path)
+    reader = None
+    try:
+        reader = ResumableReader(url)
+        extract_stream(reader, staging, select, dep is not None)
+        reader.drain()
+    except BaseException as error:
+        if reader and isinstance(error, KeyboardInterrupt):
+            reader.interrupted = True
+        discard_staging(staging)
+        if reader:
+            reader.finish()
+        raise
+    reader.finish(dep)
+    return staging, reader.hexdigest()
+
+
+# Download and extract a tarball to path, only committing it if sha256 matches
+def stream_install(url, path, sha256=None):
+    staging, actual = stream_to_staging(url, path)
+    if sha256 and actual != sha256:
+        discard_staging(staging)
+        return False
+    commit_staging(staging, path)
+    return True
+
+
+# Make sure the archive of a dependency is in the artifact store, downloading it if needed
+# Returns the path of the stored archive
+def fetch_artifact(dep):
+    artifact = find_artifact(dep["sha256"])
+    if artifact:
+        return artifact
+
+    reader = None
+    try:
+        reader = ResumableReader(mirror_url(dep["url"]))
+        reader.drain()
+    except BaseException as error:
+        if reader and isinstance(error, KeyboardInterrupt):
+            reader.interrupted = True
+        if reader:
+            reader.finish()
+        raise
+    reader.finish(dep)
+
+    artifact = find_artifact(dep["sha256"])
+    if not artifact:
+        raise DependencyError(
+            "SHA256 mismatch for %s@%s!" % (dep["name"], dep["version"])
+        )
+    return artifact
@@ -0,0 +1,314 @@
+import concurrent.futures
+import hashlib
+import os
+import shutil
+import subprocess
+import tarfile
+import threading
+
+# Size of the chunks moved between the archive, decompressor and tarfile
+CHUNK_SIZE = 64 * 1024
+
+# Number of threads writing extracted files (files are written inline with one)
+EXTRACT_WORKERS = min(8, os.cpu_count() or 1)
+
+# Bytes of file contents that may be waiting to be written at once
+WRITE_BUDGET = 64 * 1024 * 1024
+
+# Files larger than this are written directly instead of by a worker
+LARGE_FILE = 8 * 1024 * 1024
+
+# External decompressors (by archive magic), fastest first
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+DECOMPRESSORS = {
+    GZIP_MAGIC: [["pigz", "-dc"], ["gzip", "-dc"]],
+    ZSTD_MAGIC: [["zstd", "-dc", "-T0"]],
+}
+
+
+# Stream wrapper that lets the first bytes be inspected without consuming them
+class PeekableStream:
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = b""
+
+    def peek(self, size):
+        while len(self.buffer) < size:
+            chunk = self.stream.read(size - len(self.buffer))
+            if not chunk:
+                break
+            self.buffer += chunk
+        return self.buffer[:size]
+
+    def read(self, size=-1):
+        if self.buffer:
+            chunk = self.buffer if size < 0 else self.buffer[:size]
+            self.buffer = self.buffer[len(chunk) :]
+            return chunk
+        return self.stream.read(size)
+
+
+# Find an installed external decompressor for an archive
+# Running it in another process only pays off with more than one core
+def find_decompressor(magic):
+    if (os.cpu_count() or 1) < 2:
+        return None
+    for command in DECOMPRESSORS.get(magic, []):
+        if shutil.which(command[0]):
+            return command
+    return None
+
+
+# Decompress a stream with an external program, feeding it from a thread
+class ExternalDecompressor:
+    def __init__(self, command, stream):
+        self.stream = stream
+        self.error = None
+        self.process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        self.feeder = threading.Thread(target=self.feed, daemon=True)
+        self.feeder.start()
+
+    @property
+    def stdout(self):
+        return self.process.stdout
+
+    # Copy the compressed stream into the decompressor
+    def feed(self):
+        try:
+            for chunk in iter(lambda: self.stream.read(CHUNK_SIZE), b""):
+                self.process.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        except BaseException as error:
+            self.error = error
+        finally:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    # Wait for the decompressor, raising errors from the input stream first
+    def finish(self):
+        # Read trailing padding so the decompressor can exit
+        while self.process.stdout.read(CHUNK_SIZE):
+            pass
+        self.feeder.join()
+        self.process.wait()
+        if self.error:
+            raise self.error
+        if self.process.returncode != 0:
+            raise tarfile.ReadError("Failed to decompress archive!")
+
+    def abort(self):
+        self.process.kill()
+        self.process.wait()
+        self.feeder.join()
+        self.process.stdout.close()
+        if self.error:
+            raise self.error
+
+
+# Whether target resolves to a path inside the destination path
+def is_inside(target, path):
+    path = os.path.realpath(path)
+    return os.path.commonpath([os.path.realpath(target), path]) == path
+
+
+# Path a link member points to once extracted into path
+def link_source(member, path):
+    if member.issym():
+        return os.path.join(path, os.path.dirname(member.name), member.linkname)
+    return os.path.join(path, member.linkname)
+
+
+# Apply tarfile's data filter: no absolute paths, escapes, special bits, or links
+# pointing outside the destination
+def check_member(member, path):
+    if hasattr(tarfile, "data_filter"):
+        return tarfile.data_filter(member, path)
+    if not is_inside(os.path.join(path, member.name), path):
+        raise tarfile.TarError("Member %s is outside the destination!" % member.name)
+    if member.issym() or member.islnk():
+        if os.path.isabs(member.linkname) or not is_inside(
+            link_source(member, path), path
+        ):
+            raise tarfile.TarError("Link %s is outside the destination!" % member.name)
+    return member
+
+
+# Key of a member in the file index: its normalized path with / separators
+def index_name(name):
+    return os.path.normpath(name).replace(os.sep, "/")
+
+
+# Write one regular file and apply its permissions and modification time
+# Returns the sha256 of the contents for the file index
+def write_member(target, content, mode, mtime):
+    with open(target, "wb") as file:
+        file.write(content)
+    os.chmod(target, mode)
+    os.utime(target, (mtime, mtime))
+    return hashlib.sha256(content).hexdigest()
+
+
+# Extract a tar stream, writing files from several threads
+# If select is given, only the members whose names it accepts are extracted
+# The size, mtime and sha256 of every extracted file are collected in index
+class ParallelExtractor:
+    def __init__(self, path, select=None):
+        self.path = path
+        self.select = select
+        self.index = {}
+        self.links = []
+        self.directories = []
+        self.errors = []
+        self.budget = threading.BoundedSemaphore(WRITE_BUDGET // CHUNK_SIZE)
+        self.executor = None
+        if EXTRACT_WORKERS > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=EXTRACT_WORKERS
+            )
+
+    def target(self, member):
+        return os.path.join(self.path, member.name)
+
+    # Record a written file in the index
+    def add_to_index(self, member, sha256):
+        self.index[index_name(member.name)] = [member.size, int(member.mtime), sha256]
+
+    # Release the budget of a finished write and remember if it failed
+    def finished(self, job, member, units):
+        for _ in range(units):
+            self.budget.release()
+        if job.exception():
+            self.errors.append(job.exception())
+        else:
+            self.add_to_index(member, job.result())
+
+    # Raise the first error of any finished write
+    def collect(self):
+        if self.errors:
+            raise self.errors[0]
+
+    def extract(self, tar):
+        try:
+            for member in tar:
+                if self.select and not self.select(member.name):
+                    continue
+                member = check_member(member, self.path)
+                if member is None:
+                    continue
+                target = self.target(member)
+                if member.isdir():
+                    os.makedirs(target, exist_ok=True)
+                    self.directories.append(member)
+                elif member.isfile():
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    self.extract_file(tar, member, target)
+                elif member.issym() or member.islnk():
+                    # Links are created last so no file is written through one
+                    self.links.append(member)
+                self.collect()
+        finally:
+            if self.executor:
+                self.executor.shutdown(wait=True)
+        self.collect()
+        self.extract_links()
+        self.finish_directories()
+        return self.index
+
+    def extract_file(self, tar, member, target):
+        source = tar.extractfile(member)
+        if member.size > LARGE_FILE or not self.executor:
+            digest = hashlib.sha256()
+            with open(target, "wb") as file:
+                for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    file.write(chunk)
+            os.chmod(target, member.mode)
+            os.utime(target, (member.mtime, member.mtime))
+            self.add_to_index(member, digest.hexdigest())
+            return
+
+        # Reserve room in the write budget before holding the contents in memory
+        units = max(1, member.size // CHUNK_SIZE)
+        for _ in range(units):
+            self.budget.acquire()
+        content = source.read()
+        job = self.executor.submit(
+            write_member, target, content, member.mode, member.mtime
+        )
+        job.add_done_callback(lambda job: self.finished(job, member, units))
+
+    def extract_links(self):
+        for member in self.links:
+            target = self.target(member)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # A directory already extracted in place of the link wins
+            if os.path.isdir(target) and not os.path.islink(target):
+                continue
+            # Check again now that the links before this one exist
+            source = link_source(member, self.path)
+            if os.path.isabs(member.linkname) or not is_inside(source, self.path):
+                raise tarfile.TarError(
+                    "Link %s is outside the destination!" % member.name
+                )
+            if os.path.lexists(target):
+                os.remove(target)
+            if member.issym():
+                try:
+                    os.symlink(member.linkname, target)
+                    continue
+                except (OSError, NotImplementedError):
+                    # Symlinks may be unavailable (Windows), copy the target
+                    pass
+            else:
+                # A hard link has the contents of the file it links to
+                linked = self.index.get(index_name(member.linkname))
+                if linked:
+                    self.index[index_name(member.name)] = linked
+                try:
+                    os.link(source, target)
+                    continue
+                except OSError:
+                    pass
+            if os.path.isfile(source):
+                shutil.copy2(source, target)
+
+    # Apply directory permissions last, deepest first, like tarfile does
+    def finish_directories(self):
+        self.directories.sort(key=lambda member: member.name, reverse=True)
+        for member in self.directories:
+            target = self.target(member)
+            # The data filter leaves the mode of directories to the umask
+            if member.mode is not None:
+                os.chmod(target, member.mode)
+            os.utime(target, (member.mtime, member.mtime))
+
+
+# Extract a compressed tar stream into path
+# Decompression is handed to pigz/zstd when installed and files are
+# written by a pool of threads, with tarfile's data filter checks
+# Returns the file index of the extracted files
+def extract_archive(stream, path, select=None):
+    stream = PeekableStream(stream)
+    magic = stream.peek(4)
+    command = find_decompressor(magic[:2]) or find_decompressor(magic)
+
+    if not command:
+        mode = "r|gz" if magic.startswith(GZIP_MAGIC) else "r|*"
+        with tarfile.open(fileobj=stream, mode=mode) as tar:
+            return ParallelExtractor(path, select).extract(tar)
+
+    decompressor = ExternalDecompressor(command, stream)
+    try:
+        with tarfile.open(fileobj=decompressor.stdout, mode="r|") as tar:
+            index = ParallelExtractor(path, select).extract(tar)
+    except BaseException:
+        decompressor.abort()
+        raise
+    decompressor.finish()
+    return index
@@ -0,0 +1,68 @@
+import concurrent.futures
+import json
+import os
+
+# Local imports
+from .store import hash_file
+
+# Index of the files of an installed dependency: {path: [size, mtime, sha256]}
+# It is written when the dependency is installed and checked by neopo verify
+FILE_INDEX = ".neopo-file-index.json"
+
+# Number of files hashed at once (hashlib releases the GIL)
+HASH_WORKERS = os.cpu_count() or 1
+
+
+# Load the file index of an installed dependency, or None if it has none
+def load_file_index(path):
+    try:
+        with open(os.path.join(path, FILE_INDEX), "r") as file:
+            return json.load(file)["files"]
+    except (FileNotFoundError, KeyError, TypeError, json.decoder.JSONDecodeError):
+        return None
+
+
+# Write the file index of a dependency, replacing any previous one in one step
+def save_file_index(path, files):
+    index = os.path.join(path, FILE_INDEX)
+    temp = "%s.%d.tmp" % (index, os.getpid())
+    with open(temp, "w") as file:
+        json.dump({"files": files}, file)
+    os.replace(temp, index)
+
+
+# Add entries to the file index of a dependency
+def update_file_index(path, files):
+    index = load_file_index(path) or {}
+    index.update(files)
+    save_file_index(path, index)
+
+
+# Hash a list of files in parallel, returning None for files that cannot be read
+def hash_files(paths):
+    def hash_or_none(path):
+        try:
+            return hash_file(path)
+        except OSError:
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+        return list(executor.map(hash_or_none, paths))
+
+
+# Index every regular file of a tree that was not installed from an archive
+def build_file_index(path):
+    entries = []
+    for root, _, names in os.walk(path):
+        for name in names:
+            target = os.path.join(root, name)
+            relative = os.path.relpath(target, path).replace(os.sep, "/")
+            if relative == FILE_INDEX or os.path.islink(target):
+                continue
+            entries.append((relative, os.stat(target)))
+    hashes = hash_files([os.path.join(path, relative) for relative, _ in entries])
+    return {
+        relative: [stat.st_size, int(stat.st_mtime), sha256]
+        for (relative, stat), sha256 in zip(entries, hashes, strict=True)
+        if sha256
+    }
@@ -28,12 +28,60 @@ help_commands = {
     "versions": ["List downloadable Device OS versions and their supported platforms"],
     "get": [
         "Download a specific Device OS version and required toolchains",
-        "<version>",
+        "<version> [platforms...|all]",
     ],
     "remove": [
         "Delete a specific Device OS version from ~/.particle/toolchains",
         "<version>",
     ],
+    "cache": [
+        "List, verify, or prune the shared store of downloaded toolchain archives",
+        "[command]",
+        [
+            ("list", "\tList stored archives (default)"),
+            ("verify", "Rehash stored archives and remove corrupt ones"),
+            ("prune", "Evict least recently used archives [size in MiB]"),
+        ],
+    ],
+    "ccache": [
+        "Show statistics of, or clear, the cache of compiled objects (see NEOPO_CCACHE)",
+        "[command]",
+        [
+            ("stats", "Show hits, misses, and size of the cache (default)"),
+            ("clear", "Remove every cached object"),
+        ],
+    ],
+    "bundle": [
+        "Export or import an offline bundle of toolchains for hosts without internet access",
+        "<command> <file> [versions...]",
+        [
+            (
+                "export",
+                "Write the catalog, toolchains, and particle binary for versions",
+            ),
+            ("import", "Install everything in a bundle without using the network"),
+        ],
+    ],
+    "dedupe": [
+        "Share identical files between installed toolchains and Device OS versions",
+        "[--full]",
+    ],
+    "verify": [
+        "Check installed toolchains and Device OS versions for missing or modified files",
+        "[--deep]",
+    ],
+    "gc": [
+        "Remove the least recently used toolchains and Device OS versions no project uses",
+        "[--dry-run] <size|--all> [roots...]",
+    ],
+    "serve": [
+        "Serve the catalog, toolchains, and libraries to other machines (see NEOPO_MIRROR)",
+        "[port] [address]",
+    ],
+    "daemon": [
+        "Keep toolchains resolved in memory and run the builds of this installation",
+        "[jobs]",
+    ],
     "particle": [
         "Access Particle CLI to run particle commands. (Also available as `particle`)",
         "[options] [command...]",
@@ -92,7 +140,9 @@ help_commands = {
     "configure": [
         """Change the platform and Device OS version used in a project, verifying
 compatibility and downloading toolchains if necessary. If used with a basic
-Particle CLI project, the project is upgraded with Workbench and neopo support.\n""",
+Particle CLI project, the project is upgraded with Workbench and neopo support.
+The resolved toolchain and libraries are pinned in neopo.lock, which builds trust
+until the project changes.\n""",
         "<platform> <version> [project]",
     ],
     "run": [
@@ -124,9 +174,21 @@ making it possible to use the Particle toolchains without requiring neopo.\n""",
     ],
     "libs": [
         """Parse the project.properties file in a Particle project and install specified
-libraries in the lib/ directory of the current or specified project.\n""",
+libraries in the lib/ directory of the current or specified project, then update
+the neopo.lock of the project.\n""",
         "[project]",
     ],
+    "workspace": [
+        """Build, clean, or install the libraries of every Particle project found under a
+directory (the current directory by default). Projects are built in parallel
+within one budget of jobs (NEOPO_MAKE_JOBS), and each toolchain is prepared once.\n""",
+        "<command> [root]",
+        [
+            ("build", "Compile every project"),
+            ("clean", "Clean every project"),
+            ("libs", "Install the libraries of every project"),
+        ],
+    ],
     # Special commands
     "bootloader": [
         """Build and flash the bootloader for a specific platform and Device OS version.
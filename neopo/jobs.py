@@ -0,0 +1,89 @@
+import math
+import os
+import re
+
+# Local imports
+from .common import UserError
+
+# Jobserver of an outer GNU make that hands its pipe to child processes
+JOBSERVER_FDS = re.compile(r"--jobserver-(?:auth|fds)=(\d+),(\d+)")
+
+# Jobserver of an outer GNU make 4.4+ that uses a named pipe
+JOBSERVER_FIFO = re.compile(r"--jobserver-auth=fifo:")
+
+# A -j option set in MAKEFLAGS by the user or an outer make
+MAKEFLAGS_JOBS = re.compile(r"(^|\s)-j\d*(\s|$)")
+
+
+# CPU quota of the cgroup of this process (cgroup v2, then v1), or None
+def cgroup_cpu_quota():
+    try:
+        with open("/sys/fs/cgroup/cpu.max", "r") as file:
+            quota, period = file.read().split()[:2]
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "r") as file:
+                quota = file.read().strip()
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us", "r") as file:
+                period = file.read().strip()
+        except OSError:
+            return None
+    if quota in ["max", "-1"]:
+        return None
+    try:
+        return max(1, math.ceil(int(quota) / int(period)))
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+# Number of CPUs this process may use, given its affinity and cgroup quota
+def available_cpus():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_quota()
+    return min(cpus, quota) if quota else cpus
+
+
+# Number of jobs make runs a build with. Set NEOPO_MAKE_JOBS in the environment
+# of the build to override the CPUs available. Example:
+# NEOPO_MAKE_JOBS=1 neopo build
+def make_jobs(environ):
+    try:
+        jobs = int(environ.get("NEOPO_MAKE_JOBS") or 0)
+    except ValueError as error:
+        raise UserError("NEOPO_MAKE_JOBS must be a number!") from error
+    return jobs if jobs > 0 else available_cpus()
+
+
+# How an outer make (neopo being run by make) schedules the jobs of a build:
+# - None: it does not, and neopo picks the number of jobs
+# - (): through MAKEFLAGS alone (a named pipe, or a -j option)
+# - (read fd, write fd): through a pipe that must be passed to make
+def outer_jobserver(environ):
+    flags = environ.get("MAKEFLAGS", "")
+    match = JOBSERVER_FDS.search(flags)
+    if match:
+        fds = tuple(int(fd) for fd in match.groups())
+        try:
+            for fd in fds:
+                os.fstat(fd)
+            return fds
+        except OSError:
+            # The outer make did not share its pipe (its recipe lacks a +)
+            return None
+    if JOBSERVER_FIFO.search(flags) or MAKEFLAGS_JOBS.search(flags):
+        return ()
+    return None
+
+
+# Make a build process run in parallel: make joins the jobserver of an outer make
+# if neopo is run by one, or is given the number of jobs
+def parallel_make(process, environ):
+    if outer_jobserver(environ) is not None:
+        return
+    # A pipe the outer make did not share would only earn a warning from make
+    if "MAKEFLAGS" in environ:
+        environ["MAKEFLAGS"] = JOBSERVER_FDS.sub("", environ["MAKEFLAGS"]).strip()
+    process.insert(3, "-j%d" % make_jobs(environ))
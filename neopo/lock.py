@@ -0,0 +1,93 @@
+import os
+import pathlib
+import threading
+
+# Local imports
+from .common import LOCK_DIR
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Threads of one process take a thread lock first, so only one of them waits on the file
+thread_locks = {}
+thread_locks_lock = threading.Lock()
+
+
+# Exclusive lock shared by every neopo process using the same installation
+# Without fcntl (Windows) it only serializes the threads of this process
+class FileLock:
+    def __init__(self, name, message=None):
+        self.path = os.path.join(LOCK_DIR, name + ".lock")
+        self.message = message
+        self.file = None
+        with thread_locks_lock:
+            self.thread_lock = thread_locks.setdefault(self.path, threading.Lock())
+
+    def acquire(self):
+        if not self.thread_lock.acquire(blocking=False):
+            if self.message:
+                print(self.message)
+            self.thread_lock.acquire()
+        if not fcntl:
+            return
+        try:
+            pathlib.Path(LOCK_DIR).mkdir(parents=True, exist_ok=True)
+            self.file = open(self.path, "a")
+            try:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if self.message:
+                    print(self.message)
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        except BaseException:
+            self.release()
+            raise
+
+    # Take the lock only if no other thread or process holds it
+    # Returns whether the lock was taken
+    def try_acquire(self):
+        if not self.thread_lock.acquire(blocking=False):
+            return False
+        if not fcntl:
+            return True
+        try:
+            pathlib.Path(LOCK_DIR).mkdir(parents=True, exist_ok=True)
+            self.file = open(self.path, "a")
+            try:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.release()
+                return False
+        except BaseException:
+            self.release()
+            raise
+        return True
+
+    def release(self):
+        if self.file:
+            # Closing the file releases the lock
+            self.file.close()
+            self.file = None
+        self.thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+# Lock held while a dependency is installed, so it is only installed once
+def dependency_lock(name, version):
+    return FileLock(
+        "%s@%s" % (name, version),
+        "Waiting for another neopo process to install %s@%s..." % (name, version),
+    )
+
+
+# Lock held while a shared file (manifest, caches, receipts) is rewritten
+def file_lock(path):
+    return FileLock(os.path.basename(path))
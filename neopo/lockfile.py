@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+
+# Local imports
+from .common import PARTICLE_DEPS, projectFiles
+from .fileindex import hash_files
+from .workbench import INSTALL_RECEIPT
+
+# Lockfile of a project, pinning its toolchain and libraries
+# It is written by neopo configure and neopo libs, and is meant to be committed
+LOCKFILE = "neopo.lock"
+
+# Toolchain dependencies pinned by a lockfile
+LOCKED_DEPS = ["gcc-arm", "buildscripts", "buildtools", "deviceOS"]
+
+
+# Files of a project that the resolution in a lockfile depends on
+def lockfile_inputs(libraries):
+    inputs = [projectFiles["properties"], projectFiles["settings"]]
+    inputs.extend(
+        os.path.join("lib", name, "library.properties") for name in sorted(libraries)
+    )
+    return [path.replace(os.sep, "/") for path in inputs]
+
+
+# Hash the files of a library, independent of where and when it was installed
+def library_sha256(path):
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in sorted(names):
+            files.append(os.path.join(root, name))
+    digest = hashlib.sha256()
+    for file, sha256 in zip(files, hash_files(files), strict=True):
+        relative = os.path.relpath(file, path).replace(os.sep, "/")
+        digest.update(("%s\0%s\n" % (relative, sha256)).encode())
+    return digest.hexdigest()
+
+
+# Write the lockfile of a project
+# toolchain: {name: [version, archive sha256]}, libraries: {name: version}
+def save_lockfile(project_path, platform, toolchain, libraries, flags):
+    lock = {
+        "platform": platform,
+        "toolchain": {
+            name: {"version": version, "sha256": sha256}
+            for name, (version, sha256) in toolchain.items()
+        },
+        "libraries": {
+            name: {
+                "version": version,
+                "sha256": library_sha256(os.path.join(project_path, "lib", name)),
+            }
+            for name, version in libraries.items()
+        },
+        "EXTRA_CFLAGS": flags,
+    }
+    inputs = lockfile_inputs(libraries)
+    hashes = hash_files([os.path.join(project_path, path) for path in inputs])
+    lock["inputs"] = dict(zip(inputs, hashes, strict=True))
+
+    path = os.path.join(project_path, LOCKFILE)
+    temp = "%s.%d.tmp" % (path, os.getpid())
+    with open(temp, "w") as file:
+        json.dump(lock, file, indent=4, sort_keys=True)
+        file.write("\n")
+    os.replace(temp, path)
+
+
+# Load the lockfile of a project if it can be trusted without resolving anything
+# It is trusted while no input changed since it was written and its toolchain is
+# still installed. Inputs modified after the lockfile are hashed, and if their
+# contents are unchanged the lockfile is touched so the next build only stats them
+# Returns None if the project must be resolved again
+def load_lockfile(project_path):
+    path = os.path.join(project_path, LOCKFILE)
+    try:
+        written = os.stat(path).st_mtime_ns
+        with open(path, "r") as file:
+            lock = json.load(file)
+        inputs = lock["inputs"]
+        toolchain = {name: lock["toolchain"][name]["version"] for name in LOCKED_DEPS}
+        platform = lock["platform"]
+    except (OSError, KeyError, TypeError, json.decoder.JSONDecodeError):
+        return None
+
+    suspects = []
+    touch = False
+    for relative, sha256 in inputs.items():
+        try:
+            modified = os.stat(os.path.join(project_path, relative)).st_mtime_ns
+        except OSError:
+            return None
+        if modified >= written:
+            suspects.append((relative, sha256))
+
+    for name, version in toolchain.items():
+        receipt = os.path.join(PARTICLE_DEPS, name, version, INSTALL_RECEIPT)
+        try:
+            modified = os.stat(receipt).st_mtime_ns
+        except OSError:
+            return None
+        # A reinstalled deviceOS release may lack the files of this platform
+        if name == "deviceOS" and modified >= written:
+            try:
+                with open(receipt, "r") as file:
+                    platforms = json.load(file).get("platforms")
+            except (OSError, AttributeError, json.decoder.JSONDecodeError):
+                return None
+            if platforms and platform not in platforms:
+                return None
+            touch = True
+
+    if suspects:
+        paths = [os.path.join(project_path, relative) for relative, _ in suspects]
+        if hash_files(paths) != [sha256 for _, sha256 in suspects]:
+            return None
+        touch = True
+    if touch:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    lock["toolchain"] = toolchain
+    return lock
+
+
+# Check whether a project has a lockfile (stale or not)
+def has_lockfile(project_path):
+    return os.path.isfile(os.path.join(project_path, LOCKFILE))
@@ -1,41 +1,86 @@
 import json
 import os
+import threading
 
 # Local imports
 from .common import jsonFiles
+from .lock import file_lock
 from .utility import handle_missing_file
 
+# Parsed manifest, with the file it was parsed from: (inode, mtime, size)
+manifest_cache = {"stamp": None, "data": None}
+manifest_cache_lock = threading.Lock()
 
-# Update the manifest JSON file
-def write_manifest(dep):
-    with open(jsonFiles["manifest"], "r+") as file:
+
+# Read the manifest, parsing it again only if the file changed since the last read
+# Returns None if it is empty or invalid; raises FileNotFoundError if it is missing
+def read_manifest():
+    stat = os.stat(jsonFiles["manifest"])
+    stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    with manifest_cache_lock:
+        if manifest_cache["stamp"] != stamp:
+            with open(jsonFiles["manifest"], "r") as file:
+                try:
+                    data = json.load(file)
+                except json.decoder.JSONDecodeError:
+                    data = None
+            manifest_cache.update(stamp=stamp, data=data)
+        data = manifest_cache["data"]
+    return dict(data) if data is not None else None
+
+
+# Apply a batch of updates ({name: version}) to the manifest in one atomic write
+# The read-modify-write is locked against other neopo processes, and the file is
+# replaced with a rename so a reader never sees it half written
+def update_manifest(changes):
+    path = jsonFiles["manifest"]
+    with file_lock(path):
         try:
-            manifest = json.load(file)
-        except json.decoder.JSONDecodeError:
+            manifest = read_manifest() or {}
+        except FileNotFoundError:
             manifest = {}
+        manifest.update(changes)
+
+        temp = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            with open(temp, "w") as file:
+                json.dump(manifest, file, indent=4)
+            os.replace(temp, path)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+        # This process already knows what it wrote
+        stat = os.stat(path)
+        with manifest_cache_lock:
+            manifest_cache.update(
+                stamp=(stat.st_ino, stat.st_mtime_ns, stat.st_size), data=manifest
+            )
+
+
+# Update the manifest JSON file
+def write_manifest(dep):
+    write_manifest_entries([dep])
 
-        manifest[dep["name"]] = dep["version"]
-        file.seek(0)
-        json.dump(manifest, file, indent=4)
-        file.truncate()
 
+# Update the manifest JSON file with several dependencies in one write
+def write_manifest_entries(deps):
+    update_manifest({dep["name"]: dep["version"] for dep in deps})
 
-# Create the manifest file
+
+# Create the manifest file (without truncating one another process just wrote)
 def create_manifest():
     if not os.path.isfile(jsonFiles["manifest"]):
-        open(jsonFiles["manifest"], "w")
+        open(jsonFiles["manifest"], "a").close()
 
 
 def get_manifest_value(key):
     try:
-        with open(jsonFiles["manifest"], "r") as file:
-            try:
-                data = json.load(file)
-            except json.decoder.JSONDecodeError:
-                return None
-            return data[key]
+        data = read_manifest()
     except FileNotFoundError as error:
         handle_missing_file(error.filename)
+    return data[key] if data is not None else None
 
 
 def get_cached_json(key):
@@ -54,14 +99,12 @@ def get_cached_json(key):
 
 # Load settings from the dependency mainfest JSON file
 def load_manifest():
-    with open(jsonFiles["manifest"], "r") as file:
-        try:
-            data = json.load(file)
-        except json.decoder.JSONDecodeError:
-            return None
-        return (
-            data["gcc-arm"],
-            data["buildscripts"],
-            data["buildtools"],
-            data["deviceOS"],
-        )
+    data = read_manifest()
+    if data is None:
+        return None
+    return (
+        data["gcc-arm"],
+        data["buildscripts"],
+        data["buildtools"],
+        data["deviceOS"],
+    )
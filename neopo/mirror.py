@@ -0,0 +1,383 @@
+import contextlib
+import hashlib
+import http.server
+import json
+import os
+import pathlib
+import re
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+
+# Local imports
+from .common import (
+    ARM_GCC_ARM,
+    MIRROR_DIR,
+    MIRROR_LIMIT,
+    DependencyError,
+    UserError,
+    jsonFiles,
+    s3_bucket,
+    vscodeFiles,
+)
+from .download import CHUNK_SIZE, fetch_artifact
+from .session import session
+from .workbench import CATALOG_KEYS, PARTICLE_MANIFEST
+
+# Default port of neopo serve
+MIRROR_PORT = 8088
+
+# Catalogs that list toolchains per system and architecture
+TOOLCHAIN_KEYS = ["compilers", "tools", "scripts", "debuggers"]
+
+# Hosts that are always mirrored, besides those of catalog dependencies
+MIRROR_HOSTS = ["binaries.particle.io", "github.com"]
+
+
+# Load the JSON caches the mirror serves and takes its dependencies from
+def load_catalog():
+    catalog = {}
+    for key in CATALOG_KEYS:
+        try:
+            with open(jsonFiles[key], "r") as file:
+                catalog[key] = json.load(file)
+        except (FileNotFoundError, json.decoder.JSONDecodeError) as error:
+            raise DependencyError(
+                "The mirror needs the dependency catalog! Please run `neopo install`."
+            ) from error
+    return catalog
+
+
+# Identify the JSON caches the catalog is loaded from, to notice neopo update
+def catalog_stamp():
+    stamps = []
+    for key in CATALOG_KEYS:
+        try:
+            stat = os.stat(jsonFiles[key])
+            stamps.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            stamps.append(None)
+    return stamps
+
+
+# Map the URL of every dependency in the catalog to the dependency
+def catalog_deps(catalog):
+    deps = list(catalog["firmware"])
+    for key in TOOLCHAIN_KEYS:
+        for architectures in catalog[key].values():
+            for entries in architectures.values():
+                deps.extend(entries)
+    for versions in ARM_GCC_ARM.values():
+        for version, entry in versions.items():
+            deps.append({"name": "gcc-arm", "version": version, **entry})
+    return {dep["url"]: dep for dep in deps if "url" in dep and "sha256" in dep}
+
+
+# Resources that can change upstream are revalidated, versioned archives are not
+def is_mutable(url):
+    parts = urllib.parse.urlsplit(url)
+    return bool(parts.query) or parts.path.endswith(".json")
+
+
+def load_metadata(path):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return None
+
+
+# Mark a cached resource as recently used
+def touch_cached(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+# Delete least recently used resources until the mirror cache fits in limit bytes
+# The resource keep (the one just downloaded) stays, even if it alone exceeds limit
+def evict_cached(limit, keep=None):
+    entries = []
+    for name in os.listdir(MIRROR_DIR):
+        path = os.path.join(MIRROR_DIR, name)
+        if name.endswith((".json", ".tmp")) or path == keep:
+            continue
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total = sum(entry[1] for entry in entries)
+    if keep:
+        total += os.path.getsize(keep)
+    for _, size, path in entries:
+        if total <= limit:
+            break
+        for file in (path, path + ".json"):
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+        total -= size
+
+
+# Download a resource into the mirror cache, returning its path and metadata
+# A stale copy is served if the upstream server cannot be reached
+def fetch_cached(url):
+    pathlib.Path(MIRROR_DIR).mkdir(parents=True, exist_ok=True)
+    path = os.path.join(MIRROR_DIR, hashlib.sha256(url.encode("utf-8")).hexdigest())
+    metadata = load_metadata(path + ".json") if os.path.isfile(path) else None
+    if metadata and not is_mutable(url):
+        touch_cached(path)
+        return path, metadata
+
+    headers = {}
+    if metadata:
+        if metadata.get("etag"):
+            headers["If-None-Match"] = metadata["etag"]
+        if metadata.get("last_modified"):
+            headers["If-Modified-Since"] = metadata["last_modified"]
+
+    try:
+        with session.request(url, headers=headers) as response:
+            if response.status == 304:
+                touch_cached(path)
+                return path, metadata
+            handle, temp = tempfile.mkstemp(dir=MIRROR_DIR, suffix=".tmp")
+            digest = hashlib.sha256()
+            try:
+                with os.fdopen(handle, "wb") as file:
+                    for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                        digest.update(chunk)
+                        file.write(chunk)
+                os.replace(temp, path)
+            finally:
+                if os.path.isfile(temp):
+                    os.remove(temp)
+            metadata = {
+                "url": url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "type": response.headers.get(
+                    "Content-Type", "application/octet-stream"
+                ),
+                "sha256": digest.hexdigest(),
+            }
+    except urllib.error.HTTPError:
+        raise
+    except urllib.error.URLError:
+        if metadata:
+            touch_cached(path)
+            return path, metadata
+        raise
+
+    with open(path + ".json", "w") as file:
+        json.dump(metadata, file, indent=4)
+    evict_cached(MIRROR_LIMIT, path)
+    return path, metadata
+
+
+# Answers neopo clients from the artifact store and the mirror cache
+class MirrorHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "neopo"
+
+    def do_GET(self):
+        self.handle_request(True)
+
+    def do_HEAD(self):
+        self.handle_request(False)
+
+    def handle_request(self, body):
+        try:
+            if self.path.startswith("/catalog/"):
+                self.send_catalog(self.path[len("/catalog/") :], body)
+            else:
+                self.send_mirrored(body)
+        except urllib.error.HTTPError as error:
+            self.send_error(error.code)
+        except (urllib.error.URLError, DependencyError):
+            self.send_error(502)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    # Serve the dependency manifest or a project template
+    def send_catalog(self, name, body):
+        if name == "manifest.json":
+            content = json.dumps(load_catalog()).encode("utf-8")
+        elif name in ("launch.json", "settings.json"):
+            try:
+                with open(vscodeFiles[name[: -len(".json")]], "rb") as file:
+                    content = file.read()
+            except FileNotFoundError:
+                self.send_error(404)
+                return
+        else:
+            self.send_error(404)
+            return
+        etag = '"%s"' % hashlib.sha256(content).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self.send_not_modified(etag)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+
+    # Serve /<scheme>/<host>/<path> from the store or mirror cache, fetching it first if needed
+    def send_mirrored(self, body):
+        parts = self.path.lstrip("/").split("/", 2)
+        if len(parts) < 3 or parts[0] not in ("http", "https"):
+            self.send_error(404)
+            return
+        scheme, host, rest = parts
+        deps, hosts = self.server.catalog()
+        if host not in hosts:
+            self.send_error(403)
+            return
+        url = "%s://%s/%s" % (scheme, host, rest)
+
+        # Only one client fetches a resource from upstream at a time
+        with self.server.lock(url):
+            dep = deps.get(url)
+            if dep:
+                path = fetch_artifact(dep)
+                etag, content_type = '"%s"' % dep["sha256"], "application/octet-stream"
+            else:
+                path, metadata = fetch_cached(url)
+                etag, content_type = '"%s"' % metadata["sha256"], metadata["type"]
+
+            # The store may evict the archive at any time, but an open file stays
+            # readable until it is closed
+            try:
+                file = open(path, "rb")
+            except FileNotFoundError:
+                self.send_error(503, "Evicted from the store, please retry")
+                return
+        with file:
+            self.send_file(file, etag, content_type, body)
+
+    # Send an open file, honoring single byte ranges so clients can resume and segment
+    def send_file(self, file, etag, content_type, body):
+        if self.headers.get("If-None-Match") == etag:
+            self.send_not_modified(etag)
+            return
+
+        size = os.fstat(file.fileno()).st_size
+        start, end, status = 0, size - 1, 200
+        requested = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", (requested or "").strip())
+        if match and any(match.groups()) and if_range in (None, etag):
+            if match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)), size - 1)
+            else:
+                start = max(0, size - int(match.group(2)))
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % size)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        if status == 206:
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+        self.end_headers()
+        if not body:
+            return
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+
+    def send_not_modified(self, etag):
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+# HTTP server sharing the catalog and per-resource locks between request threads
+class MirrorServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, MirrorHandler)
+        self.stamp = None
+        self.deps = self.hosts = None
+        self.catalog_lock = threading.Lock()
+        self.catalog()
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    # Dependencies and hosts of the catalog, loaded again after neopo update
+    def catalog(self):
+        stamp = catalog_stamp()
+        with self.catalog_lock:
+            if stamp != self.stamp:
+                try:
+                    self.deps = catalog_deps(load_catalog())
+                except DependencyError:
+                    # Keep serving the previous catalog while it is being written
+                    if self.deps is None:
+                        raise
+                    return self.deps, self.hosts
+                self.hosts = set(MIRROR_HOSTS)
+                for url in [PARTICLE_MANIFEST, s3_bucket, *self.deps]:
+                    self.hosts.add(urllib.parse.urlsplit(url).netloc)
+                self.stamp = stamp
+            return self.deps, self.hosts
+
+    # Hold the lock of a resource, dropping it once no request holds or waits for it
+    @contextlib.contextmanager
+    def lock(self, key):
+        with self.locks_lock:
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[key]
+
+
+# Wrapper for [serve]
+def serve_command(args):
+    try:
+        port = int(args[2]) if len(args) >= 3 else MIRROR_PORT
+    except ValueError as error:
+        raise UserError("The port must be a number!") from error
+    address = args[3] if len(args) >= 4 else ""
+
+    server = MirrorServer((address, port))
+    print("Serving neopo mirror on port %d..." % port)
+    print("Point clients at it with:")
+    print("\t$ export NEOPO_MIRROR=http://%s:%d" % (address or "<this host>", port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        session.close()
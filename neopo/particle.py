@@ -4,13 +4,17 @@ import sys
 # Local imports
 from .build import add_build_tools
 from .common import min_particle_env, particle_cli, running_on_windows
+from .manifest import get_manifest_value
+from .usage import record_usage
 
 
 # Create particle-cli temp_env
 def particle_env():
     temp_env = min_particle_env()
     # Add build tools to env
-    add_build_tools(temp_env)
+    tools_version = get_manifest_value("buildtools")
+    add_build_tools(temp_env, tools_version)
+    record_usage({"buildtools": tools_version})
     return temp_env
 
 
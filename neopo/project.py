@@ -15,8 +15,14 @@ from .common import (
     running_on_windows,
     vscodeFiles,
 )
-from .manifest import get_manifest_value
-from .toolchain import check_firmware_version
+from .lockfile import save_lockfile
+from .manifest import get_manifest_value, load_manifest
+from .toolchain import (
+    check_firmware_version,
+    get_compiler,
+    get_dep_data,
+    get_firmware_data,
+)
 from .utility import check_login, download_library, write_file
 
 
@@ -93,6 +99,7 @@ def configure_project(project_path, platform, firmware_version):
 
     # Apply configuration to project
     write_settings(project_path, platform, firmware_version)
+    lock_project(project_path)
     print(
         "Configured project %s: (%s, %s)" % (project_path, platform, firmware_version)
     )
@@ -181,18 +188,30 @@ def check_libraries(project_path, active):
     return libraries_intact
 
 
+# Version of a library installed in a project, or None if it is not installed
+def installed_version(project_path, name):
+    try:
+        lib_properties = load_properties(
+            os.path.join(project_path, "lib", name, "library.properties")
+        )
+        return lib_properties["version"]
+    except FileNotFoundError:
+        return None
+
+
+# Check that a list of libraries is installed, without printing anything
+def libraries_installed(libraries, project_path):
+    return all(
+        installed_version(project_path, name) == version for name, version in libraries
+    )
+
+
 # Install a list of libraries
 def install_libraries(libraries, project_path, active):
     libraries_intact = True
     for library in libraries:
         requested_version = library[1]
-        try:
-            lib_properties = load_properties(
-                os.path.join(project_path, "lib", library[0], "library.properties")
-            )
-            actual_version = lib_properties["version"]
-        except FileNotFoundError:
-            actual_version = None
+        actual_version = installed_version(project_path, library[0])
 
         if requested_version != actual_version:
             if active:
@@ -206,6 +225,40 @@ def install_libraries(libraries, project_path, active):
     return libraries_intact
 
 
+# Resolve the toolchain and libraries of a project and pin them in its lockfile
+# Nothing is written unless every library is installed, and an existing lockfile
+# is left alone: once the project changed it is no longer trusted anyway
+# Missing libraries are reported by neopo build and neopo libs, not here
+def lock_project(project_path):
+    platform, firmware_version = get_settings(project_path)
+    properties = load_properties(os.path.join(project_path, projectFiles["properties"]))
+    libraries = get_library_deps(properties)
+    if not libraries_installed(libraries, project_path):
+        return False
+    sub_libraries = find_sub_libraries(libraries, project_path)
+    if not libraries_installed(sub_libraries, project_path):
+        return False
+    libraries += sub_libraries
+
+    _, script_version, tools_version, _ = load_manifest()
+    versions = {
+        "gcc-arm": get_compiler(firmware_version),
+        "buildscripts": script_version,
+        "buildtools": tools_version,
+    }
+    toolchain = {
+        name: [version, get_dep_data(name, version)["sha256"]]
+        for name, version in versions.items()
+    }
+    firmware = get_firmware_data(firmware_version)
+    toolchain["deviceOS"] = [firmware_version, firmware and firmware["sha256"]]
+
+    save_lockfile(
+        project_path, platform, toolchain, dict(libraries), get_flags(project_path)
+    )
+    return True
+
+
 # Get EXTRA_CFLAGS for a project or return empty string
 def get_flags(project_path):
     try:
@@ -283,4 +336,5 @@ def settings_command(args):
 # Wrapper for [libs]
 def libraries_command(args):
     project_path = args[2] if len(args) >= 3 else os.getcwd()
-    check_libraries(project_path, True)
+    if check_libraries(project_path, True):
+        lock_project(project_path)
@@ -0,0 +1,84 @@
+import json
+import os
+import re
+
+# Local imports
+from .catalog import catalog
+from .common import NEOPO_PLATFORMS, UserError, projectFiles
+
+# Directories of a deviceOS release with a subdirectory per platform
+PLATFORM_PARENTS = ["hal/src", "bootloader/src", "modules"]
+
+# Platforms that also build from the directories of another platform
+PLATFORM_ALIASES = {"p1": ["photon"]}
+
+# Build output directories, named by platform ID (build/target/*/platform-12-m)
+BUILD_DIR = re.compile(r"platform-(\d+)(-m)?(-lto)?")
+
+
+# Find the platform a member of a deviceOS archive belongs to
+# Returns a platform name or ID, or None for files shared by every platform
+def member_platform(name, names):
+    parts = name.strip("/").split("/")
+    for index, part in enumerate(parts):
+        match = BUILD_DIR.fullmatch(part)
+        if match:
+            return match.group(1)
+        if part in names:
+            parent = "/" + "/".join(parts[:index])
+            if any(parent.endswith("/" + path) for path in PLATFORM_PARENTS):
+                return part
+    return None
+
+
+# Check platform names against the catalog, returning them with their IDs
+def platform_ids(platforms):
+    known = {entry["name"]: entry["id"] for entry in catalog.load("platforms")}
+    for name in platforms:
+        if name not in known:
+            raise UserError("Invalid platform %s!" % name)
+    return {name: str(known[name]) for name in platforms}, known
+
+
+# Create a filter for the members of a deviceOS archive that selects the files of platforms
+# The files shared by every platform are selected too, unless shared is False
+def platform_selector(platforms, shared=True):
+    selected, known = platform_ids(platforms)
+    names = set(known)
+    wanted = set(selected) | set(selected.values())
+    for name, aliases in PLATFORM_ALIASES.items():
+        names.update(aliases)
+        if name in selected:
+            wanted.update(aliases)
+
+    def select(member):
+        owner = member_platform(member, names)
+        return shared if owner is None else owner in wanted
+
+    return select
+
+
+# Platforms to install deviceOS for when none are given: NEOPO_PLATFORMS, or else
+# those configured in the projects in the current directory and its subdirectories
+# Returns None to install every platform
+def default_platforms():
+    if NEOPO_PLATFORMS:
+        if NEOPO_PLATFORMS == ["all"]:
+            return None
+        platform_ids(NEOPO_PLATFORMS)
+        return NEOPO_PLATFORMS
+    directories = [os.curdir]
+    try:
+        directories += [entry.path for entry in os.scandir(os.curdir) if entry.is_dir()]
+    except OSError:
+        pass
+    platforms = set()
+    for directory in directories:
+        try:
+            with open(os.path.join(directory, projectFiles["settings"]), "r") as file:
+                platforms.add(json.load(file)["particle.targetPlatform"])
+        except (OSError, KeyError, TypeError, json.decoder.JSONDecodeError):
+            continue
+    # Projects for platforms missing from the catalog cannot be built anyway
+    _, known = platform_ids([])
+    return sorted(platforms & set(known)) or None
@@ -0,0 +1,80 @@
+import io
+import urllib.error
+import zipfile
+
+# Local imports
+from .download import probe_ranges
+from .session import session
+
+# Smallest range fetched at once, so ZIP headers and small members take one request
+WINDOW_SIZE = 64 * 1024
+
+
+# Seekable read-only file backed by HTTP range requests
+class RemoteFile(io.RawIOBase):
+    def __init__(self, url, size):
+        super().__init__()
+        self.url = url
+        self.size = size
+        self.position = 0
+        self.window_start = 0
+        self.window = b""
+        self.requests = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        self.position = max(0, min(self.position, self.size))
+        return self.position
+
+    # Fetch bytes start to end (exclusive) of the remote file
+    def fetch(self, start, end):
+        headers = {"Range": "bytes=%d-%d" % (start, end - 1)}
+        with session.request(self.url, headers=headers) as response:
+            if response.status != 206:
+                raise urllib.error.URLError("Server ignored range request!")
+            data = response.read()
+        self.requests += 1
+        return data
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.size - self.position)
+        if size <= 0:
+            return 0
+        end = self.position + size
+
+        # Refill the window if the request is not already cached
+        window_end = self.window_start + len(self.window)
+        if self.position < self.window_start or end > window_end:
+            self.window_start = self.position
+            self.window = self.fetch(
+                self.position, min(self.size, self.position + max(size, WINDOW_SIZE))
+            )
+
+        offset = self.position - self.window_start
+        data = self.window[offset : offset + size]
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+# Open a remote ZIP, only fetching the central directory and the members read
+# Falls back to downloading the whole file if the server does not support ranges
+def open_remote_zip(url):
+    size = probe_ranges(url)
+    if size:
+        return zipfile.ZipFile(RemoteFile(url, size), "r")
+    return zipfile.ZipFile(io.BytesIO(session.get(url)), "r")
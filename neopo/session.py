@@ -0,0 +1,237 @@
+import http.client
+import io
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# Local imports
+from .common import NEOPO_MIRROR, NEOPO_RETRIES, NEOPO_TIMEOUT
+
+# Statuses that are followed to their Location
+REDIRECTS = (301, 302, 303, 307, 308)
+
+# Statuses worth retrying after a short wait
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Errors of a connection that was reset, refused or timed out, worth retrying
+# URL, certificate and HTTP errors are permanent and fail at once
+TRANSIENT_ERRORS = (ConnectionError, TimeoutError, http.client.IncompleteRead)
+
+# Errors raised when a pooled connection was closed by the server
+STALE_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+
+
+# Response wrapper that hands its connection back to the pool once it is done
+class Response:
+    def __init__(self, session, key, connection, response, url):
+        self.session = session
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    # Bytes of the body that have not been read yet (None if unknown)
+    @property
+    def length(self):
+        return self.response.length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.response.read()
+        return self.response.read(size)
+
+    def close(self):
+        if not self.connection:
+            return
+        # Only a fully read response leaves the connection ready for reuse
+        reusable = self.response.isclosed() and not self.response.will_close
+        self.response.close()
+        if reusable:
+            self.session.release(self.key, self.connection)
+        else:
+            self.connection.close()
+        self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Keep-alive HTTP(S) connections pooled per host, shared by every network call
+class Session:
+    def __init__(self, timeout=NEOPO_TIMEOUT, retries=NEOPO_RETRIES):
+        self.timeout = timeout
+        self.retries = retries
+        self.pool = {}
+        self.lock = threading.Lock()
+        self.context = ssl.create_default_context()
+        self.proxies = urllib.request.getproxies()
+
+    # Find the host to connect to and the host to tunnel to for a URL
+    def route(self, parts):
+        default_port = 443 if parts.scheme == "https" else 80
+        target = (parts.scheme, parts.hostname, parts.port or default_port)
+        proxy = self.proxies.get(parts.scheme)
+        if proxy and not urllib.request.proxy_bypass(parts.hostname):
+            proxy_parts = urllib.parse.urlsplit(proxy)
+            return target, (proxy_parts.hostname, proxy_parts.port or 80)
+        return target, None
+
+    # Take an idle connection from the pool or open a new one
+    def acquire(self, key):
+        with self.lock:
+            idle = self.pool.get(key)
+            if idle:
+                return idle.pop(), True
+
+        (scheme, host, port), proxy = key
+        if proxy:
+            connection_host, connection_port = proxy
+        else:
+            connection_host, connection_port = host, port
+
+        if scheme == "https":
+            connection = http.client.HTTPSConnection(
+                connection_host,
+                connection_port,
+                timeout=self.timeout,
+                context=self.context,
+            )
+            if proxy:
+                connection.set_tunnel(host, port)
+        else:
+            connection = http.client.HTTPConnection(
+                connection_host, connection_port, timeout=self.timeout
+            )
+        return connection, False
+
+    # Return an idle connection to the pool
+    def release(self, key, connection):
+        with self.lock:
+            self.pool.setdefault(key, []).append(connection)
+
+    # Close every pooled connection
+    def close(self):
+        with self.lock:
+            for connections in self.pool.values():
+                for connection in connections:
+                    connection.close()
+            self.pool.clear()
+
+    # Send a single request over a pooled connection
+    def send(self, method, url, headers, data):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise urllib.error.URLError("Unsupported URL %s" % url)
+        key = self.route(parts)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        # Plain HTTP proxies expect the absolute URL
+        if key[1] and parts.scheme == "http":
+            path = url
+
+        headers = dict(headers or {})
+        headers.setdefault("User-Agent", "neopo")
+        while True:
+            connection, reused = self.acquire(key)
+            try:
+                connection.request(method, path, body=data, headers=headers)
+                response = connection.getresponse()
+            except STALE_ERRORS:
+                connection.close()
+                # The server closed an idle connection, try a fresh one
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            return Response(self, key, connection, response, url)
+
+    # Perform a request, following redirects and retrying transient failures
+    # Raises urllib.error.HTTPError/URLError like urllib.request.urlopen
+    def request(self, url, method="GET", headers=None, data=None):
+        attempt = 0
+        redirects = 0
+        while True:
+            try:
+                response = self.send(method, url, headers, data)
+            except TRANSIENT_ERRORS as error:
+                attempt += 1
+                if attempt > self.retries:
+                    raise urllib.error.URLError(error) from error
+                time.sleep(attempt)
+                continue
+            except urllib.error.URLError:
+                raise
+            except (http.client.HTTPException, OSError) as error:
+                raise urllib.error.URLError(error) from error
+
+            if response.status in REDIRECTS and "Location" in response.headers:
+                redirects += 1
+                location = urllib.parse.urljoin(url, response.headers["Location"])
+                response.read()
+                response.close()
+                if redirects > 10:
+                    raise urllib.error.URLError("Too many redirects for %s" % url)
+                url = location
+                if response.status == 303:
+                    method, data = "GET", None
+                continue
+
+            if response.status in RETRY_STATUSES and attempt < self.retries:
+                attempt += 1
+                response.read()
+                response.close()
+                time.sleep(attempt)
+                continue
+
+            if response.status >= 400:
+                body = response.read()
+                response.close()
+                raise urllib.error.HTTPError(
+                    url,
+                    response.status,
+                    response.reason,
+                    response.headers,
+                    io.BytesIO(body),
+                )
+            return response
+
+    # Download a resource into memory
+    def get(self, url, headers=None):
+        with self.request(url, headers=headers) as response:
+            return response.read()
+
+
+# The session used by every network call in neopo
+session = Session()
+
+
+# Open a URL with the shared session (drop-in for urllib.request.urlopen)
+def urlopen(url, method="GET", headers=None, data=None):
+    return session.request(url, method, headers, data)
+
+
+# Rewrite a URL to go through the NEOPO_MIRROR server if one is configured
+# http://mirror:8088/https/host/path mirrors https://host/path
+def mirror_url(url):
+    parts = urllib.parse.urlsplit(url)
+    if not NEOPO_MIRROR or parts.scheme not in ("http", "https"):
+        return url
+    origin = "%s://%s" % (parts.scheme, parts.netloc)
+    return "%s/%s/%s%s" % (NEOPO_MIRROR, parts.scheme, parts.netloc, url[len(origin) :])
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+
+# Local imports
+from .common import STORE_DIR, STORE_LIMIT, UserError
+
+# Suffixes of the files kept for each artifact
+ARTIFACT_SUFFIX = ".tar.gz"
+METADATA_SUFFIX = ".json"
+
+
+# Path of the archive with a given sha256 in the artifact store
+def artifact_path(sha256):
+    return os.path.join(STORE_DIR, sha256[:2], sha256 + ARTIFACT_SUFFIX)
+
+
+# Return the path of a stored archive (marking it as recently used) or None
+def find_artifact(sha256):
+    path = artifact_path(sha256)
+    if not os.path.isfile(path):
+        return None
+    # A read-only store cannot record the use, but can still be read from
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return path
+
+
+# Add a downloaded archive to the store, moving it if possible
+def store_artifact(source, sha256, dep=None):
+    path = artifact_path(sha256)
+    directory = os.path.dirname(path)
+    pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+
+    # Copy to a temporary file first so other readers never see a partial archive
+    try:
+        os.replace(source, path)
+    except OSError:
+        handle, temp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        os.close(handle)
+        shutil.copyfile(source, temp)
+        os.replace(temp, path)
+
+    if dep:
+        metadata = {"name": dep["name"], "version": dep["version"], "url": dep["url"]}
+        with open(path[: -len(ARTIFACT_SUFFIX)] + METADATA_SUFFIX, "w") as file:
+            json.dump(metadata, file, indent=4)
+
+    evict_artifacts(STORE_LIMIT, sha256)
+
+
+# Delete an archive and its metadata from the store
+def remove_artifact(sha256):
+    path = artifact_path(sha256)
+    for file in (path, path[: -len(ARTIFACT_SUFFIX)] + METADATA_SUFFIX):
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+
+
+# Load the name and version recorded for an archive
+def artifact_metadata(sha256):
+    path = artifact_path(sha256)[: -len(ARTIFACT_SUFFIX)] + METADATA_SUFFIX
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {}
+
+
+# List stored archives as (sha256, path, size, last used), least recently used first
+def list_artifacts():
+    artifacts = []
+    if not os.path.isdir(STORE_DIR):
+        return artifacts
+    for root, _, files in os.walk(STORE_DIR):
+        for file in files:
+            if not file.endswith(ARTIFACT_SUFFIX):
+                continue
+            path = os.path.join(root, file)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            sha256 = file[: -len(ARTIFACT_SUFFIX)]
+            artifacts.append((sha256, path, stat.st_size, stat.st_mtime))
+    artifacts.sort(key=lambda artifact: artifact[3])
+    return artifacts
+
+
+# Evict least recently used archives until the store fits in limit bytes
+# The archive keep (the one just stored) stays, even if it alone exceeds limit
+def evict_artifacts(limit, keep=None):
+    artifacts = list_artifacts()
+    total = sum(artifact[2] for artifact in artifacts)
+    freed = 0
+    for sha256, _, size, _ in artifacts:
+        if total - freed <= limit:
+            break
+        if sha256 == keep:
+            continue
+        remove_artifact(sha256)
+        freed += size
+    return freed
+
+
+# Compute the sha256 of a file without loading it into memory
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Rehash every stored archive and delete the ones that do not match their key
+def verify_artifacts():
+    corrupt = []
+    for sha256, path, _, _ in list_artifacts():
+        if hash_file(path) != sha256:
+            remove_artifact(sha256)
+            corrupt.append(sha256)
+    return corrupt
+
+
+# Format a number of bytes for humans
+def format_size(size):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024 or unit == "GiB":
+            break
+        size /= 1024
+    return "%.1f %s" % (size, unit)
+
+
+# Print the contents of the artifact store
+def cache_list():
+    artifacts = list_artifacts()
+    print("Artifact store: %s" % STORE_DIR)
+    for sha256, _, size, _ in reversed(artifacts):
+        metadata = artifact_metadata(sha256)
+        label = "%s@%s" % (metadata["name"], metadata["version"]) if metadata else "?"
+        print("   %s  %10s  %s" % (sha256[:12], format_size(size), label))
+    total = sum(artifact[2] for artifact in artifacts)
+    print(
+        "%d archives, %s of %s"
+        % (len(artifacts), format_size(total), format_size(STORE_LIMIT))
+    )
+
+
+# Wrapper for [cache]
+def cache_command(args):
+    action = args[2] if len(args) >= 3 else "list"
+    if action == "list":
+        cache_list()
+    elif action == "verify":
+        corrupt = verify_artifacts()
+        for sha256 in corrupt:
+            print("Removed corrupt archive %s" % sha256)
+        print("Verified artifact store, %d corrupt archives removed." % len(corrupt))
+    elif action == "prune":
+        try:
+            limit = int(args[3]) * 1024 * 1024 if len(args) >= 4 else STORE_LIMIT
+        except ValueError as error:
+            raise UserError("The size limit must be a number of MiB!") from error
+        freed = evict_artifacts(limit)
+        print("Pruned artifact store, reclaimed %s." % format_size(freed))
+    else:
+        raise UserError("Invalid command! Commands are: list, verify, prune")
@@ -3,19 +3,35 @@ import os
 import platform
 import shutil
 import subprocess
+import urllib.error
 
 # Local imports
-from .common import NEOPO_PARALLEL, PARTICLE_DEPS, DependencyError, UserError, jsonFiles
-from .manifest import get_cached_json
+from .catalog import catalog
+from .common import NEOPO_DEDUPE, PARTICLE_DEPS, DependencyError, UserError
+from .dedupe import dedupe_dependency
+from .download import (
+    commit_staging,
+    discard_staging,
+    extract_artifact,
+    fetch_artifact,
+    make_staging,
+    merge_staging,
+)
+from .fileindex import build_file_index, save_file_index
+from .lock import dependency_lock
+from .prune import default_platforms, platform_ids, platform_selector
+from .usage import record_usage
 from .workbench import (
     INSTALL_RECEIPT,
     attempt_download,
-    download_dep,
     fix_gcc_arm,
+    install_deps,
     install_receipt,
-    parallel_handler,
 )
 
+# Releases of deviceOS that are not listed in the Workbench manifest
+DEVICE_OS_BINARIES = "https://binaries.particle.io/device-os/v%s.tar.gz"
+
 
 # Attempt to get custom toolchain data from .workbench/manifest.json
 def get_custom_toolchain(firmware_version, component="toolchains", all_items=False):
@@ -41,11 +57,7 @@ def write_custom_toolchain(firmware_version, toolchain_data):
 
 # Get a deviceOS dependency from a version
 def get_firmware_data(version):
-    with open(jsonFiles["firmware"], "r") as firmware:
-        for entry in json.load(firmware):
-            if entry["version"] == version:
-                return entry
-        return False
+    return catalog.firmware(version) or False
 
 
 # Convert between platform IDs and device names
@@ -60,19 +72,15 @@ def platform_convert(data, key1, key2, custom_version=None):
         return False
 
     # Official manifest
-    with open(jsonFiles["platforms"], "r") as platforms:
-        for device in json.load(platforms):
-            if device[key1] == data:
-                return device[key2]
-        return False
+    device = catalog.platform(key1, data)
+    return device[key2] if device else False
 
 
 # List the supported platform IDs for a given version
 def get_supported_platforms(version):
-    with open(jsonFiles["toolchains"], "r") as toolchains:
-        for toolchain in json.load(toolchains):
-            if toolchain["firmware"] == "deviceOS@%s" % version:
-                return toolchain["platforms"]
+    toolchain = catalog.toolchain(version)
+    if toolchain:
+        return toolchain["platforms"]
 
     toolchain = get_custom_toolchain(version)
     return toolchain["platforms"] if toolchain else False
@@ -102,6 +110,9 @@ def check_firmware_version(device_platform, version):
 
     # If required firmware is not installed, download it, along with dependencies
     download_firmware(version)
+    # A release installed for other platforms gets the files of this one
+    add_firmware_platforms(version, [device_platform])
+    record_usage(dict(get_firmware_deps(version), deviceOS=version))
     return True
 
 
@@ -127,23 +138,22 @@ def get_compiler(firmware_version):
 # Print available versions and platforms
 def versions_command(args):
     official_versions = set()
-    with open(jsonFiles["firmware"], "r") as firmware_file:
-        print("Available deviceOS versions:\n")
-        for entry in reversed(json.load(firmware_file)):
-            version = entry["version"]
-            official_versions.add(version)
+    print("Available deviceOS versions:\n")
+    for entry in reversed(catalog.firmware_releases()):
+        version = entry["version"]
+        official_versions.add(version)
 
-            try:
-                devices = ", ".join(
-                    [
-                        platform_convert(platform, "id", "name")
-                        for platform in get_supported_platforms(version)
-                    ]
-                )
-            except TypeError:
-                continue
+        try:
+            devices = ", ".join(
+                [
+                    platform_convert(platform, "id", "name")
+                    for platform in get_supported_platforms(version)
+                ]
+            )
+        except TypeError:
+            continue
 
-            print("   %s\t [ %s ]" % (version, devices))
+        print("   %s\t [ %s ]" % (version, devices))
 
     custom_versions = None
     device_os_path = os.path.join(PARTICLE_DEPS, "deviceOS")
@@ -172,8 +182,11 @@ def versions_command(args):
 
 # Wrapper for [get]
 def get_command(args):
+    platforms = args[3:] or None
+    if platforms == ["all"]:
+        platforms = [entry["name"] for entry in catalog.load("platforms")]
     try:
-        download_firmware(args[2])
+        download_firmware(args[2], platforms)
     except IndexError as error:
         raise UserError("You must specify a deviceOS version!") from error
 
@@ -181,16 +194,7 @@ def get_command(args):
 # Given a deviceOS version, get a dictionary of deps and versions
 def get_firmware_deps(version):
     keys = ["compilers", "tools", "scripts", "debuggers"]
-    with open(jsonFiles["toolchains"]) as toolchains:
-        data = json.load(toolchains)
-        for toolchain in data:
-            if toolchain["firmware"] == "deviceOS@%s" % version:
-                return {
-                    toolchain[key].split("@")[0]: toolchain[key].split("@")[1]
-                    for key in keys
-                }
-
-    toolchain = get_custom_toolchain(version)
+    toolchain = catalog.toolchain(version) or get_custom_toolchain(version)
     if toolchain:
         return {
             toolchain[key].split("@")[0]: toolchain[key].split("@")[1] for key in keys
@@ -199,6 +203,8 @@ def get_firmware_deps(version):
 
 
 # Confirm if specified deps are installed in PARTICLE_DEPS
+# The receipt is written last, so a directory without one is a partial install,
+# unless it is a custom deviceOS release that was put there by hand
 def check_deps_installed(deps_dict):
     missing = {}
     for dep, version in deps_dict.items():
@@ -208,76 +214,132 @@ def check_deps_installed(deps_dict):
             missing.update({dep: version})
             continue
         if not os.path.isfile(receipt):
-            install_receipt({"name": dep, "version": version})
+            if dep == "deviceOS" and not get_firmware_data(version):
+                install_receipt({"name": dep, "version": version})
+            else:
+                missing.update({dep: version})
     return missing
 
 
 # Get the dependency data for a specified dep and version
 def get_dep_data(dep, version):
-    system = platform.system().lower()
-    lookup = {
-        "gcc-arm": jsonFiles["compilers"],
-        "buildtools": jsonFiles["tools"],
-        "buildscripts": jsonFiles["scripts"],
-        "openocd": jsonFiles["debuggers"],
-    }
-    try:
-        with open(lookup[dep]) as file:
-            dep_file = json.load(file)
-            section = dep_file[system]["x64"]
-            dep_full = [x for x in section if x["version"] == version][0]
-            if dep == "gcc-arm":
-                fix_gcc_arm(dep_full)
-            return dep_full
-    except IndexError as error:
-        raise DependencyError("Invalid dependency %s@%s!" % (dep, version)) from error
+    dep_full = catalog.dep(dep, version, platform.system().lower())
+    if not dep_full:
+        raise DependencyError("Invalid dependency %s@%s!" % (dep, version))
+    if dep == "gcc-arm":
+        fix_gcc_arm(dep_full)
+    return dep_full
 
 
-# Install specified dependencies
-def install_firmware_deps(deps_dict):
-    if NEOPO_PARALLEL:
-        deps = [get_dep_data(dep, version) for (dep, version) in deps_dict.items()]
-        parallel_handler(deps)
-    else:
-        for dep, version in deps_dict.items():
-            download_dep(get_dep_data(dep, version), False, True)
+# Install specified dependencies (and optionally a deviceOS release) in parallel
+def install_firmware_deps(deps_dict, firmware=None, platforms=None):
+    deps = [get_dep_data(dep, version) for (dep, version) in deps_dict.items()]
+    if firmware:
+        deps.append(firmware)
+    install_deps(deps, platforms=platforms)
 
 
 # Download a specific deviceOS version (along with any of its dependencies)
-def download_firmware(version):
-    deps = get_firmware_deps(version)
-    # deps.append(get_firmware_data(version)) #?
-    missing_deps = check_deps_installed(deps)
-    if missing_deps:
-        install_firmware_deps(missing_deps)
-    if not check_deps_installed({"deviceOS": version}):
+# The release is only installed for platforms (by default those of default_platforms)
+# and the files of any of them that an existing installation lacks are added to it
+def download_firmware(version, platforms=None):
+    if platforms is None:
+        platforms = default_platforms()
+    else:
+        platform_ids(platforms)
+    missing_deps = check_deps_installed(get_firmware_deps(version))
+    firmware = None
+    if check_deps_installed({"deviceOS": version}):
+        firmware = get_firmware_data(version)
+        if not firmware:
+            print("Could not download deviceOS version %s!" % version)
+    if missing_deps or firmware:
+        install_firmware_deps(missing_deps, firmware, platforms)
+    if platforms:
+        add_firmware_platforms(version, platforms)
+
+
+# List the platforms a deviceOS release is installed for, or None if it has all of them
+def installed_platforms(version):
+    receipt = os.path.join(PARTICLE_DEPS, "deviceOS", version, INSTALL_RECEIPT)
+    try:
+        with open(receipt, "r") as file:
+            return json.load(file).get("platforms")
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return None
+
+
+# Extract the files of more platforms into a deviceOS release installed for only some
+# The archive is taken from the artifact store, so it is usually not downloaded again
+def add_firmware_platforms(version, platforms):
+    installed = installed_platforms(version)
+    if installed is None or set(platforms) <= set(installed):
+        return
+    firmware = get_firmware_data(version)
+    if not firmware:
         return
-    if not download_dep(get_firmware_data(version), False, True):
-        print("Could not download deviceOS version %s!" % version)
+
+    path = os.path.join(PARTICLE_DEPS, "deviceOS", version)
+    with dependency_lock("deviceOS", version):
+        # Another neopo process may have added them while this one waited
+        installed = installed_platforms(version)
+        missing = sorted(set(platforms) - set(installed or platforms))
+        if not missing:
+            return
+        print("Adding %s to deviceOS@%s..." % (", ".join(missing), version))
+        select = platform_selector(missing, shared=False)
+        # The files are only added once the archive matches its sha256, and a
+        # corrupt archive is dropped from the store and downloaded again once
+        for _ in range(2):
+            try:
+                artifact = fetch_artifact(firmware)
+            except urllib.error.URLError as error:
+                raise DependencyError(
+                    "Failed to download deviceOS@%s!" % version
+                ) from error
+            staging = extract_artifact(artifact, path, firmware["sha256"], select)
+            if staging:
+                break
+        else:
+            raise DependencyError("The archive of deviceOS@%s is corrupt!" % version)
+        merge_staging(staging, path)
+        install_receipt(firmware, installed + missing)
+    if NEOPO_DEDUPE:
+        dedupe_dependency("deviceOS", version)
 
 
 # Clone a specific tag (version) from the device-os repo
+# The clone is made in a staging directory and renamed into place when complete
 def clone_tag_from_git(version):
     repo_path = os.path.join(PARTICLE_DEPS, "deviceOS", version)
     repo_url = "https://github.com/particle-iot/device-os"
-    clone_process = [
-        "git",
-        "clone",
-        "--depth",
-        "1",
-        "-b",
-        "v%s" % version,
-        repo_url,
-        repo_path,
-    ]
-    submodule_process = ["git", "-C", repo_path, "submodule", "update", "--init"]
-    try:
-        subprocess.run(clone_process, check=True)
-        subprocess.run(submodule_process, check=True)
+    with dependency_lock("deviceOS", version):
+        staging = make_staging(repo_path)
+        clone_process = [
+            "git",
+            "clone",
+            "--depth",
+            "1",
+            "-b",
+            "v%s" % version,
+            repo_url,
+            staging,
+        ]
+        submodule_process = ["git", "-C", staging, "submodule", "update", "--init"]
+        try:
+            subprocess.run(clone_process, check=True)
+            subprocess.run(submodule_process, check=True)
+            cleanup_repo(staging)
+            save_file_index(staging, build_file_index(staging))
+        except BaseException as error:
+            discard_staging(staging)
+            if isinstance(error, subprocess.CalledProcessError):
+                raise DependencyError from error
+            raise
+        commit_staging(staging, repo_path)
         install_receipt({"name": "deviceOS", "version": version})
-        cleanup_repo(repo_path)
-    except subprocess.CalledProcessError as error:
-        raise DependencyError from error
+    if NEOPO_DEDUPE:
+        dedupe_dependency("deviceOS", version)
 
 
 # Delete uneeded files from a deviceOS release
@@ -299,7 +361,7 @@ def download_unlisted(version, skip_mirror=False):
         "name": "deviceOS",
         "version": version,
         "sha256": "SKIP",
-        "url": "https://binaries.particle.io/device-os/v%s.tar.gz" % version,
+        "url": DEVICE_OS_BINARIES % version,
     }
 
     try:
@@ -321,7 +383,7 @@ def download_unlisted(version, skip_mirror=False):
     toolchain = get_custom_toolchain(version, None)
     platforms = get_supported_platforms(version)
 
-    all_platforms = get_cached_json("platforms")
+    all_platforms = catalog.load("platforms")
 
     selected_platforms = [p for p in all_platforms if p["id"] in platforms]
 
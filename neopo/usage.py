@@ -0,0 +1,55 @@
+import json
+import os
+import threading
+import time
+
+# Local imports
+from .common import jsonFiles
+from .lock import file_lock
+
+
+# Load the last-used times of dependencies: {"name@version": seconds}
+def load_usage():
+    try:
+        with open(jsonFiles["usage"], "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {}
+
+
+# Replace the usage file with a rename so gc never reads it half written
+def write_usage(usage):
+    path = jsonFiles["usage"]
+    temp = "%s.%d-%d.tmp" % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(temp, "w") as file:
+            json.dump(usage, file, indent=4)
+        os.replace(temp, path)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+# Record that dependencies ({name: version}) were just used, for neopo gc
+def record_usage(deps):
+    now = time.time()
+    try:
+        with file_lock(jsonFiles["usage"]):
+            usage = load_usage()
+            for name, version in deps.items():
+                if version:
+                    usage["%s@%s" % (name, version)] = now
+            write_usage(usage)
+    except OSError:
+        # Never fail a build because usage could not be recorded
+        pass
+
+
+# Forget the last-used times of removed dependencies
+def forget_usage(keys):
+    with file_lock(jsonFiles["usage"]):
+        usage = load_usage()
+        for key in keys:
+            usage.pop(key, None)
+        write_usage(usage)
@@ -1,12 +1,9 @@
 import io
 import os
-import pathlib
 import stat
 import subprocess
 import sys
-import tarfile
 import traceback
-import urllib.request
 import xml.etree.ElementTree as ET
 
 # Local imports
@@ -21,7 +18,9 @@ from .common import (
     s3_bucket,
     s3_prefix,
 )
+from .download import stream_install
 from .help_info import get_help
+from .session import mirror_url, session
 
 
 # Write data to a file
@@ -56,10 +55,8 @@ def check_login():
 
 
 def search(lib_query):
-    request = urllib.request.Request(s3_bucket + s3_prefix + lib_query)
-    with urllib.request.urlopen(request) as response:
-        content = response.read()
-        return io.BytesIO(content)
+    content = session.get(mirror_url(s3_bucket + s3_prefix + lib_query))
+    return io.BytesIO(content)
 
 
 def get_keys(byte_file):
@@ -88,18 +85,8 @@ def install_library(name, version, project_path):
 
 
 def download_library_archive(url, name, project_path):
-    base = os.path.join(project_path, "lib")
-    path = os.path.join(base, name)
-    archive = os.path.join(base, name + ".tar.gz")
-    pathlib.Path(path).mkdir(parents=True, exist_ok=True)
-    request = urllib.request.Request(url)
-    with urllib.request.urlopen(request) as response:
-        content = response.read()
-    with open(archive, "wb") as gz_file:
-        gz_file.write(content)
-    with tarfile.open(archive, "r:gz") as tar:
-        tar.extractall(path)
-    os.remove(archive)
+    path = os.path.join(project_path, "lib", name)
+    stream_install(url, path)
 
 
 def download_library(library, project_path):
@@ -132,6 +119,14 @@ Refer to the manual for more detailed help:
       versions                # List available versions and platforms
       get <version>           # Download a specific deviceOS version
       remove <version>        # Delete an installed deviceOS version
+      cache [command]         # Manage the toolchain archive store
+      ccache [command]        # Manage the compiler cache
+      dedupe [--full]         # Share identical files between toolchains
+      verify [--deep]         # Check installed toolchains for damage
+      gc <size|--all> [roots] # Remove toolchains no project uses
+      bundle <command> <file> # Export or import an offline bundle
+      serve [port] [address]  # Run a caching mirror for other machines
+      daemon [jobs]           # Run builds from a resident process
       particle [OPTIONS]      # Use the encapsulated Particle CLI
 
   Build Commands:
@@ -148,6 +143,7 @@ Refer to the manual for more detailed help:
       flags <string> [project]                  # Set EXTRA_CFLAGS in a project 
       settings [project]                        # View configured settings
       libs [project]                            # Install Particle libraries
+      workspace <command> [root]                # Build all projects in a tree
 
   Special Commands:
       bootloader <platform> <version> [-v/-q]   # Flash device bootloader
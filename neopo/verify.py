@@ -0,0 +1,133 @@
+import os
+import time
+
+# Local imports
+from .common import PARTICLE_DEPS, DependencyError, UserError
+from .fileindex import hash_files, load_file_index, save_file_index
+from .lock import dependency_lock
+from .store import format_size
+from .workbench import INSTALL_RECEIPT
+
+# Number of damaged files listed for each dependency
+MAX_LISTED = 10
+
+
+# List installed dependencies as (name, version, path)
+def installed_deps():
+    deps = []
+    if not os.path.isdir(PARTICLE_DEPS):
+        return deps
+    for name in sorted(os.listdir(PARTICLE_DEPS)):
+        directory = os.path.join(PARTICLE_DEPS, name)
+        if not os.path.isdir(directory):
+            continue
+        for version in sorted(os.listdir(directory)):
+            path = os.path.join(directory, version)
+            # Skip staging directories of installs in progress
+            if not version.startswith(".") and os.path.isdir(path):
+                deps.append((name, version, path))
+    return deps
+
+
+# Compare the files of a dependency with its index using only stat
+# Returns the damaged files and the files whose contents must be hashed
+def stat_files(path, files, deep):
+    damaged = {}
+    suspects = []
+    for relative, (size, mtime, _) in files.items():
+        try:
+            stat = os.stat(os.path.join(path, relative))
+        except OSError:
+            damaged[relative] = "missing"
+            continue
+        if stat.st_size != size:
+            damaged[relative] = "size changed"
+        elif deep or int(stat.st_mtime) != mtime:
+            suspects.append((relative, int(stat.st_mtime)))
+    return damaged, suspects
+
+
+# Verify installed dependencies against the file index written when they were installed
+# The default pass only stats files and hashes those with a new mtime, --deep hashes all
+# Files found intact with a new mtime (e.g. after neopo dedupe) get it recorded
+def verify_deps(deep):
+    start = time.time()
+    results = []
+    suspects = []
+    for name, version, path in installed_deps():
+        if not os.path.isfile(os.path.join(path, INSTALL_RECEIPT)):
+            results.append(
+                (name, version, path, None, "incomplete (no install receipt)")
+            )
+            continue
+        files = load_file_index(path)
+        if files is None:
+            results.append(
+                (name, version, path, None, "not indexed (installed by an older neopo)")
+            )
+            continue
+        damaged, checks = stat_files(path, files, deep)
+        results.append((name, version, path, files, damaged))
+        suspects.extend(
+            (len(results) - 1, relative, mtime) for relative, mtime in checks
+        )
+
+    # Hash the suspect files of every dependency together, in parallel
+    hashes = hash_files(
+        [os.path.join(results[result][2], relative) for result, relative, _ in suspects]
+    )
+    refreshed = set()
+    hashed = 0
+    for (result, relative, mtime), sha256 in zip(suspects, hashes, strict=True):
+        files, damaged = results[result][3], results[result][4]
+        size, _, expected = files[relative]
+        hashed += size
+        if sha256 != expected:
+            damaged[relative] = "modified" if sha256 else "unreadable"
+        elif files[relative][1] != mtime:
+            files[relative] = [size, mtime, sha256]
+            refreshed.add(result)
+
+    failures = 0
+    checked = 0
+    for result, (name, version, path, files, damaged) in enumerate(results):
+        label = "%s@%s" % (name, version)
+        if files is None:
+            print("   %-24s %s" % (label, damaged))
+            failures += damaged.startswith("incomplete")
+            continue
+        checked += len(files)
+        if not damaged:
+            print("   %-24s ok (%d files)" % (label, len(files)))
+        else:
+            failures += 1
+            print(
+                "   %-24s DAMAGED (%d of %d files)" % (label, len(damaged), len(files))
+            )
+            for relative in sorted(damaged)[:MAX_LISTED]:
+                print("      %s: %s" % (damaged[relative], relative))
+            if len(damaged) > MAX_LISTED:
+                print("      ...")
+        if result in refreshed:
+            with dependency_lock(name, version):
+                save_file_index(path, files)
+
+    print(
+        "Verified %d files, hashed %s in %.1fs."
+        % (checked, format_size(hashed), time.time() - start)
+    )
+    return failures
+
+
+# Wrapper for [verify]
+def verify_command(args):
+    deep = len(args) >= 3 and args[2] == "--deep"
+    if len(args) >= 3 and not deep:
+        raise UserError("Invalid option! Use: neopo verify [--deep]")
+    print("Verifying installed dependencies%s..." % (" (deep)" if deep else ""))
+    failures = verify_deps(deep)
+    if failures:
+        raise DependencyError(
+            "%d dependencies are damaged or incomplete! Reinstall them to repair them."
+            % failures
+        )
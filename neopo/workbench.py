@@ -9,16 +9,21 @@ import platform
 import shutil
 import subprocess
 import tarfile
+import threading
 import time
-import urllib.request
+import urllib.error
 import zipfile
 
 # Local imports
+from .catalog import catalog, save_snapshot
 from .common import (
     ARM_GCC_ARM,
     CACHE_DIR,
     HOME_DIR,
-    NEOPO_PARALLEL,
+    NEOPO_DEDUPE,
+    NEOPO_JOBS,
+    NEOPO_MIN_FREE,
+    NEOPO_MIRROR,
     PARTICLE_DEPS,
     DependencyError,
     extensionFiles,
@@ -27,15 +32,52 @@ from .common import (
     running_on_windows,
     vscodeFiles,
 )
-from .manifest import create_manifest, get_manifest_value, write_manifest
+from .dedupe import dedupe_dependency
+from .download import (
+    commit_staging,
+    discard_staging,
+    print_progress,
+    stream_to_staging,
+)
+from .lock import dependency_lock, file_lock
+from .manifest import (
+    create_manifest,
+    get_cached_json,
+    get_manifest_value,
+    write_manifest,
+    write_manifest_entries,
+)
+from .prune import platform_selector
+from .remotezip import open_remote_zip
+from .session import mirror_url, session, urlopen
 from .utility import write_executable, write_file
 
 INSTALL_RECEIPT = ".particle-install-receipt"
 WORKBENCH_EXTENSION = "particle.particle-vscode-core"
+PARTICLE_MANIFEST = "https://binaries.particle.io/particle-cli/manifest.json"
+MARKETPLACE_QUERY = (
+    "https://marketplace.visualstudio.com/_apis/public/gallery/extensionquery"
+)
+
+# JSON caches created from the toolchain-manager manifest in the VSIX
+CATALOG_KEYS = [
+    "firmware",
+    "platforms",
+    "toolchains",
+    "compilers",
+    "tools",
+    "scripts",
+    "debuggers",
+]
 
 
 # Find the Workbench extension URL from the Visual Studio Marketplace
 def get_extension_url(extension_name=WORKBENCH_EXTENSION):
+    return query_extension(extension_name)[0]
+
+
+# Find the URL and version of the latest release of an extension
+def query_extension(extension_name=WORKBENCH_EXTENSION):
     if extension_name == WORKBENCH_EXTENSION:
         print("Finding Workbench extension URL...")
     payload = (
@@ -43,18 +85,16 @@ def get_extension_url(extension_name=WORKBENCH_EXTENSION):
         % extension_name
     )
 
-    request = urllib.request.Request(
-        "https://marketplace.visualstudio.com/_apis/public/gallery/extensionquery",
-        method="POST",
-        headers={
-            "content-type": "application/json",
-            "accept": "application/json;api-version=6.0-preview.1;excludeUrls=true",
-        },
-        data=payload.encode("utf-8"),
-    )
-
     try:
-        with urllib.request.urlopen(request) as response:
+        with urlopen(
+            MARKETPLACE_QUERY,
+            method="POST",
+            headers={
+                "content-type": "application/json",
+                "accept": "application/json;api-version=6.0-preview.1;excludeUrls=true",
+            },
+            data=payload.encode("utf-8"),
+        ) as response:
             content = response.read()
     except urllib.error.URLError as error:
         raise DependencyError("Failed to get extension URL!") from error
@@ -62,75 +102,152 @@ def get_extension_url(extension_name=WORKBENCH_EXTENSION):
     # Parse response and extract the URL of the VSIX
     data = json.loads(content.decode("utf-8"))
 
-    files_raw = data["results"][0]["extensions"][0]["versions"][0]["files"]
-    files = {f["assetType"]: f["source"] for f in files_raw}
+    latest = data["results"][0]["extensions"][0]["versions"][0]
+    files = {f["assetType"]: f["source"] for f in latest["files"]}
     package = "Microsoft.VisualStudio.Services.VSIXPackage"
 
-    return files[package]
+    return files[package], latest["version"]
 
 
 def download_url(url):
-    with urllib.request.urlopen(url) as response:
-        return response.read()
-
-
-# Download the Workbench extension from the URL and return it in ZIP format
+    return session.get(url)
+
+
+# Load the stored ETag/Last-Modified/version of upstream resources
+def load_upstream():
+    if not os.path.isfile(jsonFiles["upstream"]):
+        return {}
+    return get_cached_json("upstream") or {}
+
+
+# Save the ETag/Last-Modified/version of upstream resources
+def save_upstream(upstream):
+    with open(jsonFiles["upstream"], "w") as file:
+        json.dump(upstream, file, indent=4)
+
+
+# Download a small text resource, revalidating the stored copy if there is one
+def download_revalidated(url, upstream):
+    entry = upstream.get(url)
+    headers = {}
+    if entry and "content" in entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    with urlopen(url, headers=headers) as response:
+        content = response.read()
+        if response.status == 304:
+            return entry["content"]
+        upstream[url] = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "content": content.decode("utf-8"),
+        }
+    return upstream[url]["content"]
+
+
+# Open the Workbench extension from the URL in ZIP format
+# Only the parts of the VSIX that are read are downloaded if possible
 def get_extension(url):
     print("Downloading Workbench extension...")
     try:
-        content = download_url(url)
-    except urllib.error.URLError as error:
+        return open_remote_zip(url)
+    except (urllib.error.URLError, zipfile.BadZipFile) as error:
         raise DependencyError("Failed to download extension!") from error
-    return zipfile.ZipFile(io.BytesIO(content), "r")
 
 
 # Load a file from a ZIP
 def get_file(file, path):
-    return file.read(path)
-
+    try:
+        return file.read(path)
+    except urllib.error.URLError as error:
+        raise DependencyError("Failed to download %s from extension!" % path) from error
 
-# Experimental
-def parallel_handler(deps, update_manifest=True):
-    if not deps or not isinstance(deps, list):
-        return
 
+# Install dependencies concurrently, at most NEOPO_JOBS at a time
+# Archives are streamed, so each job only holds a few chunks in memory, and
+# one job's download overlaps with another's extraction. Failures are
+# collected and reported per dependency, and manifest_deps that installed
+# successfully are recorded in the manifest with a single write at the end.
+# If platforms are given, deviceOS is only installed for those platforms.
+def install_deps(deps, manifest_deps=None, platforms=None):
     # Ensure that installation directory exists
     pathlib.Path(PARTICLE_DEPS).mkdir(parents=True, exist_ok=True)
 
-    # Download dependencies in parallel
-    with concurrent.futures.ThreadPoolExecutor() as exector:
-        exector.map(parallel_download_dep, deps)
-
-    # Update dependency manifest
-    if update_manifest:
+    failures = {}
+    if deps:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=NEOPO_JOBS) as executor:
+            jobs = {
+                executor.submit(parallel_download_dep, dep, platforms): dep
+                for dep in deps
+            }
+            for job in concurrent.futures.as_completed(jobs):
+                dep = jobs[job]
+                try:
+                    job.result()
+                except Exception as error:
+                    failures["%s@%s" % (dep["name"], dep["version"])] = error
+
+    # Update dependency manifest once
+    if manifest_deps:
         create_manifest()
-        for dep in deps:
-            write_manifest(dep)
+        write_manifest_entries(
+            [
+                dep
+                for dep in manifest_deps
+                if "%s@%s" % (dep["name"], dep["version"]) not in failures
+            ]
+        )
 
+    if failures:
+        details = ["  %s: %s" % (name, error) for name, error in failures.items()]
+        raise DependencyError(
+            "Failed to install %d dependencies!\n%s"
+            % (len(failures), "\n".join(details))
+        )
 
-# Experimental
-def parallel_download_dep(dep):
-    try:
-        with urllib.request.urlopen(dep["url"]) as response:
-            content = response.read()
-    except urllib.error.URLError as error:
-        print("%s@%s: failed to download!" % (dep["name"], dep["version"]))
-        return
-    print("%s@%s: downloaded" % (dep["name"], dep["version"]))
-    matched = hashlib.sha256(content).hexdigest() == dep["sha256"]
-    if not matched:
-        print("%s@%s: sha256 failed!" % (dep["name"], dep["version"]))
-        return
-    tarball = tarfile.open(fileobj=io.BytesIO(content), mode="r:gz")
-    path = os.path.join(PARTICLE_DEPS, dep["name"], dep["version"])
-    try:
-        tarball.extractall(path)
-        tarball.close()
-        install_receipt(dep)
-        # write_manifest(dep) #?
-        print("%s@%s: extracted" % (dep["name"], dep["version"]))
-    except PermissionError:
-        print("%s@%s: failed to extract!" % (dep["name"], dep["version"]))
+
+# Download, verify, and extract a single dependency (run by install_deps)
+def parallel_download_dep(dep, platforms=None):
+    name, version = dep["name"], dep["version"]
+    path = os.path.join(PARTICLE_DEPS, name, version)
+    installed = is_installed(dep)
+
+    # Only the files of some platforms are extracted from deviceOS releases
+    select = None
+    if platforms and name == "deviceOS":
+        select = platform_selector(platforms)
+    else:
+        platforms = None
+
+    with dependency_lock(name, version):
+        # Another neopo process may have installed it while this one waited
+        if not installed and is_installed(dep):
+            print_progress("%s@%s: installed by another process" % (name, version))
+            return
+
+        # Keep a reserve of free disk space rather than failing halfway through
+        free = shutil.disk_usage(PARTICLE_DEPS).free
+        if free < NEOPO_MIN_FREE:
+            raise DependencyError("not enough free disk space!")
+
+        print_progress("%s@%s: downloading" % (name, version))
+        try:
+            staging, content_sha256 = stream_to_staging(dep["url"], path, dep, select)
+        except urllib.error.URLError as error:
+            raise DependencyError("failed to download!") from error
+        except (PermissionError, tarfile.TarError) as error:
+            raise DependencyError("failed to extract!") from error
+        if content_sha256 != dep["sha256"]:
+            discard_staging(staging)
+            raise DependencyError("sha256 mismatch!")
+        commit_staging(staging, path)
+        install_receipt(dep, platforms)
+    if NEOPO_DEDUPE:
+        dedupe_dependency(name, version)
+    print_progress("%s@%s: installed" % (name, version))
 
 
 # Download the specified dependency
@@ -141,70 +258,139 @@ def download_dep(dep, update_manifest, check_hash):
         write_manifest(dep)
 
     name, version, url, sha256 = dep["name"], dep["version"], dep["url"], dep["sha256"]
-    print("Downloading dependency %s@%s..." % (name, version))
+    path = os.path.join(PARTICLE_DEPS, name, version)
+    installed = is_installed(dep)
 
-    try:
-        with urllib.request.urlopen(url) as response:
-            content = response.read()
-    except urllib.error.URLError as error:
-        raise DependencyError("Failed to download dependency!") from error
+    with dependency_lock(name, version):
+        # Another neopo process may have installed it while this one waited
+        if not installed and is_installed(dep):
+            return True
+        print("Downloading dependency %s@%s..." % (name, version))
+
+        # Download, hash, and extract the archive into a staging directory in one pass
+        try:
+            staging, content_sha256 = stream_to_staging(url, path, dep)
+        except urllib.error.URLError as error:
+            raise DependencyError("Failed to download dependency!") from error
 
-    # Verify that the sha256 matches
-    if check_hash:
-        content_sha256 = hashlib.sha256(content).hexdigest()
-        if content_sha256 != sha256:
+        # Verify that the sha256 matches before committing the staging directory
+        if check_hash and content_sha256 != sha256:
             print("SHA256 mismatch!")
             print("Expected: %s" % sha256)
             print("Actual: %s" % content_sha256)
             print()
             print("Would you like to proceed anyway?")
             if input("(Y/N): ").lower() != "y":
+                discard_staging(staging)
                 return False
 
-    # Ensure that installation directory exists
-    path = os.path.join(PARTICLE_DEPS, name, version)
-    pathlib.Path(path).mkdir(parents=True, exist_ok=True)
-
-    # Write the archive to a file to save RAM
-    archive = os.path.join(path, "%s-v%s.tar.gz" % (name, version))
-    with open(archive, "wb") as gz_file:
-        gz_file.write(content)
+        # Move the extracted dependency into place
+        commit_staging(staging, path)
 
-    # Extract the archive
-    with tarfile.open(archive, "r:gz") as file:
-        file.extractall(path)
+        # Create install receipt so Workbench is happy
+        install_receipt(dep)
+    if NEOPO_DEDUPE:
+        dedupe_dependency(name, version)
+    return True
 
-    # Create install receipt so Workbench is happy
-    install_receipt(dep)
 
-    # Delete the temporary archive
-    os.remove(archive)
-    return True
+# Check for the install receipt, which is only written once a dependency is in place
+def is_installed(dep):
+    path = os.path.join(PARTICLE_DEPS, dep["name"], dep["version"])
+    return os.path.isfile(os.path.join(path, INSTALL_RECEIPT))
 
 
 # Create the install receipt for a dependency
-def install_receipt(dep):
+# It is written to a temporary file and renamed so it is never seen half written
+# A deviceOS release installed for some platforms records them in its receipt
+def install_receipt(dep, platforms=None):
     name, version = dep["name"], dep["version"]
     path = os.path.join(PARTICLE_DEPS, name, version)
     installed = int(time.time() * 1000)
     receipt = {"name": name, "version": version, "installed": installed}
-    with open(os.path.join(path, INSTALL_RECEIPT), "w") as file:
+    if platforms:
+        receipt["platforms"] = sorted(platforms)
+    temp = os.path.join(
+        path, "%s.%d-%d.tmp" % (INSTALL_RECEIPT, os.getpid(), threading.get_ident())
+    )
+    with open(temp, "w") as file:
         json.dump(receipt, file, indent=4)
+    os.replace(temp, os.path.join(path, INSTALL_RECEIPT))
 
 
 # Download extension manifest and simple dependencies
-def get_deps():
+# Resources that have not changed upstream since the last run are skipped
+def get_deps(upstream):
     # Ensure that cache directory exists
     pathlib.Path(CACHE_DIR).mkdir(parents=True, exist_ok=True)
-
-    # Download and extract VSIX, and obtain dependency manifest
-    extension = get_extension(get_extension_url())
     pathlib.Path(vscodeFiles["dir"]).mkdir(parents=True, exist_ok=True)
-    manifest = get_file(extension, extensionFiles["manifest"])
+
+    if NEOPO_MIRROR:
+        manifest = get_mirror_catalog(upstream)
+    else:
+        manifest = get_extension_catalog(upstream)
 
     # The particle executable is no longer provided in the VSIX
     # But it is still hosted on binaries.particle.io
+    get_particle_binary(upstream)
+
+    # Ensure that manifest file exists and return manifest content
+    create_manifest()
+    return manifest
+
+
+# Download the dependency manifest and project templates from a neopo mirror
+def get_mirror_catalog(upstream):
+    print("Downloading catalog from %s..." % NEOPO_MIRROR)
+    try:
+        manifest = json.loads(
+            download_revalidated("%s/catalog/manifest.json" % NEOPO_MIRROR, upstream)
+        )
+        for key in ["launch", "settings"]:
+            template = download_revalidated(
+                "%s/catalog/%s.json" % (NEOPO_MIRROR, key), upstream
+            )
+            write_file(template, vscodeFiles[key], "w")
+    except urllib.error.URLError as error:
+        raise DependencyError("Failed to download catalog from mirror!") from error
+    return manifest
+
+
+# Get the dependency manifest and project templates from the Workbench extension
+def get_extension_catalog(upstream):
+    # Only download the VSIX if the Marketplace has a new version of it
+    url, version = query_extension()
+    cached = [
+        os.path.isfile(path)
+        for path in [jsonFiles[key] for key in CATALOG_KEYS]
+        + [vscodeFiles["launch"], vscodeFiles["settings"]]
+    ]
+    manifest = None
+    if upstream.get(WORKBENCH_EXTENSION) == {"version": version} and all(cached):
+        manifest = {key: get_cached_json(key) for key in CATALOG_KEYS}
+        if None in manifest.values():
+            manifest = None
+        else:
+            print("Workbench extension %s is unchanged." % version)
+
+    if manifest is None:
+        # Download and extract VSIX, and obtain dependency manifest
+        extension = get_extension(url)
+        manifest = json.loads(
+            get_file(extension, extensionFiles["manifest"]).decode("utf-8")
+        )
+
+        # Create launch.json and settings.json project template files
+        launch = get_file(extension, extensionFiles["launch"])
+        settings = get_file(extension, extensionFiles["settings"])
+        write_file(launch, vscodeFiles["launch"], "wb")
+        write_file(settings, vscodeFiles["settings"], "wb")
+        upstream[WORKBENCH_EXTENSION] = {"version": version}
+    return manifest
 
+
+# Install the particle binary unless the installed one is already current
+def get_particle_binary(upstream):
     os_platform = platform.system().lower()
     plat_map = {
         "armv7l": "arm",
@@ -215,18 +401,23 @@ def get_deps():
     os_arch = plat_map[platform.machine()]
 
     # Get manifest file
-    manifest_host = "binaries.particle.io"
-    manifest_url = f"https://{manifest_host}/particle-cli/manifest.json"
-
-    manifest_json = json.loads(download_url(manifest_url).decode())
+    manifest_json = json.loads(
+        download_revalidated(mirror_url(PARTICLE_MANIFEST), upstream)
+    )
 
     binary_url = manifest_json["builds"][os_platform][os_arch]["url"]
     binary_sha = manifest_json["builds"][os_platform][os_arch]["sha256"]
 
+    # Skip the download if the installed binary came from the same archive
+    installed_sha = upstream.get("particle", {}).get("sha256")
+    if installed_sha == binary_sha and os.path.isfile(particle_cli):
+        print("Particle binary is up to date.")
+        return
+
     print("Downloading particle binary...")
 
     # Download particle binary
-    particle_gz = download_url(binary_url)
+    particle_gz = download_url(mirror_url(binary_url))
 
     # Check hash
     assert (
@@ -239,44 +430,24 @@ def get_deps():
 
     # Install to correct location
     write_executable(particle, particle_cli)
-
-    # Create launch.json and settings.json project template files
-    launch = get_file(extension, extensionFiles["launch"])
-    settings = get_file(extension, extensionFiles["settings"])
-    write_file(launch, vscodeFiles["launch"], "wb")
-    write_file(settings, vscodeFiles["settings"], "wb")
-
-    # Ensure that manifest file exists and return manifest content
-    create_manifest()
-    return json.loads(manifest.decode("utf-8"))
+    upstream["particle"] = {"sha256": binary_sha}
 
 
 # Write an object to JSON cache file
 def write_json_caches(data, keys):
     for key in keys:
-        with open(jsonFiles[key], "w") as file:
+        with file_lock(jsonFiles[key]), open(jsonFiles[key], "w") as file:
             key_data = data[key]
             json.dump(key_data, file, indent=4)
+    if set(CATALOG_KEYS) <= set(keys):
+        save_snapshot(data)
+    catalog.invalidate(keys)
 
 
-# Install or update neopo dependencies (not the neopo script)
-def install_or_update(install, force, skip_deps):
-    print("Installing neopo..." if install else "Updating dependencies...")
-
-    # Dependencies we wish to install and caches we will create
+# Choose the latest deviceOS release and toolchains from the dependency data
+def select_deps(data):
+    # Dependencies we wish to install
     dependencies = ["compilers", "tools", "scripts", "debuggers"]
-    caches = [
-        "firmware",
-        "platforms",
-        "toolchains",
-        "compilers",
-        "tools",
-        "scripts",
-        "debuggers",
-    ]
-
-    # Download dependency data and create list of installables
-    data = get_deps()
     dep_json = [data["firmware"][0]]
 
     # Append dependencies to list
@@ -284,55 +455,57 @@ def install_or_update(install, force, skip_deps):
     dep_json.extend([data[dep][system]["x64"][0] for dep in dependencies])
 
     # Use my precompiled gcc-arm for ARM
-    install_platform = platform.machine()
-    if install_platform != "x86_64":
+    if platform.machine() != "x86_64":
         for dep in dep_json:
             if dep["name"] == "gcc-arm":
                 fix_gcc_arm(dep)
                 break
+    return dep_json
+
+
+# Install or update neopo dependencies (not the neopo script)
+def install_or_update(install, force, skip_deps):
+    print("Installing neopo..." if install else "Updating dependencies...")
+
+    # Download dependency data and create list of installables
+    # Forcing an install also refreshes every upstream resource
+    upstream = {} if force else load_upstream()
+    data = get_deps(upstream)
+    dep_json = select_deps(data)
 
-    # Update JSON cache files
-    write_json_caches(data, caches)
+    # Update JSON cache files, then record what they were created from
+    write_json_caches(data, CATALOG_KEYS)
+    save_upstream(upstream)
+    install_selected_deps(dep_json, install, force, skip_deps)
 
+
+# Install (or update to) the selected dependencies and record them in the manifest
+# Shared by install_or_update and offline bundle imports
+def install_selected_deps(dep_json, install, force, skip_deps):
     # Skip installation of dependencies (for containers)
     if skip_deps:
-        for dep in dep_json:
-            write_manifest(dep)
+        create_manifest()
+        write_manifest_entries(dep_json)
         print("Skipped installation of all dependencies.")
         return
 
-    # Experimental (parallel downloading to save time)
-    # Currently opt-in
-    if NEOPO_PARALLEL:
-        deps_to_install = []
-        for dep in dep_json:
-            install_path = os.path.join(PARTICLE_DEPS, dep["name"], dep["version"])
-            installed = os.path.isdir(install_path)
-            if force or not installed:
-                deps_to_install.append(dep)
-        # Download needed deps in parallel
-        parallel_handler(deps_to_install)
-        return
-
     # Either install or update
     if install:
+        # Install dependency if not currently installed, or forced, otherwise skip
+        # A directory without a receipt is a partial install and is installed again
+        deps_to_install = []
         skipped_deps = []
         for dep in dep_json:
-            # Install dependency if not currently installed, or forced, otherwise skip
-            install_path = os.path.join(PARTICLE_DEPS, dep["name"], dep["version"])
-            installed = os.path.isdir(install_path)
-            # Check for install receipt here? (Silent fix for older neopo installs)
-            receipt = os.path.isfile(os.path.join(install_path, INSTALL_RECEIPT))
-
-            if not installed or force:
-                download_dep(dep, True, True)
+            if not is_installed(dep) or force:
+                deps_to_install.append(dep)
             else:
                 skipped_deps.append(dep)
-                if not receipt:
-                    install_receipt(dep)
+
+        # Download needed deps in parallel and put all deps in manifest.json
+        install_deps(deps_to_install, dep_json)
 
         # Fix buildtools and openocd for aarch64
-        if install_platform == "aarch64":
+        if platform.machine() == "aarch64":
             buildtools_version = [
                 dep["version"] for dep in dep_json if dep["name"] == "buildtools"
             ][0]
@@ -342,10 +515,6 @@ def install_or_update(install, force, skip_deps):
             ][0]
             fix_openocd(openocd_version)
 
-        # Put skippedDeps in manifest.json
-        for dep in skipped_deps:
-            write_manifest(dep)
-
         # Notify user of dependencies skipped to save bandwidth and time
         if skipped_deps:
             print()
@@ -358,11 +527,13 @@ def install_or_update(install, force, skip_deps):
 
     else:
         # Only install a dependency if newer
+        deps_to_update = []
         for dep in dep_json:
             new = int(dep["version"].split("-")[0].replace(".", ""))
             old = int(get_manifest_value(dep["name"]).split("-")[0].replace(".", ""))
             if new > old:
-                download_dep(dep, True, True)
+                deps_to_update.append(dep)
+        install_deps(deps_to_update, deps_to_update)
         print("Dependencies are up to date!")
 
 
@@ -0,0 +1,296 @@
+import concurrent.futures
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# Local imports
+from .build import build_process
+from .common import NEOPO_JOBS, ProcessError, ProjectError, UserError, projectFiles
+from .daemon import ThreadOutput
+from .jobs import JOBSERVER_FDS, make_jobs, outer_jobserver
+from .lockfile import has_lockfile, load_lockfile
+from .manifest import get_manifest_value
+from .project import check_libraries, get_flags, get_settings, lock_project
+from .toolchain import check_firmware_version, get_compiler
+
+# Makefile targets run by workspace commands
+WORKSPACE_TARGETS = {"build": "compile-user", "clean": "clean-user"}
+
+# Commands of [workspace]
+WORKSPACE_COMMANDS = ["build", "clean", "libs"]
+
+
+# Find the Particle projects under a directory (projects are not searched further)
+def find_projects(root):
+    projects = []
+    for path, dirs, files in os.walk(root):
+        dirs[:] = sorted(name for name in dirs if not name.startswith("."))
+        if projectFiles["properties"] in files:
+            projects.append(path)
+            dirs[:] = []
+    return projects
+
+
+# Output of one project: complete lines, prefixed with the name of the project
+class PrefixedOutput:
+    def __init__(self, name, stream, lock):
+        self.prefix = "[%s] " % name
+        self.stream = stream
+        self.lock = lock
+        self.partial = ""
+
+    def write(self, text):
+        lines = (self.partial + text).split("\n")
+        self.partial = lines.pop()
+        if lines:
+            with self.lock:
+                for line in lines:
+                    self.stream.write(self.prefix + line + "\n")
+                self.stream.flush()
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.partial:
+            self.write("\n")
+
+
+# Jobserver shared by the builds of a workspace, so that together they run at most
+# as many jobs as it has tokens. Each build holds a token for the job make runs
+# without asking, and its make takes the others from the pipe
+class Jobserver:
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.fds = os.pipe()
+        os.write(self.fds[1], b"+" * jobs)
+
+    def acquire(self):
+        return os.read(self.fds[0], 1)
+
+    def release(self, token):
+        os.write(self.fds[1], token)
+
+    def makeflags(self):
+        return "-j%d --jobserver-auth=%d,%d" % (self.jobs, *self.fds)
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+
+
+# Resolve a project for a build, validating the toolchain of each (platform,
+# deviceOS) pair of the workspace only once: toolchains maps pairs to compilers
+def resolve_project(project_path, toolchains):
+    lock = load_lockfile(project_path)
+    if lock:
+        return lock
+    try:
+        platform, version = get_settings(project_path)
+    except (FileNotFoundError, KeyError) as error:
+        raise ProjectError(
+            "Project not configured!\nUse: neopo configure <platform> <version> <project>"
+        ) from error
+
+    if (platform, version) not in toolchains:
+        valid = check_firmware_version(platform, version)
+        toolchains[(platform, version)] = valid and get_compiler(version)
+    if not toolchains[(platform, version)]:
+        raise ProjectError("Firmware related error!")
+
+    if not check_libraries(project_path, False):
+        print("To install libraries run: $ neopo workspace libs [root]")
+    elif has_lockfile(project_path):
+        lock_project(project_path)
+    return {
+        "platform": platform,
+        "toolchain": {
+            "gcc-arm": toolchains[(platform, version)],
+            "buildscripts": get_manifest_value("buildscripts"),
+            "buildtools": get_manifest_value("buildtools"),
+            "deviceOS": version,
+        },
+        "EXTRA_CFLAGS": get_flags(project_path),
+    }
+
+
+# Run the make of a project once the jobserver has a token for it, streaming its
+# output. Returns the exit status, or None if the workspace was stopped first
+def run_make(process, environment, output, jobserver, stopped):
+    token = jobserver.acquire() if jobserver else None
+    try:
+        if stopped.is_set():
+            return None
+        make = subprocess.Popen(
+            process,
+            env=environment,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            pass_fds=outer_jobserver(environment) or (),
+        )
+        for line in make.stdout:
+            output.write(line.decode("utf-8", "replace"))
+        return make.wait()
+    finally:
+        output.close()
+        if token:
+            jobserver.release(token)
+
+
+# Resolve the projects of a workspace one after another, preparing each toolchain
+# only once. Returns the builds of the projects that resolved, and adds the others
+# to results: {project: (process, environment, output)}, {project: (status, seconds)}
+def prepare_builds(projects, names, target, environ, stdout, lock, results):
+    builds = {}
+    toolchains = {}
+    for project in projects:
+        output = PrefixedOutput(names[project], stdout, lock)
+        sys.stdout.local.stream = output
+        try:
+            process, environment, _ = build_process(
+                project,
+                target,
+                False,
+                0,
+                resolve_project(project, toolchains),
+                environ,
+            )
+            builds[project] = (process, environment, output)
+        except FileNotFoundError as error:
+            print("Could not find %s!" % error.filename)
+            results[project] = ("failed", 0)
+        except RuntimeError as error:
+            print(error)
+            results[project] = ("failed", 0)
+        finally:
+            sys.stdout.local.stream = None
+            output.close()
+    return builds
+
+
+# Build (or clean) the projects of a workspace in parallel, with one budget of jobs
+# Returns {project: (status, seconds)}
+def build_workspace(projects, names, target, stdout, lock):
+    environ = dict(os.environ)
+    jobs = make_jobs(environ)
+    if outer_jobserver(environ) is None:
+        jobserver = Jobserver(jobs)
+        flags = JOBSERVER_FDS.sub("", environ.get("MAKEFLAGS", ""))
+        environ["MAKEFLAGS"] = ("%s %s" % (jobserver.makeflags(), flags)).strip()
+        workers = min(jobs, len(projects))
+    else:
+        # Builds join the jobserver of an outer make one project at a time
+        jobserver = None
+        workers = 1
+
+    results = {}
+    stopped = threading.Event()
+
+    def build(project):
+        started = time.monotonic()
+        status = run_make(*builds[project], jobserver, stopped)
+        if status is None or status and stopped.is_set():
+            result = "stopped"
+        else:
+            result = "failed" if status else "done"
+        results[project] = (result, time.monotonic() - started)
+
+    # A ^C while resolving or building leaves the other projects reported as stopped
+    executor = None
+    try:
+        builds = prepare_builds(projects, names, target, environ, stdout, lock, results)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        for future in [executor.submit(build, project) for project in builds]:
+            future.result()
+    except KeyboardInterrupt:
+        # The builds that are running get the ^C from the terminal too
+        stopped.set()
+        print("Stopping the builds of the workspace...")
+    finally:
+        if executor:
+            executor.shutdown(wait=True, cancel_futures=True)
+        if jobserver:
+            jobserver.close()
+    return results
+
+
+# Install the libraries of the projects of a workspace in parallel
+# Returns {project: (status, seconds)}
+def install_workspace_libraries(projects, names, stdout, lock):
+    results = {}
+
+    def install(project):
+        started = time.monotonic()
+        output = PrefixedOutput(names[project], stdout, lock)
+        sys.stdout.local.stream = output
+        try:
+            if check_libraries(project, True):
+                lock_project(project)
+            result = "done"
+        except FileNotFoundError as error:
+            print("Could not find %s!" % error.filename)
+            result = "failed"
+        except RuntimeError as error:
+            print(error)
+            result = "failed"
+        finally:
+            sys.stdout.local.stream = None
+            output.close()
+        results[project] = (result, time.monotonic() - started)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=NEOPO_JOBS) as executor:
+        for future in [executor.submit(install, project) for project in projects]:
+            future.result()
+    return results
+
+
+# Print the status and duration of each project of a workspace
+def print_summary(projects, names, results):
+    width = max(len("Project"), *(len(names[project]) for project in projects))
+    print()
+    print("%-*s  %-8s  %8s" % (width, "Project", "Status", "Time"))
+    for project in projects:
+        status, seconds = results.get(project, ("stopped", 0))
+        print("%-*s  %-8s  %7.1fs" % (width, names[project], status, seconds))
+
+
+# Wrapper for [workspace]
+def workspace_command(args):
+    try:
+        action = args[2]
+    except IndexError as error:
+        raise UserError(
+            "You must supply a command! Commands are: %s"
+            % ", ".join(WORKSPACE_COMMANDS)
+        ) from error
+    if action not in WORKSPACE_COMMANDS:
+        raise UserError(
+            "Invalid command! Commands are: %s" % ", ".join(WORKSPACE_COMMANDS)
+        )
+    root = os.path.abspath(args[3]) if len(args) >= 4 else os.getcwd()
+    projects = find_projects(root)
+    if not projects:
+        raise UserError("No Particle projects found in %s!" % root)
+    names = {project: os.path.relpath(project, root) for project in projects}
+
+    # Each thread prints to the output of the project it is working on
+    stdout = sys.stdout
+    lock = threading.Lock()
+    sys.stdout = ThreadOutput(stdout)
+    try:
+        if action == "libs":
+            results = install_workspace_libraries(projects, names, stdout, lock)
+        else:
+            target = WORKSPACE_TARGETS[action]
+            results = build_workspace(projects, names, target, stdout, lock)
+    finally:
+        sys.stdout = stdout
+
+    print_summary(projects, names, results)
+    failed = [p for p in projects if results.get(p, ("stopped",))[0] != "done"]
+    if failed:
+        raise ProcessError("%d of %d projects failed!" % (len(failed), len(projects)))